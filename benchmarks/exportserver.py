@@ -0,0 +1,90 @@
+"""
+Local stand-in for management/export.php of a FOG Project server.
+
+Answers POST requests for export.php?type=sql with a generated SQL dump of a
+configurable size, after a configurable latency, streamed in chunks like the
+PHP server does.
+"""
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+from time import sleep
+
+CHUNK_SIZE = 64 * 1024
+TRAILER = b"-- Dump completed\n"
+
+
+def sql_chunk(size: int, start: int) -> bytes:
+    """Generates INSERT statements of roughly size bytes."""
+    lines = []
+    length = 0
+    row = start
+    while length < size:
+        line = (f"INSERT INTO `hosts` VALUES ({row},'host{row}',"
+                f"'00:11:22:{row % 256:02x}:{row // 256 % 256:02x}:00',"
+                f"'2024-01-01 00:00:00');\n").encode()
+        lines.append(line)
+        length += len(line)
+        row += 1
+    return b''.join(lines)
+
+
+class ExportHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not self.path.endswith('/management/export.php?type=sql'):
+            self.send_error(404)
+            return
+        server: ExportServer = self.server
+        sleep(server.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        sent = 0
+        while sent < server.payload_size:
+            chunk = sql_chunk(min(CHUNK_SIZE, server.payload_size - sent),
+                              sent)
+            self.write_chunk(chunk)
+            sent += len(chunk)
+        self.write_chunk(TRAILER)
+        self.wfile.write(b"0\r\n\r\n")
+
+    def write_chunk(self, chunk: bytes) -> None:
+        self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ExportServer(ThreadingHTTPServer):
+    """
+    HTTP server answering export.php requests.
+
+    Args:
+        port: Port to listen on, on 127.0.0.1. 0 picks a free port.
+        payload_size: Approximate size in bytes of the SQL dump.
+        latency: Seconds to wait before answering, like the PHP server
+            running mysqldump.
+    """
+    daemon_threads = True
+
+    def __init__(self, port: int = 0, payload_size: int = 64 * 1024 * 1024,
+                 latency: float = 1.0):
+        super().__init__(('127.0.0.1', port), ExportHandler)
+        self.payload_size: int = payload_size
+        self.latency: float = latency
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def start(self) -> Thread:
+        """Serves requests in a background thread."""
+        thread = Thread(target=self.serve_forever, name='export-server',
+                        daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,158 @@
+"""
+Generates a synthetic FOG Project server layout for benchmarks.
+
+The layout contains sparse multi-gigabyte image files, thousands of small
+snapins and report files, and a .fogsettings file pointing at them. Contents
+are generated from a seed, so every run with the same parameters produces the
+same tree.
+"""
+
+import os
+import random
+from dataclasses import dataclass
+from pathlib import Path
+
+MEGABYTE = 1024 * 1024
+
+
+@dataclass
+class TreeParameters:
+    """
+    Shape of a synthetic FOG layout.
+
+    Attributes:
+        images: Amount of image directories.
+        image_size: Apparent size of every image file in bytes.
+        image_data_every: Distance in bytes between the data regions of an
+            image file. Everything in between is a hole.
+        image_data_size: Size in bytes of every data region.
+        snapins: Amount of snapin files.
+        snapin_max_size: Maximum size of a snapin file in bytes.
+        reports: Amount of report files.
+        seed: Seed of the generated contents.
+    """
+    images: int = 2
+    image_size: int = 2 * 1024 * MEGABYTE
+    image_data_every: int = 256 * MEGABYTE
+    image_data_size: int = 4 * MEGABYTE
+    snapins: int = 2000
+    snapin_max_size: int = 64 * 1024
+    reports: int = 500
+    seed: int = 0
+
+
+@dataclass
+class FogTree:
+    """Paths of a generated FOG layout."""
+    root: Path
+    fogsettings: Path
+    images: Path
+    snapins: Path
+    docroot: Path
+
+    @property
+    def reports(self) -> Path:
+        return self.docroot / 'lib' / 'reports'
+
+
+def write_image(path: Path, parameters: TreeParameters,
+                rng: random.Random) -> None:
+    """Writes a sparse image file with incompressible data regions."""
+    with path.open('wb') as f:
+        for offset in range(0, parameters.image_size,
+                            parameters.image_data_every):
+            f.seek(offset)
+            f.write(rng.randbytes(min(parameters.image_data_size,
+                                      parameters.image_size - offset)))
+        f.truncate(parameters.image_size)
+
+
+def write_report(path: Path, rng: random.Random) -> None:
+    """Writes a PHP report file that compresses like source code."""
+    lines = [f"<?php\n// Report {path.stem}\n"]
+    for i in range(rng.randint(20, 400)):
+        lines.append(f"$row{i} = $this->get('{rng.choice('abcdef')}', "
+                     f"{rng.randint(0, 1000)});\n")
+    path.write_text(''.join(lines))
+
+
+def generate(root: Path, parameters: TreeParameters, port: int) -> FogTree:
+    """
+    Generates a FOG layout.
+
+    Args:
+        root: Directory to generate the layout in. Created if needed.
+        parameters: Shape of the layout.
+        port: Port of the export.php stand-in, written to .fogsettings.
+
+    Returns:
+        Paths of the generated layout.
+    """
+    rng = random.Random(parameters.seed)
+    tree = FogTree(root=root,
+                   fogsettings=root / '.fogsettings',
+                   images=root / 'images',
+                   snapins=root / 'snapins',
+                   docroot=root / 'www' / 'fog')
+
+    for i in range(parameters.images):
+        image_dir = tree.images / f'image{i}'
+        image_dir.mkdir(parents=True, exist_ok=True)
+        write_image(image_dir / 'd1p2.img', parameters, rng)
+        (image_dir / 'd1.mbr').write_bytes(rng.randbytes(512))
+        (image_dir / 'd1.partitions').write_text(
+            "label: gpt\nunit: sectors\n")
+
+    tree.snapins.mkdir(parents=True, exist_ok=True)
+    for i in range(parameters.snapins):
+        subdir = tree.snapins / f'snapin{i // 100}'
+        subdir.mkdir(exist_ok=True)
+        (subdir / f'file{i}.bin').write_bytes(
+            rng.randbytes(rng.randint(1, parameters.snapin_max_size)))
+
+    tree.reports.mkdir(parents=True, exist_ok=True)
+    for i in range(parameters.reports):
+        write_report(tree.reports / f'report{i}.php', rng)
+
+    tree.fogsettings.write_text(
+        f"ipaddress='127.0.0.1:{port}'\n"
+        f"webroot='fog'\n"
+        f"docroot='{tree.docroot}'\n"
+        f"osid='1'\n"
+        f"storageLocation='{tree.images}'\n")
+    return tree
+
+
+def mutate(tree: FogTree, parameters: TreeParameters,
+           fraction: float = 0.01) -> None:
+    """
+    Changes a fraction of the files, like a week of use of a FOG server.
+
+    Appends to some snapins and reports, deletes some, adds new ones, and
+    rewrites a data region of the first image.
+
+    Args:
+        tree: The generated layout.
+        parameters: Shape the layout was generated with.
+        fraction: Fraction of the small files to change.
+    """
+    rng = random.Random(parameters.seed + 1)
+    snapins = sorted(tree.snapins.rglob('*.bin'))
+    reports = sorted(tree.reports.glob('*.php'))
+    changed = max(1, int(len(snapins) * fraction))
+
+    for path in rng.sample(snapins, changed) + rng.sample(
+            reports, max(1, int(len(reports) * fraction))):
+        with path.open('ab') as f:
+            f.write(rng.randbytes(1024))
+    for path in rng.sample(snapins, changed):
+        path.unlink(missing_ok=True)
+    for i in range(changed):
+        (tree.snapins / 'snapin0' / f'new{i}.bin').write_bytes(
+            rng.randbytes(rng.randint(1, parameters.snapin_max_size)))
+
+    image = next(tree.images.rglob('*.img'), None)
+    if image is not None:
+        with image.open('r+b') as f:
+            f.write(rng.randbytes(parameters.image_data_size))
+        os.utime(image)
@@ -0,0 +1,260 @@
+"""
+Benchmarks full and incremental backups, rotation and pruning.
+
+Generates a synthetic FOG layout, serves export.php from a local stand-in,
+and runs Digibankup against them. Every scenario runs in its own process, so
+its peak memory is its own. Results are written as JSON, and two result files
+can be compared.
+
+Example usage:
+    python3.12 -m benchmarks.run run --image-size-mb 4096
+    python3.12 -m benchmarks.run compare old.json new.json
+"""
+
+import json
+import multiprocessing
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import traceback
+from configparser import ConfigParser
+from dataclasses import asdict
+from datetime import datetime, timezone
+from pathlib import Path
+from queue import Empty
+from time import monotonic
+
+import click
+
+import digibankup.backup as backup
+import digibankup.snapshots as snapshots
+from digibankup.config import get_config, Backupflags
+from digibankup.metrics import read_history
+
+from benchmarks.fogtree import TreeParameters, FogTree, generate, mutate
+from benchmarks.exportserver import ExportServer
+
+MEGABYTE = 1024 * 1024
+RESULTS_PATH = Path(__file__).parent / 'results'
+# Seconds between checks whether a scenario process is still running.
+POLL_INTERVAL = 1
+
+
+def make_config(workdir: Path, tree: FogTree, settings: dict) -> ConfigParser:
+    """Configures Digibankup to back up the tree into workdir/backups."""
+    config = get_config()
+    config['paths']['backups'] = str(workdir / 'backups')
+    config['paths']['info'] = str(workdir / 'info.dat')
+    config['paths']['file_index'] = str(workdir / 'index.sqlite')
+    config['paths']['history'] = str(workdir / 'history.jsonl')
+    config['paths']['log'] = str(workdir / 'backup.log')
+    config['paths']['fogsettings'] = str(tree.fogsettings)
+    config['paths']['fog_snapins'] = str(tree.snapins)
+    config['settings']['idle_priority'] = 'False'
+    config['settings']['fog_db_trailer'] = 'Dump completed'
+    config['settings']['backup_count'] = '100'
+    for key, value in settings.items():
+        config['settings'][key] = value
+    return config
+
+
+def all_flags() -> Backupflags:
+    return Backupflags(snipeit=False, fog_db=True, fog_images=True,
+                       fog_snapins=True, fog_reports=True)
+
+
+def run_backup(config: ConfigParser) -> dict:
+    Path(config['paths']['backups']).mkdir(parents=True, exist_ok=True)
+    backup.backup(config, Path(config['paths']['backups']) / '0', {},
+                  all_flags())
+    return read_history(Path(config['paths']['history']))[-1]
+
+
+def run_prune(config: ConfigParser) -> dict:
+    backups_path = Path(config['paths']['backups'])
+    snapshots.expire(backups_path, snapshots.read_index(backups_path)[1:])
+    snapshots.empty_trash(backups_path,
+                          int(config['settings']['prune_workers']))
+    return {}
+
+
+SCENARIOS = {
+    'full': run_backup,
+    'incremental': run_backup,
+    'prune': run_prune,
+}
+
+
+def scenario_process(name: str, config: ConfigParser,
+                     queue: multiprocessing.Queue) -> None:
+    start = monotonic()
+    try:
+        run = SCENARIOS[name](config)
+    except Exception:
+        queue.put({'error': traceback.format_exc()})
+        raise
+    wall_time = monotonic() - start
+    queue.put({'wall_time': wall_time,
+               'peak_rss': resource.getrusage(
+                   resource.RUSAGE_SELF).ru_maxrss * 1024,
+               'run': run})
+
+
+def measure(name: str, config: ConfigParser) -> dict:
+    """
+    Runs a scenario in a child process.
+
+    Args:
+        name: Key of the scenario in SCENARIOS.
+        config: Configuration of Digibankup.
+
+    Returns:
+        Wall time, peak memory, bytes read and written, files and
+        throughput of the scenario, and the phases of the run if it was a
+        backup.
+    """
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    process = context.Process(target=scenario_process,
+                              args=(name, config, queue))
+    process.start()
+    result = None
+    while result is None:
+        try:
+            result = queue.get(timeout=POLL_INTERVAL)
+        except Empty:
+            if process.is_alive():
+                continue
+            # The child may have put its result just before exiting.
+            try:
+                result = queue.get(timeout=POLL_INTERVAL)
+            except Empty:
+                break
+    process.join()
+    if result is None or 'error' in result:
+        reason = (f"exit code {process.exitcode}" if result is None
+                  else result['error'])
+        raise click.ClickException(f"Scenario {name} failed: {reason}")
+    if process.exitcode:
+        raise click.ClickException(f"Scenario {name} failed with exit code "
+                                   f"{process.exitcode}.")
+
+    run = result.pop('run')
+    phases = run.get('phases', {})
+    bytes_read = sum(phase['bytes_read'] for phase in phases.values())
+    result |= {
+        'bytes_read': bytes_read,
+        'bytes_written': sum(phase['bytes_written']
+                             for phase in phases.values()),
+        'files': sum(phase['files'] for phase in phases.values()),
+        'throughput': bytes_read / result['wall_time'],
+        'phases': phases,
+    }
+    click.echo(f"{name}: {result['wall_time']:.2f} s, "
+               f"{result['throughput'] / MEGABYTE:.1f} MiB/s, "
+               f"peak RSS {result['peak_rss'] / MEGABYTE:.0f} MiB")
+    return result
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              cwd=Path(__file__).parent, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.group()
+def cli() -> None:
+    """Benchmarks Digibankup against a synthetic FOG server."""
+
+
+@cli.command()
+@click.option('--workdir', type=click.Path(path_type=Path), default=None,
+              help='Directory for the tree and backups. Defaults to a '
+                   'temporary directory that is deleted afterwards.')
+@click.option('--images', default=2, help='Amount of images.')
+@click.option('--image-size-mb', default=2048,
+              help='Apparent size of every image in MiB.')
+@click.option('--snapins', default=2000, help='Amount of snapin files.')
+@click.option('--reports', default=500, help='Amount of report files.')
+@click.option('--sql-size-mb', default=64,
+              help='Size of the SQL export in MiB.')
+@click.option('--latency', default=1.0,
+              help='Seconds before export.php answers.')
+@click.option('--seed', default=0, help='Seed of the generated tree.')
+@click.option('--setting', 'settings', multiple=True,
+              help='Digibankup setting as key=value, e.g. compression=zstd.')
+@click.option('--output', type=click.Path(path_type=Path), default=None,
+              help='Result file. Defaults to benchmarks/results/<time>.json.')
+def run(workdir, images, image_size_mb, snapins, reports, sql_size_mb,
+        latency, seed, settings, output) -> None:
+    """Runs every scenario and writes the results as JSON."""
+    parameters = TreeParameters(images=images,
+                                image_size=image_size_mb * MEGABYTE,
+                                snapins=snapins, reports=reports, seed=seed)
+    settings = dict(setting.split('=', 1) for setting in settings)
+    cleanup = workdir is None
+    if cleanup:
+        workdir = Path(tempfile.mkdtemp(prefix='digibankup-bench-'))
+
+    server = ExportServer(payload_size=sql_size_mb * MEGABYTE,
+                          latency=latency)
+    server.start()
+    try:
+        click.echo(f"Generating FOG layout in {workdir}.")
+        tree = generate(workdir / 'fog', parameters, server.port)
+        config = make_config(workdir, tree, settings)
+
+        results = {'full': measure('full', config)}
+        mutate(tree, parameters)
+        results['incremental'] = measure('incremental', config)
+        rotation = results['incremental']['phases'].get('rotation', {})
+        results['rotation'] = {'wall_time': rotation.get('duration'),
+                               'peak_rss': rotation.get('peak_rss')}
+        results['prune'] = measure('prune', config)
+    finally:
+        server.shutdown()
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    now = datetime.now(timezone.utc)
+    report = {'time': now.isoformat(),
+              'commit': git_commit(),
+              'python': platform.python_version(),
+              'parameters': asdict(parameters)
+              | {'sql_size': sql_size_mb * MEGABYTE, 'latency': latency},
+              'settings': settings,
+              'scenarios': results}
+    if output is None:
+        output = RESULTS_PATH / f"{now.strftime('%Y%m%dT%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    click.echo(f"Results written to {output}.")
+
+
+@cli.command()
+@click.argument('baseline', type=click.Path(exists=True, path_type=Path))
+@click.argument('candidate', type=click.Path(exists=True, path_type=Path))
+def compare(baseline, candidate) -> None:
+    """Compares the wall time and memory of two result files."""
+    old = json.loads(baseline.read_text())
+    new = json.loads(candidate.read_text())
+    if old['parameters'] != new['parameters']:
+        click.echo("Warning: the runs used different parameters.")
+    for name, result in new['scenarios'].items():
+        previous = old['scenarios'].get(name)
+        if not previous or not previous.get('wall_time'):
+            continue
+        speedup = previous['wall_time'] / result['wall_time']
+        memory = result['peak_rss'] / previous['peak_rss']
+        click.echo(f"{name}: {previous['wall_time']:.2f} s -> "
+                   f"{result['wall_time']:.2f} s ({speedup:.2f}x faster), "
+                   f"peak RSS {memory:.2f}x")
+
+
+if __name__ == '__main__':
+    cli()
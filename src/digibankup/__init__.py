@@ -6,6 +6,9 @@ import click
 
 import digibankup.backup as backup
 import digibankup.backupsinfo as backupsinfo
+import digibankup.restore as restore
+import digibankup.retention as retention
+import digibankup.snapshots as snapshots
 from digibankup.config import get_config, Backupflags
 from digibankup.util import touch_parents, str_to_bool
 
@@ -22,15 +25,17 @@ def init_paths(config: ConfigParser):
     Path(config['paths']['backups']).mkdir(parents=True, exist_ok=True)
     touch_parents(Path(config['paths']['info']))
     touch_parents(Path(config['paths']['log']))
+    if config['paths']['event_log']:
+        touch_parents(Path(config['paths']['event_log']))
 
 
-@click.command()
+@click.group(invoke_without_command=True)
 @click.option('--log/--no-log', is_flag=True, default=None,
               help='Log steps of backup.')
 @click.option('--check-date', is_flag=True, default=None,
               help='Check if sufficient time has been elapsed since backup.')
 @click.option('--snipeit/--no-snipeit', is_flag=True, default=None,
-              help='Backup Snipe IT server. (NOT IMPLEMENTED)')
+              help='Backup Snipe IT server.')
 @click.option('--fogdb/--no-fogdb', 'fog_db', is_flag=True, default=None,
               help='Backup FOG Project database.')
 @click.option('--fogimages/--no-fogimages', 'fog_images',
@@ -46,9 +51,17 @@ def init_paths(config: ConfigParser):
               help='Path of a config file to use.')
 @click.option('--export-config', 'config_export_path', default="",
               help='Path at which to export the configuration.')
-def main(log, check_date, snipeit, fog_db, fog_images, fog_snapins,
-         fog_reports, config_path='', config_export_path='') -> None:
+@click.option('--daemon', is_flag=True, default=False,
+              help='Keep running, performing a backup every backup_interval '
+                   'days and watching the FOG Project files in between.')
+@click.pass_context
+def main(ctx, log, check_date, snipeit, fog_db, fog_images, fog_snapins,
+         fog_reports, config_path='', config_export_path='',
+         daemon=False) -> None:
     """Performs backups of FOG Project and Snipe IT servers."""
+    if ctx.invoked_subcommand is not None:
+        return
+
     config: ConfigParser = get_config(Path(config_path))
 
     if check_date is None:
@@ -73,6 +86,9 @@ def main(log, check_date, snipeit, fog_db, fog_images, fog_snapins,
     if log:
         from digibankup.logging import configure_logging
         configure_logging(config)
+    if config['paths']['event_log']:
+        from digibankup.logging import configure_events
+        configure_events(config)
 
     logger.info("====== DIGIBANKUP 0.0.2 by Raf V. ======")
 
@@ -80,6 +96,11 @@ def main(log, check_date, snipeit, fog_db, fog_images, fog_snapins,
 
     backup_path = Path(config['paths']['backups']) / '0'
 
+    if daemon:
+        import digibankup.daemon
+        digibankup.daemon.run(config, backupflags, backup_path)
+        return
+
     if check_date:
         if backupsinfo.performed_recent_backup(config, backups_info):
             logger.info("Backup has already been performed recently. "
@@ -92,3 +113,85 @@ def main(log, check_date, snipeit, fog_db, fog_images, fog_snapins,
 
     if config_export_path != '':
         config.write(Path(config_export_path).open('w'))
+
+
+@main.command('restore')
+@click.option('--generation', default=1,
+              help='Backup to restore. 1 is the last completed backup, 2 the '
+                   'one before...')
+@click.option('--snapshot', 'name', default=None,
+              help='Name of the snapshot to restore, instead of a generation.')
+@click.option('--target', 'targets', multiple=True,
+              type=click.Choice(list(restore.TARGETS)),
+              help='Part to restore. Can be repeated. Defaults to every part '
+                   'that has somewhere to go.')
+@click.option('--to', type=click.Path(file_okay=False, path_type=Path),
+              default=None,
+              help='Restore into this directory instead of to the FOG '
+                   'server.')
+@click.option('--import-db', 'import_database', is_flag=True, default=False,
+              help='Import the database dump into the FOG server.')
+@click.option('--verify/--no-verify', default=True,
+              help='Check restored files against the manifest of the backup.')
+@click.option('--workers', type=int, default=None,
+              help='Amount of files restored at the same time.')
+@click.option('--log/--no-log', is_flag=True, default=None,
+              help='Log steps of restore.')
+@click.option('--config', 'config_path', default="",
+              help='Path of a config file to use.')
+def restore_snapshot(generation, name, targets, to, import_database, verify,
+                     workers, log, config_path='') -> None:
+    """Restores a backup to the FOG Project server."""
+    config: ConfigParser = get_config(Path(config_path))
+    if workers is not None:
+        config['settings']['copy_workers'] = str(workers)
+
+    if log is None:
+        log = str_to_bool(config['settings']['log'])
+    if log:
+        touch_parents(Path(config['paths']['log']))
+        from digibankup.logging import configure_logging
+        configure_logging(config)
+
+    if not targets:
+        targets = [target for target in restore.TARGETS
+                   if target != 'db' or to is not None or import_database]
+
+    try:
+        snapshot = restore.find_snapshot(Path(config['paths']['backups']),
+                                         generation, name)
+        logger.info(f"Initializing restore of {snapshot.name}.")
+        restore.restore(config, snapshot, list(targets), to,
+                        import_database, verify)
+    except (FileNotFoundError, ValueError, RuntimeError) as e:
+        raise click.ClickException(str(e)) from e
+
+
+@main.command('prune')
+@click.option('--dry-run', is_flag=True, default=False,
+              help='Only list the backups with their size and whether they '
+                   'are kept or expire.')
+@click.option('--log/--no-log', is_flag=True, default=None,
+              help='Log steps of pruning.')
+@click.option('--config', 'config_path', default="",
+              help='Path of a config file to use.')
+def prune(dry_run, log, config_path='') -> None:
+    """Applies the retention policy to the backups."""
+    config: ConfigParser = get_config(Path(config_path))
+
+    if log is None:
+        log = str_to_bool(config['settings']['log'])
+    if log:
+        touch_parents(Path(config['paths']['log']))
+        from digibankup.logging import configure_logging
+        configure_logging(config)
+
+    backups_path = Path(config['paths']['backups'])
+    plan = retention.plan(config, backups_path, usage=True)
+    for line in retention.describe(plan):
+        click.echo(line)
+    if dry_run:
+        return
+    retention.apply(config, backups_path, plan)
+    snapshots.empty_trash(backups_path,
+                          int(config['settings']['prune_workers']))
@@ -1,42 +1,100 @@
 from logging import getLogger
 from pathlib import Path
+from functools import partial
+from zoneinfo import ZoneInfo
 from configparser import ConfigParser
 
 import digibankup.fog as fog
 import digibankup.snipeit as snipeit
 import digibankup.backupsinfo as backupsinfo
-from digibankup.util import rmtree
+import digibankup.retention as retention
+import digibankup.snapshots as snapshots
+import digibankup.dbdelta as dbdelta
+import digibankup.destinations as destinations
+from digibankup.util import rmtree, str_to_bool
 from digibankup.config import Backupflags
+from digibankup.throttle import lower_priority
+from digibankup.journal import Journal
+from digibankup.manifest import Manifest
+from digibankup.fileindex import FileIndex
+from digibankup.scheduler import Scheduler, Task, raise_failures
+from digibankup.metrics import RunMetrics
+from digibankup.watcher import ChangeSet
 
 
 logger = getLogger(__name__)
 
 
-def rotate_backups(config: ConfigParser):
+def rotate_backups(config: ConfigParser, backup_path: Path) -> Path:
     """
     Rotates backup directories after finishing a backup.
 
+    The finished backup is renamed into a new snapshot, and the snapshots
+    the retention policy does not keep are moved into the trash. With
+    settings.fog_db_storage set to delta, the database dump of the previous
+    snapshot is replaced by a delta against the new one. Depending on
+    settings.prune, the trash is emptied right away or at the start of the
+    next backup.
+
     Args:
         config: Contains configuration settings for the backup.
+        backup_path: Root path of the finished backup.
+
+    Returns:
+        Path of the new snapshot.
     """
 
     backups_path = Path(config['paths']['backups'])
-    backup_count = Path(config['settings']['backup_count'])
+    timezone = ZoneInfo(config['settings']['timezone'])
+
+    snapshots.migrate(backups_path, timezone)
+    snapshot = snapshots.promote(backups_path, backup_path, timezone)
 
-    if (backups_path / backup_count).is_dir():
-        rmtree(backups_path / backup_count)
+    if config['settings']['fog_db_storage'] == 'delta':
+        dbdelta.encode_previous(backups_path, config['subpaths']['fog_db'])
 
-    backup_dirs = sorted(
-        [i for i in backups_path.iterdir() if i.name.isdigit()],
-        key=lambda x: int(x.name), reverse=True
-    )
+    retention.apply(config, backups_path,
+                    retention.plan(config, backups_path))
 
-    for i in backup_dirs:
-        i.rename(backups_path / str(int(i.name) + 1))
+    if config['settings']['prune'] == 'immediate':
+        snapshots.empty_trash(backups_path,
+                              int(config['settings']['prune_workers']))
+
+    return snapshot
 
 
 def backup(config: ConfigParser, backup_path: Path, backups_info: dict,
-           backupflags: Backupflags):
+           backupflags: Backupflags, changes: ChangeSet | None = None):
+    """
+    Performs a backup and records its metrics in the run history.
+
+    Args:
+        config: Contains configuration settings for the backup.
+        backup_path: Root destination path of the ongoing backup.
+        backups_info: Dict containing date of last backup.
+        backupflags: Contains flags indicating which backups to perform.
+        changes: Directories changed since the previous backup, collected
+            by the daemon.
+    """
+    metrics = RunMetrics.from_config(config)
+    try:
+        perform_backup(config, backup_path, backups_info, backupflags,
+                       metrics, changes)
+    except BaseException:
+        metrics.finish(success=False)
+        raise
+    else:
+        metrics.finish(success=True)
+        backupsinfo.write_backups_info(config, backups_info,
+                                       metrics.finished)
+    finally:
+        metrics.write()
+
+
+def perform_backup(config: ConfigParser, backup_path: Path,
+                   backups_info: dict, backupflags: Backupflags,
+                   metrics: RunMetrics,
+                   changes: ChangeSet | None = None) -> None:
     """
     Performs a backup.
 
@@ -45,25 +103,110 @@ def backup(config: ConfigParser, backup_path: Path, backups_info: dict,
         backup_path: Root destination path of the ongoing backup.
         backups_info: Dict containing date of last backup.
         backupflags: Contains flags indicating which backups to perform.
+        metrics: Metrics of the run, measured by phase.
+        changes: Directories changed since the previous backup. Only used
+            if they are relative to the previous backup and complete.
     """
 
     backups_path = Path(config['paths']['backups'])
 
-    if backup_path.is_dir():
-        logger.warning(f"Directory {backup_path} exists. "
-                       f"Recursively removing directory.")
-        rmtree(backup_path)
-
-    backup_path.mkdir(parents=True)
+    if str_to_bool(config['settings']['idle_priority']):
+        lower_priority()
 
-    fog.backup(config, backup_path, backupflags)
-    snipeit.backup(config, backup_path, backupflags)
+    trash_thread = snapshots.start_emptying_trash(
+        backups_path, int(config['settings']['prune_workers']))
 
-    logger.info("Backup performed successfully.")
-
-    rotate_backups(config)
-
-    logger.info(f"Backup stored at {backups_path / '1'}. Other backup "
-                f"directory names incremented by 1.")
-
-    backupsinfo.write_backups_info(config, backups_info)
+    journal = Journal.from_config(config, backup_path)
+    if backup_path.is_dir():
+        if journal.load():
+            logger.info(f"Resuming interrupted backup at {backup_path}. "
+                        f"{len(journal.entries)} files already finished.")
+        else:
+            logger.warning(f"Directory {backup_path} exists. "
+                           f"Recursively removing directory.")
+            rmtree(backup_path, int(config['settings']['prune_workers']))
+
+    backup_path.mkdir(parents=True, exist_ok=True)
+    journal.open()
+
+    previous_path = None
+    if str_to_bool(config['settings']['incremental']):
+        snapshots.migrate(backups_path,
+                          ZoneInfo(config['settings']['timezone']))
+        previous_path = snapshots.snapshot_path(backups_path, 1)
+        if previous_path is not None:
+            logger.info(f"Performing incremental backup against "
+                        f"{previous_path}.")
+        else:
+            logger.info("No previous backup found. Performing full backup.")
+
+    manifest = Manifest.from_config(config, backup_path, previous_path)
+    index = FileIndex.from_config(config, backup_path, previous_path)
+    index.load()
+
+    if changes is not None:
+        previous_name = None if previous_path is None else previous_path.name
+        if changes.usable(previous_name) and index.enabled:
+            logger.info(f"Only comparing files in the "
+                        f"{changes.summary()} since {changes.since}.")
+        else:
+            logger.info("Changes since the previous backup are not fully "
+                        "known. Comparing every file.")
+            changes = None
+
+    extra_destinations = destinations.from_config(config, metrics)
+    try:
+        tee = None
+        if extra_destinations:
+            for destination in extra_destinations:
+                destination.prepare(backup_path)
+            tee = destinations.tee_function(extra_destinations)
+
+        scheduler = Scheduler.from_config(config, metrics)
+        fog.backup(config, backup_path, backupflags, previous_path, journal,
+                   manifest, index, scheduler, metrics, changes, tee)
+        if backupflags.snipeit:
+            scheduler.add(Task('snipeit', partial(
+                snipeit.backup, config, backup_path, backupflags,
+                backups_info, previous_path, manifest,
+                metrics.phase('snipeit')),
+                resources=('http', 'destination')))
+        raise_failures(scheduler.run())
+
+        manifest.write()
+
+        if journal.resumed:
+            journal.prune()
+        journal.remove()
+
+        logger.info("Backup performed successfully.")
+
+        for destination in extra_destinations:
+            with metrics.measure(f'destination_{destination.name}'):
+                try:
+                    destination.complete()
+                except Exception as e:
+                    destination.fail(e)
+
+        trash_thread.join()
+        with metrics.measure('rotation'):
+            snapshot = rotate_backups(config, backup_path)
+            index.commit(snapshot.name)
+
+        logger.info(f"Backup stored at {snapshot}, also available as "
+                    f"{backups_path / '1'}. Other backup numbers "
+                    f"incremented by 1.")
+
+        for destination in extra_destinations:
+            if destination.failed:
+                continue
+            try:
+                location = destination.rotate(backups_info)
+            except Exception as e:
+                destination.fail(e)
+                continue
+            logger.info(f"Backup also stored at {location} for "
+                        f"destination {destination.name}.")
+    finally:
+        for destination in extra_destinations:
+            destination.close()
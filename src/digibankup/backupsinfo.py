@@ -7,6 +7,8 @@ from configparser import ConfigParser
 
 from datetime import datetime, date, timedelta
 
+from digibankup.metrics import read_history, last_success
+
 logger = getLogger(__name__)
 
 
@@ -24,20 +26,28 @@ def get_backups_info(config: ConfigParser) -> dict:
             return json.load(f)
     except FileNotFoundError:
         logger.warning(f"No info file about previous backups at {info_path}. "
-                       f"Falling back on defaults.")
+                       f"Falling back on run history.")
     except json.JSONDecodeError as e:
         logger.error(f"Could not parse info file about previous backups at "
-                     f"{info_path}. Falling back on defaults.",
+                     f"{info_path}. Falling back on run history.",
                      exc_info=e)
     except Exception as e:
         logger.critical(f"Error while retrieving info file about previous "
                         f"backups at {info_path}. Cannot continue.",
                         exc_info=e)
         raise e
+
+    history_path = Path(config['paths']['history'])
+    last_datetime = last_success(read_history(history_path))
+    if last_datetime is not None:
+        return {'last_datetime': last_datetime}
+    logger.warning("No successful backup in run history. "
+                   "Falling back on defaults.")
     return dict(config['default_info'])
 
 
-def write_backups_info(config: ConfigParser, backups_info: dict) -> None:
+def write_backups_info(config: ConfigParser, backups_info: dict,
+                       finished: datetime | None = None) -> None:
     """
     Stores date of last backup.
 
@@ -45,11 +55,15 @@ def write_backups_info(config: ConfigParser, backups_info: dict) -> None:
         config: Contains configuration settings for the backup.
         backups_info: Previous backups_info dict, will be updated,
             and saved as JSON file.
+        finished: Time the backup finished, as recorded in the run history.
+            Defaults to now.
     """
     info_path = Path(config['paths']['info'])
     timezone = ZoneInfo(config['settings']['timezone'])
 
-    backups_info['last_datetime'] = datetime.now(timezone).isoformat()
+    if finished is None:
+        finished = datetime.now(timezone)
+    backups_info['last_datetime'] = finished.isoformat()
     try:
         with info_path.open('w') as f:
             return json.dump(backups_info, f)
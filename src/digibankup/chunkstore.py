@@ -0,0 +1,422 @@
+"""
+Deduplicated storage of large files in a content-addressed chunk repository.
+
+Files are split into chunks at content-defined boundaries, so an insertion or
+deletion only changes the chunks around it. Each chunk is stored once under
+its digest, and every backup keeps a manifest listing the chunks of each file.
+"""
+
+import os
+import json
+import hashlib
+from logging import getLogger
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from threading import Lock
+from typing import BinaryIO, Callable, Iterator
+
+from digibankup.util import format_filesize
+from digibankup.throttle import Throttle
+from digibankup.transfer import write_sparse
+from digibankup.manifest import (new_hasher, format_digest,
+                                 digest_algorithm, ChecksumError)
+from digibankup.metrics import PhaseMetrics
+
+logger = getLogger(__name__)
+
+READ_SIZE = 16 * 1024 * 1024
+WINDOW = 20
+
+# Maps every byte to 1 or 0 using a fixed pseudorandom table. A chunk boundary
+# is placed after WINDOW consecutive bytes that all map to 1, which happens
+# about once every 2 ** (WINDOW + 1) bytes in high entropy data. Because the
+# condition only depends on the last WINDOW bytes it is a rolling predicate,
+# and bytes.translate and bytes.find evaluate it without a per-byte loop.
+# 0x00 and 0xff never qualify, so long runs of padding are not cut up.
+BOUNDARY_TABLE = bytes(
+    0 if i in (0x00, 0xff) else hashlib.blake2b(bytes([i])).digest()[0] & 1
+    for i in range(256)
+)
+BOUNDARY_RUN = b'\x01' * WINDOW
+
+
+def find_cut(buf: bytearray, min_size: int, max_size: int) -> int:
+    """
+    Finds the end of the first chunk in a buffer.
+
+    Args:
+        buf: Buffer starting at a chunk boundary.
+        min_size: Minimum chunk size in bytes.
+        max_size: Maximum chunk size in bytes.
+
+    Returns:
+        Length of the first chunk in buf.
+    """
+    end = min(len(buf), max_size)
+    if end <= min_size:
+        return end
+    start = min_size - WINDOW
+    idx = bytes(buf[start:end]).translate(BOUNDARY_TABLE).find(BOUNDARY_RUN)
+    if idx < 0:
+        return end
+    return start + idx + WINDOW
+
+
+def iter_chunks(f: BinaryIO, min_size: int, max_size: int,
+                throttle: Throttle | None = None) -> Iterator[bytes]:
+    """
+    Splits a file into content-defined chunks.
+
+    Args:
+        f: File opened in binary mode.
+        min_size: Minimum chunk size in bytes.
+        max_size: Maximum chunk size in bytes.
+        throttle: If set, every read waits for the throttle.
+
+    Yields:
+        Consecutive chunks of the file.
+    """
+    buf = bytearray()
+    eof = False
+    while not eof:
+        if throttle is not None:
+            throttle.consume(READ_SIZE)
+        data = f.read(READ_SIZE)
+        eof = not data
+        buf += data
+        while len(buf) >= max_size or (eof and buf):
+            cut = find_cut(buf, min_size, max_size)
+            yield bytes(buf[:cut])
+            del buf[:cut]
+
+
+class ChunkStore():
+    """
+    Content-addressed chunk repository.
+
+    Chunks are stored as files named after their digest. The index file lists
+    every stored chunk with its size, so checking whether a chunk exists does
+    not require a stat over the network.
+    """
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            root=Path(config['paths']['backups']) / 'chunks',
+            min_size=int(config['settings']['chunk_min_size']),
+            max_size=int(config['settings']['chunk_max_size'])
+        )
+
+    def __init__(self, root: Path, min_size: int, max_size: int):
+        self.root: Path = root
+        self.min_size: int = min_size
+        self.max_size: int = max_size
+        self.index_path: Path = root / 'index'
+        self.index: dict[str, int] = {}
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.load_index()
+
+    def load_index(self) -> None:
+        """Reads the chunk index, rebuilding it if it is missing."""
+        try:
+            with self.index_path.open('r') as f:
+                for line in f:
+                    digest, size = line.split()
+                    self.index[digest] = int(size)
+        except FileNotFoundError:
+            logger.warning(f"No chunk index at {self.index_path}. "
+                           f"Rebuilding from stored chunks.")
+            self.rebuild_index()
+
+    def rebuild_index(self) -> None:
+        """Rebuilds the chunk index by listing the stored chunks."""
+        self.index = {}
+        for prefix in self.root.iterdir():
+            if not prefix.is_dir():
+                continue
+            for chunk in os.scandir(prefix):
+                if chunk.is_file() and '.' not in chunk.name:
+                    self.index[chunk.name] = chunk.stat().st_size
+        self.write_index()
+
+    def write_index(self) -> None:
+        """Atomically replaces the chunk index with the in-memory index."""
+        tmp_path = self.index_path.with_suffix('.tmp')
+        with tmp_path.open('w') as f:
+            for digest, size in self.index.items():
+                f.write(f"{digest} {size}\n")
+        tmp_path.replace(self.index_path)
+
+    def chunk_path(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest
+
+    def put(self, chunk: bytes) -> str:
+        """
+        Stores a chunk if it is not stored yet.
+
+        Args:
+            chunk: Contents of the chunk.
+
+        Returns:
+            Digest referring to the chunk.
+        """
+        digest = hashlib.blake2b(chunk, digest_size=20).hexdigest()
+        if digest in self.index:
+            return digest
+
+        path = self.chunk_path(digest)
+        path.parent.mkdir(exist_ok=True)
+        tmp_path = path.with_suffix('.tmp')
+        tmp_path.write_bytes(chunk)
+        tmp_path.replace(path)
+
+        self.index[digest] = len(chunk)
+        with self.index_path.open('a') as f:
+            f.write(f"{digest} {len(chunk)}\n")
+        return digest
+
+    def get(self, digest: str) -> bytes:
+        return self.chunk_path(digest).read_bytes()
+
+    def put_file(self, src: Path, throttle: Throttle | None = None,
+                 hasher=None) -> list[str]:
+        """
+        Stores a file as chunks.
+
+        Args:
+            src: Path of the file to store.
+            throttle: If set, every read waits for the throttle.
+            hasher: If set, the contents of the file are added to this hash
+                object.
+
+        Returns:
+            Digests of the chunks of the file, in order.
+        """
+        digests = []
+        with src.open('rb') as f:
+            for chunk in iter_chunks(f, self.min_size, self.max_size,
+                                     throttle):
+                if hasher is not None:
+                    hasher.update(chunk)
+                digests.append(self.put(chunk))
+        return digests
+
+    def extract_file(self, digests: list[str], dst: Path,
+                     hasher=None) -> None:
+        """
+        Reassembles a stored file, leaving holes where chunks are all zeros.
+
+        Args:
+            digests: Digests of the chunks of the file, in order.
+            dst: Path to write the file to.
+            hasher: If set, the contents of the file are added to this hash
+                object.
+        """
+        with dst.open('wb') as f:
+            for digest in digests:
+                chunk = self.get(digest)
+                if hasher is not None:
+                    hasher.update(chunk)
+                write_sparse(f, chunk)
+            f.truncate()
+
+    def collect_garbage(self, referenced: set[str]) -> None:
+        """
+        Deletes every chunk that is not referenced anymore.
+
+        Args:
+            referenced: Digests of all chunks referenced by kept manifests.
+        """
+        unreferenced = [d for d in self.index if d not in referenced]
+        freed = 0
+        for digest in unreferenced:
+            try:
+                self.chunk_path(digest).unlink()
+            except FileNotFoundError:
+                pass
+            freed += self.index.pop(digest)
+        self.write_index()
+        logger.info(f"Deleted {len(unreferenced)} unreferenced chunks. "
+                    f"Freed {format_filesize(freed)}.")
+
+
+def read_manifest(manifest_path: Path) -> dict[str, dict]:
+    """
+    Reads a manifest of a chunked tree.
+
+    Args:
+        manifest_path: Path of the manifest.
+
+    Returns:
+        Manifest entries keyed by their path relative to the tree root.
+    """
+    entries = {}
+    with manifest_path.open('r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line of an interrupted manifest may be cut off.
+                break
+            entries[entry['path']] = entry
+    return entries
+
+
+def backup_tree(store: ChunkStore, src_root: Path, manifest_path: Path,
+                previous_manifest_path: Path | None = None,
+                logging_min_filesize: int = 0,
+                throttle: Throttle | None = None,
+                checksum: str = 'none',
+                stats: PhaseMetrics | None = None,
+                ignore: Callable[[str, list[str]], set[str]] | None = None
+                ) -> None:
+    """
+    Stores a directory tree in the chunk store and writes its manifest.
+
+    Args:
+        store: Chunk store to store file contents in.
+        src_root: Root of the directory tree to back up.
+        manifest_path: Path to write the manifest to.
+        previous_manifest_path: Manifest of the same tree in the previous
+            backup. Files with unchanged size and modification time reuse
+            their chunk list without being read.
+        logging_min_filesize: Files with a size smaller than this are not
+            logged.
+        throttle: If set, every read waits for the throttle.
+        checksum: Algorithm of the checksum of every file recorded in the
+            manifest, or none.
+        stats: If set, every file is counted in it.
+        ignore: If set, called with every directory and the names of its
+            entries, like the ignore argument of shutil.copytree. The
+            returned names are not stored.
+    """
+    previous = {}
+    if previous_manifest_path is not None and previous_manifest_path.is_file():
+        previous = read_manifest(previous_manifest_path)
+
+    # The manifest of an interrupted backup lists files whose chunks are
+    # already stored, so resuming does not read them again.
+    tmp_path = manifest_path.with_suffix('.tmp')
+    if tmp_path.is_file():
+        previous |= read_manifest(tmp_path)
+    with tmp_path.open('w') as manifest:
+        for dirpath, dirnames, filenames in os.walk(src_root):
+            if ignore is not None:
+                ignored = ignore(dirpath, dirnames + filenames)
+                dirnames[:] = [d for d in dirnames if d not in ignored]
+                filenames = [f for f in filenames if f not in ignored]
+            dirnames.sort()
+            for name in sorted(filenames):
+                src = Path(dirpath) / name
+                rel = src.relative_to(src_root).as_posix()
+                src_stat = src.lstat()
+                entry = {'path': rel,
+                         'size': src_stat.st_size,
+                         'mtime_ns': src_stat.st_mtime_ns,
+                         'mode': src_stat.st_mode}
+
+                if src.is_symlink():
+                    entry['symlink'] = os.readlink(src)
+                elif (rel in previous
+                      and previous[rel]['size'] == entry['size']
+                      and previous[rel]['mtime_ns'] == entry['mtime_ns']
+                      and 'chunks' in previous[rel]):
+                    entry['chunks'] = previous[rel]['chunks']
+                    entry['digest'] = previous[rel].get('digest')
+                    if stats is not None:
+                        stats.add_file(linked=True)
+                else:
+                    if entry['size'] > logging_min_filesize:
+                        logger.info(f"Chunking {src}. Filesize: "
+                                    f"{format_filesize(entry['size'])}")
+                    hasher = None
+                    if checksum != 'none':
+                        hasher = new_hasher(checksum)
+                    entry['chunks'] = store.put_file(src, throttle, hasher)
+                    if hasher is not None:
+                        entry['digest'] = format_digest(checksum, hasher)
+                    if stats is not None:
+                        stats.add_file(entry['size'])
+                manifest.write(json.dumps(entry) + '\n')
+    tmp_path.replace(manifest_path)
+
+
+def extract_tree(store: ChunkStore, manifest_path: Path, dst_root: Path,
+                 workers: int = 1,
+                 verify: bool = False) -> list[tuple[str, str, str]]:
+    """
+    Restores a chunked directory tree from its manifest.
+
+    Args:
+        store: Chunk store containing the file contents.
+        manifest_path: Manifest of the tree.
+        dst_root: Directory to restore the tree into.
+        workers: Amount of files restored at the same time.
+        verify: Whether to compare every restored file with the checksum in
+            the manifest, if it has one.
+
+    Returns:
+        (chunk manifest, dst, reason) for every file that could not be
+        restored, in the same format as transfer.copy_tree.
+    """
+    errors: list[tuple[str, str, str]] = []
+    errors_lock = Lock()
+
+    def extract_one(entry: dict) -> None:
+        dst = dst_root / entry['path']
+        try:
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            if 'symlink' in entry:
+                dst.unlink(missing_ok=True)
+                os.symlink(entry['symlink'], dst)
+                return
+            hasher = algorithm = None
+            if verify and entry.get('digest'):
+                algorithm = digest_algorithm(entry['digest'])
+                hasher = new_hasher(algorithm)
+            store.extract_file(entry['chunks'], dst, hasher)
+            os.chmod(dst, entry['mode'] & 0o7777)
+            os.utime(dst, ns=(entry['mtime_ns'], entry['mtime_ns']))
+            if (hasher is not None
+                    and format_digest(algorithm, hasher) != entry['digest']):
+                raise ChecksumError(f"Checksum of {dst} does not match "
+                                    f"{manifest_path}.")
+        except OSError as e:
+            with errors_lock:
+                errors.append((os.fspath(manifest_path), os.fspath(dst),
+                               str(e)))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for entry in read_manifest(manifest_path).values():
+            executor.submit(extract_one, entry)
+    return errors
+
+
+def referenced_chunks(backup_paths: list[Path], subpath: str) -> set[str]:
+    """
+    Collects the chunks referenced by the manifests of the kept backups.
+
+    The partial manifest of an interrupted backup counts as well, because
+    resuming the backup reuses its chunk lists.
+
+    Args:
+        backup_paths: Root paths of all kept backups.
+        subpath: Subpath of the chunked tree within a backup.
+
+    Returns:
+        Digests of all referenced chunks.
+    """
+    referenced = set()
+    for backup_path in backup_paths:
+        manifest_path = manifest_path_of(backup_path / subpath)
+        for path in (manifest_path, manifest_path.with_suffix('.tmp')):
+            if not path.is_file():
+                continue
+            for entry in read_manifest(path).values():
+                referenced.update(entry.get('chunks', ()))
+    return referenced
+
+
+def manifest_path_of(tree_path: Path) -> Path:
+    """Determines where the manifest of a chunked tree is stored."""
+    return tree_path.with_name(tree_path.name + '.manifest')
@@ -0,0 +1,231 @@
+"""
+Compresses backed up files in parallel blocks.
+
+Files are split into blocks that are compressed independently by a shared
+pool of threads, and written as consecutive gzip members or zstd frames. The
+result is a regular .gz or .zst file that standard tools can decompress.
+Requires the zstandard package for zstd compression.
+"""
+
+import io
+import os
+import zlib
+import shutil
+from collections import deque
+from configparser import ConfigParser
+from concurrent.futures import ThreadPoolExecutor, Future
+from logging import getLogger
+from pathlib import Path
+from typing import BinaryIO, Callable
+
+from digibankup.throttle import Throttle
+from digibankup.transfer import TeeTarget, TeeWriter
+
+logger = getLogger(__name__)
+
+BLOCK_SIZE = 1024 * 1024
+SAMPLE_SIZE = 256 * 1024
+# Files whose sample does not shrink below this fraction of its size are
+# considered incompressible and are stored as-is.
+MAX_SAMPLE_RATIO = 0.9
+
+SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+def gzip_block_compressor(level: int) -> Callable[[bytes], bytes]:
+    def compress(block: bytes) -> bytes:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        return compressor.compress(block) + compressor.flush()
+    return compress
+
+
+def zstd_block_compressor(level: int) -> Callable[[bytes], bytes]:
+    import zstandard
+
+    def compress(block: bytes) -> bytes:
+        return zstandard.ZstdCompressor(level=level).compress(block)
+    return compress
+
+
+BLOCK_COMPRESSORS = {
+    'gzip': gzip_block_compressor,
+    'zstd': zstd_block_compressor,
+}
+
+
+class CompressedWriter():
+    """
+    Writable file object that compresses its contents in parallel blocks.
+
+    At most a fixed amount of blocks are being compressed at a time, so
+    memory use does not depend on the size of the written file.
+    """
+    def __init__(self, compressor: 'Compressor', f: BinaryIO):
+        self.compressor: Compressor = compressor
+        self.f: BinaryIO = f
+        self.buffer: bytearray = bytearray()
+        self.pending: deque[Future] = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *e):
+        self.close()
+
+    def submit(self, block: bytes) -> None:
+        self.pending.append(self.compressor.executor.submit(
+            self.compressor.compress_block, block))
+        while len(self.pending) > self.compressor.threads * 2:
+            self.f.write(self.pending.popleft().result())
+
+    def write(self, data) -> int:
+        self.buffer += data
+        while len(self.buffer) >= BLOCK_SIZE:
+            self.submit(bytes(self.buffer[:BLOCK_SIZE]))
+            del self.buffer[:BLOCK_SIZE]
+        return len(data)
+
+    def close(self) -> None:
+        if self.buffer:
+            self.submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.f.write(self.pending.popleft().result())
+        self.f.close()
+
+
+class Compressor():
+    """
+    Compresses files with a configured algorithm and level.
+
+    With algorithm 'none' the compressor is disabled and passes data through.
+    """
+    @classmethod
+    def from_config(cls, config: ConfigParser):
+        return cls(algorithm=config['settings']['compression'],
+                   level=int(config['settings']['compression_level']),
+                   threads=int(config['settings']['compression_threads']))
+
+    def __init__(self, algorithm: str, level: int, threads: int):
+        if algorithm != 'none' and algorithm not in BLOCK_COMPRESSORS:
+            raise ValueError(f"Unknown compression algorithm {algorithm}. "
+                             f"Choose from none, "
+                             f"{', '.join(BLOCK_COMPRESSORS)}.")
+        self.algorithm: str = algorithm
+        self.enabled: bool = algorithm != 'none'
+        self.suffix: str = SUFFIXES.get(algorithm, '')
+        self.threads: int = threads or os.cpu_count() or 1
+        self.compress_block: Callable[[bytes], bytes] | None = None
+        self.executor: ThreadPoolExecutor | None = None
+        if self.enabled:
+            self.compress_block = BLOCK_COMPRESSORS[algorithm](level)
+            self.executor = ThreadPoolExecutor(max_workers=self.threads,
+                                               thread_name_prefix='compress')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *e):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def wrap(self, f: BinaryIO) -> BinaryIO | CompressedWriter:
+        """
+        Compresses everything written to a file object.
+
+        Args:
+            f: File object opened for binary writing.
+
+        Returns:
+            Writable file object that closes f when closed. f itself if the
+            compressor is disabled.
+        """
+        if not self.enabled:
+            return f
+        return CompressedWriter(self, f)
+
+    def open(self, dst: Path) -> BinaryIO | CompressedWriter:
+        """
+        Opens a file for compressed writing.
+
+        Args:
+            dst: Path of the file without compression suffix.
+
+        Returns:
+            Writable file object. dst is written with self.suffix appended.
+        """
+        return self.wrap(self.compressed_path(dst).open('wb'))
+
+    def compressed_path(self, dst: Path | str) -> Path:
+        return Path(os.fspath(dst) + self.suffix)
+
+    def should_compress(self, src: Path | str) -> bool:
+        """
+        Checks if a file compresses well, by compressing its first bytes.
+
+        Args:
+            src: Path of the file.
+
+        Returns:
+            Whether the file is worth compressing.
+        """
+        with open(src, 'rb') as f:
+            sample = f.read(SAMPLE_SIZE)
+        if not sample:
+            return False
+        compressed = zlib.compress(sample, 1)
+        return len(compressed) <= len(sample) * MAX_SAMPLE_RATIO
+
+    def compress_file(self, src: Path | str, dst: Path | str,
+                      throttle: Throttle | None = None, hasher=None,
+                      tee: Callable[[Path], list[TeeTarget]] | None = None
+                      ) -> Path:
+        """
+        Compresses a file and copies its metadata.
+
+        Args:
+            src: Source file.
+            dst: Destination without compression suffix.
+            throttle: If set, every block read waits for the throttle.
+            hasher: If set, the uncompressed contents are added to this hash
+                object.
+            tee: If set, called with the path of the written file. The
+                compressed contents are also written to the files it returns.
+
+        Returns:
+            Path of the written file.
+        """
+        compressed_path = self.compressed_path(dst)
+        f = compressed_path.open('wb')
+        if tee is not None:
+            f = TeeWriter(f, tee(compressed_path))
+        with open(src, 'rb') as fsrc, self.wrap(f) as writer:
+            while block := fsrc.read(BLOCK_SIZE):
+                if throttle is not None:
+                    throttle.consume(len(block))
+                if hasher is not None:
+                    hasher.update(block)
+                writer.write(block)
+        shutil.copystat(src, compressed_path)
+        return compressed_path
+
+
+def open_decompressed(path: Path) -> BinaryIO:
+    """
+    Opens a backed up file for reading, decompressing it if needed.
+
+    Args:
+        path: Path of the file, including its compression suffix if any.
+
+    Returns:
+        Readable binary file object with the original contents.
+    """
+    if path.suffix == SUFFIXES['gzip']:
+        import gzip
+        return gzip.open(path, 'rb')
+    if path.suffix == SUFFIXES['zstd']:
+        import zstandard
+        # The stream reader cannot be iterated over by line on its own.
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(
+            path.open('rb'), read_across_frames=True, closefd=True))
+    return path.open('rb')
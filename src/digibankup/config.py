@@ -43,7 +43,11 @@ default_config_dict = {
     'paths': {
         'backups': '/mnt/nasbackup/test/backups',
         'info': '/mnt/nasbackup/test/info.dat',
+        'file_index': '/mnt/nasbackup/test/index.sqlite',
+        'history': '/mnt/nasbackup/test/history.jsonl',
+        'prometheus_textfile': '',
         'log': '/mnt/nasbackup/test/backup.log',
+        'event_log': '',
         'fogsettings': '/opt/fog/.fogsettings',
         'fog_snapins': '/opt/fog/snapins'
     },
@@ -62,11 +66,50 @@ default_config_dict = {
     },
     'settings': {
         'backup_count': '16',
+        'keep_daily': '0',
+        'keep_weekly': '0',
+        'keep_monthly': '0',
+        'max_backups_gb': '0',
+        'min_free_percent': '0',
         'timezone': 'Europe/Brussels',
         'backup_interval': '7',
+        'full_scan_interval': '28',
+        'daemon_retry_interval': '60',
         'logging_min_filesize': '8388608',
+        'log_level': 'INFO',
+        'event_batch_size': '1000',
+        'copy_workers': '8',
+        'max_source_tasks': '1',
+        'max_destination_tasks': '2',
+        'max_http_tasks': '1',
+        'compression': 'none',
+        'compression_level': '3',
+        'compression_threads': '0',
+        'checksum': 'blake2b',
+        'max_read_mbps': '0',
+        'max_iops': '0',
+        'throttle_schedule': '',
+        'idle_priority': 'True',
+        'prune': 'background',
+        'prune_workers': '16',
         'log': 'True',
-        'check_date': 'False'
+        'check_date': 'False',
+        'incremental': 'True',
+        'pack_threshold': '0',
+        'pack_size': '67108864',
+        'fog_images_storage': 'copy',
+        'fog_images_selection': 'catalog',
+        'chunk_min_size': '262144',
+        'chunk_max_size': '8388608',
+        'http_connect_timeout': '30',
+        'http_read_timeout': '900',
+        'http_retries': '3',
+        'http_backoff': '5',
+        'fog_db_min_size': '1024',
+        'fog_db_trailer': '',
+        'fog_db_storage': 'full',
+        'fog_db_import_path': ('management/index.php'
+                               '?node=about&sub=maintenance'),
     },
     'perform': {
         'snipeit': 'False',
@@ -80,7 +123,14 @@ default_config_dict = {
     },
     'snipe_it': {
         'api_endpoint': 'https://inventaris.digibankmechelen.be/api/v1/',
-        'api_token': ('something')
+        'api_token': ('something'),
+        'resources': ('hardware, users, licenses, accessories, consumables, '
+                      'components, kits, categories, manufacturers, models, '
+                      'suppliers, locations, departments, companies, '
+                      'statuslabels, fieldsets, fields, depreciations'),
+        'page_size': '500',
+        'workers': '4',
+        'incremental': 'True',
     }
 }
 
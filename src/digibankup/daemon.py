@@ -0,0 +1,108 @@
+"""
+Keeps digibankup running between backups, watching the FOG trees.
+
+Every backup_interval days a backup is performed. While waiting, the watcher
+records which directories of the images, snapins and reports change, so the
+next backup only compares the files in those directories. Every
+full_scan_interval days, a backup compares every file regardless.
+"""
+
+import signal
+from configparser import ConfigParser
+from logging import getLogger
+from pathlib import Path
+from threading import Event
+from time import monotonic
+
+import digibankup.backup as backup
+import digibankup.backupsinfo as backupsinfo
+import digibankup.fog as fog
+import digibankup.snapshots as snapshots
+from digibankup.config import Backupflags
+from digibankup.watcher import Watcher
+
+logger = getLogger(__name__)
+
+# Time between checks whether a backup is due, in seconds.
+POLL_INTERVAL = 60
+
+
+def watched_roots(config: ConfigParser,
+                  backupflags: Backupflags) -> list[Path]:
+    """
+    Determines the trees to watch.
+
+    Args:
+        config: Contains configuration settings for the backup.
+        backupflags: Contains flags indicating which backups to perform.
+
+    Returns:
+        The images, snapins and reports folders that are backed up and
+        exist.
+    """
+    if not (backupflags.fog_images or backupflags.fog_snapins
+            or backupflags.fog_reports):
+        return []
+    fogsettings = fog.get_fogsettings(config)
+    roots = []
+    if backupflags.fog_images:
+        roots.append(Path(fogsettings['storageLocation']))
+    if backupflags.fog_snapins:
+        roots.append(Path(config['paths']['fog_snapins']))
+    if backupflags.fog_reports:
+        roots.append(fog.get_webdirdest(fogsettings) / 'lib/reports')
+    return [root for root in roots if root.is_dir()]
+
+
+def run(config: ConfigParser, backupflags: Backupflags,
+        backup_path: Path) -> None:
+    """
+    Performs backups whenever they are due, until SIGTERM or SIGINT.
+
+    Args:
+        config: Contains configuration settings for the backup.
+        backupflags: Contains flags indicating which backups to perform.
+        backup_path: Root destination path of the backups.
+    """
+    backups_path = Path(config['paths']['backups'])
+    full_scan_interval = int(config['settings']['full_scan_interval']) * 86400
+    retry_interval = int(config['settings']['daemon_retry_interval']) * 60
+
+    stopping = Event()
+
+    def stop(signum, frame):
+        logger.info(f"Received signal {signum}. Stopping.")
+        stopping.set()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    last_full_scan = None
+    with Watcher(watched_roots(config, backupflags)) as watcher:
+        watcher.start()
+        while not stopping.is_set():
+            backups_info = backupsinfo.get_backups_info(config)
+            if backupsinfo.performed_recent_backup(config, backups_info):
+                stopping.wait(POLL_INTERVAL)
+                continue
+
+            changes = watcher.take()
+            full_scan = (last_full_scan is None
+                         or monotonic() - last_full_scan >= full_scan_interval)
+            if full_scan:
+                logger.info("Performing backup comparing every file.")
+            logger.info(f"Initializing backup process at {backup_path}.")
+
+            snapshot = None
+            try:
+                backup.backup(config, backup_path, backups_info, backupflags,
+                              None if full_scan else changes)
+                snapshot = snapshots.read_index(backups_path)[0]
+                if full_scan:
+                    last_full_scan = monotonic()
+            except Exception as e:
+                logger.error(f"Backup failed. Retrying in "
+                             f"{retry_interval // 60} minutes.", exc_info=e)
+                stopping.wait(retry_interval)
+            finally:
+                watcher.finish(changes, snapshot)
+    logger.info("Daemon stopped.")
@@ -0,0 +1,441 @@
+"""
+Stores older FOG SQL dumps as line-level deltas against newer ones.
+
+The newest snapshot keeps its dump in full. When a snapshot is promoted, the
+dump of the snapshot before it is replaced by a delta against the new one.
+Successive dumps mostly differ in log and history tables, so the deltas are
+small. Any generation is rebuilt by applying the deltas from the newest full
+dump back to it.
+
+A delta is a gzip stream. Its first line is a JSON header naming the base
+snapshot and the checksums of the base and of the rebuilt dump. The header is
+followed by operations: 'C start count' copies lines of the base, and
+'I length' inserts the length bytes that follow.
+
+Dumps are streamed rather than held in memory. The base is indexed by the
+offset and a hash of each of its lines, the target is matched against it
+line by line, and deltas are written and applied incrementally. Dumps that
+are compressed or stored as deltas are first unpacked into a temporary file
+next to them, so lines of the base can be read back with a seek.
+"""
+
+import gzip
+import hashlib
+import json
+import shutil
+import tempfile
+from array import array
+from logging import getLogger
+from pathlib import Path
+from typing import BinaryIO, Callable, Iterator
+
+from digibankup.compression import SUFFIXES, open_decompressed
+from digibankup.manifest import read_manifest, write_manifest
+import digibankup.snapshots as snapshots
+
+logger = getLogger(__name__)
+
+DELTA_SUFFIX = '.delta'
+FORMAT = 'digibankup-delta-1'
+# Size in bytes of the blocks in which dumps are copied, and above which
+# inserted lines are written as a new operation.
+BLOCK_SIZE = 1024 * 1024
+
+
+def new_digest():
+    return hashlib.blake2b(digest_size=32)
+
+
+def file_digest(f: BinaryIO) -> tuple[str, int]:
+    """Computes the checksum and size of a file from its position on."""
+    hasher = new_digest()
+    size = 0
+    while block := f.read(BLOCK_SIZE):
+        hasher.update(block)
+        size += len(block)
+    return hasher.hexdigest(), size
+
+
+class LineIndex():
+    """
+    Offsets of the lines of a seekable dump, and where each line first
+    occurs by its hash. Only the hashes and offsets are kept in memory, not
+    the lines themselves.
+    """
+    def __init__(self, f: BinaryIO, positions: bool = True):
+        """
+        Reads the dump from its start.
+
+        Args:
+            f: The dump, opened for binary reading.
+            positions: Whether to index the lines by their hash, which is
+                only needed for encoding.
+        """
+        self.f: BinaryIO = f
+        self.offsets: array = array('Q')
+        self.positions: dict[int, int] = {}
+        hasher = new_digest()
+        offset = 0
+        f.seek(0)
+        for line in f:
+            if positions:
+                self.positions.setdefault(hash(line), len(self.offsets))
+            self.offsets.append(offset)
+            hasher.update(line)
+            offset += len(line)
+        self.offsets.append(offset)
+        self.digest: str = hasher.hexdigest()
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def find(self, line: bytes) -> int | None:
+        """Finds the first occurrence of a line, seeking right after it."""
+        position = self.positions.get(hash(line))
+        if position is None:
+            return None
+        self.f.seek(self.offsets[position])
+        if self.f.readline() != line:
+            return None
+        return position
+
+    def copy(self, start: int, count: int,
+             write: Callable[[bytes], object]) -> None:
+        """Passes count lines from line start on to write, in blocks."""
+        self.f.seek(self.offsets[start])
+        remaining = self.offsets[start + count] - self.offsets[start]
+        while remaining > 0:
+            block = self.f.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                raise ValueError(f"Lines {start} to {start + count} are "
+                                 f"beyond the end of the base.")
+            write(block)
+            remaining -= len(block)
+
+
+def encode(base: LineIndex, target: BinaryIO) -> Iterator[tuple]:
+    """
+    Encodes a dump as operations on the lines of a base dump.
+
+    Unchanged runs of lines are found by the hashes of the base lines, and
+    continued by reading the base along with the target, so encoding takes
+    linear time and reads both dumps once, apart from a seek at the start of
+    every run.
+
+    Args:
+        base: Index of the newer dump the delta refers to.
+        target: Dump to encode, read from its position on.
+
+    Yields:
+        ('C', start, count) and ('I', data) operations. Inserted data is
+        split after BLOCK_SIZE bytes.
+    """
+    run_start = run_end = -1
+    literal = bytearray()
+
+    for line in target:
+        if (0 <= run_end < len(base)
+                and base.f.readline() == line):
+            run_end += 1
+            continue
+        if run_end > run_start:
+            yield ('C', run_start, run_end - run_start)
+        run_start = run_end = -1
+        position = base.find(line)
+        if position is None:
+            literal += line
+            if len(literal) >= BLOCK_SIZE:
+                yield ('I', bytes(literal))
+                literal = bytearray()
+            continue
+        if literal:
+            yield ('I', bytes(literal))
+            literal = bytearray()
+        run_start, run_end = position, position + 1
+    if run_end > run_start:
+        yield ('C', run_start, run_end - run_start)
+    if literal:
+        yield ('I', bytes(literal))
+
+
+def write_delta(path: Path, base_name: str, base: BinaryIO,
+                target: BinaryIO) -> int:
+    """
+    Writes a delta file.
+
+    Args:
+        path: Path of the delta file.
+        base_name: Name of the snapshot holding the base dump.
+        base: Newer dump the delta refers to, opened for binary reading.
+            Must be seekable.
+        target: Dump to encode, opened for binary reading. Must be seekable.
+
+    Returns:
+        Size of the target dump.
+    """
+    index = LineIndex(base)
+    target.seek(0)
+    target_digest, size = file_digest(target)
+    target.seek(0)
+    header = {'format': FORMAT, 'base': base_name,
+              'base_digest': index.digest, 'digest': target_digest,
+              'size': size}
+    tmp_path = path.with_name(path.name + '.tmp')
+    with gzip.open(tmp_path, 'wb') as f:
+        f.write(json.dumps(header).encode() + b'\n')
+        for operation in encode(index, target):
+            if operation[0] == 'C':
+                f.write(f"C {operation[1]} {operation[2]}\n".encode())
+            else:
+                f.write(f"I {len(operation[1])}\n".encode())
+                f.write(operation[1])
+    tmp_path.replace(path)
+    return size
+
+
+def read_header(path: Path) -> dict:
+    with gzip.open(path, 'rb') as f:
+        return json.loads(f.readline())
+
+
+def apply(path: Path, base: BinaryIO, dst: BinaryIO) -> None:
+    """
+    Rebuilds a dump from its delta and base.
+
+    Args:
+        path: Path of the delta file.
+        base: The base dump, opened for binary reading. Must be seekable.
+        dst: File to write the rebuilt dump to.
+
+    Raises:
+        ValueError: Raised when the base or the rebuilt dump does not match
+            the checksums in the header.
+    """
+    index = LineIndex(base, positions=False)
+    hasher = new_digest()
+
+    def write(data: bytes) -> None:
+        hasher.update(data)
+        dst.write(data)
+
+    with gzip.open(path, 'rb') as f:
+        header = json.loads(f.readline())
+        if header['base_digest'] != index.digest:
+            raise ValueError(f"Base of delta {path} has changed.")
+        while line := f.readline():
+            kind, *arguments = line.split()
+            if kind == b'C':
+                start, count = map(int, arguments)
+                index.copy(start, count, write)
+                continue
+            remaining = int(arguments[0])
+            while remaining > 0:
+                block = f.read(min(BLOCK_SIZE, remaining))
+                if not block:
+                    raise ValueError(f"Delta {path} is cut off.")
+                write(block)
+                remaining -= len(block)
+    if header['digest'] != hasher.hexdigest():
+        raise ValueError(f"Rebuilt dump of delta {path} is corrupt.")
+
+
+def find_dump(snapshot: Path, subpath: str) -> Path | None:
+    """
+    Finds the dump of a snapshot.
+
+    Args:
+        snapshot: Root path of the snapshot.
+        subpath: subpaths.fog_db.
+
+    Returns:
+        Path of the full dump, with its compression suffix if any, or of the
+        delta. None if the snapshot has no dump.
+    """
+    dump = snapshot / subpath
+    for suffix in ('', *SUFFIXES.values(), DELTA_SUFFIX):
+        path = dump.with_name(dump.name + suffix)
+        if path.is_file():
+            return path
+    return None
+
+
+def is_delta(path: Path) -> bool:
+    return path.name.endswith(DELTA_SUFFIX)
+
+
+def unpacked_file(path: Path) -> BinaryIO:
+    """Creates a temporary file next to a dump, removed once closed."""
+    return tempfile.TemporaryFile(dir=path.parent, prefix='.dbdelta-')
+
+
+def open_dump(snapshot: Path, subpath: str) -> BinaryIO:
+    """
+    Opens the dump of a snapshot, rebuilding it from deltas if needed.
+
+    Args:
+        snapshot: Root path of the snapshot, in the snapshots directory.
+        subpath: subpaths.fog_db.
+
+    Returns:
+        The full dump, opened for binary reading at its start. Seekable.
+        Dumps that are compressed or stored as deltas are unpacked into a
+        temporary file.
+
+    Raises:
+        FileNotFoundError: Raised when the snapshot, or a snapshot the chain
+            of deltas refers to, has no dump.
+        ValueError: Raised when a delta does not match its base.
+    """
+    chain = []
+    path = find_dump(snapshot, subpath)
+    while path is not None and is_delta(path):
+        chain.append(path)
+        path = find_dump(snapshot.parent / read_header(path)['base'],
+                         subpath)
+    if path is None:
+        raise FileNotFoundError(f"No dump of {snapshot / subpath} to "
+                                f"rebuild from.")
+
+    if path.suffix in SUFFIXES.values():
+        dump = unpacked_file(path)
+        try:
+            with open_decompressed(path) as f:
+                shutil.copyfileobj(f, dump, BLOCK_SIZE)
+        except BaseException:
+            dump.close()
+            raise
+    else:
+        dump = path.open('rb')
+    for delta in reversed(chain):
+        try:
+            rebuilt = unpacked_file(delta)
+            try:
+                apply(delta, dump, rebuilt)
+            except BaseException:
+                rebuilt.close()
+                raise
+        finally:
+            dump.close()
+        dump = rebuilt
+    dump.seek(0)
+    return dump
+
+
+def restore_dump(snapshot: Path, subpath: str, dst: Path) -> None:
+    """
+    Writes the full dump of a snapshot to a file.
+
+    Args:
+        snapshot: Root path of the snapshot, in the snapshots directory.
+        subpath: subpaths.fog_db.
+        dst: Path to write the dump to.
+    """
+    with open_dump(snapshot, subpath) as f, dst.open('wb') as fdst:
+        shutil.copyfileobj(f, fdst, BLOCK_SIZE)
+
+
+def move_manifest_entry(snapshot: Path, old_path: Path,
+                        new_path: Path) -> None:
+    """Moves the manifest entry of the dump of a snapshot to another path."""
+    entries = read_manifest(snapshot)
+    old_key = old_path.relative_to(snapshot).as_posix()
+    if old_key not in entries or old_path == new_path:
+        return
+    entry = entries.pop(old_key)
+    entry['path'] = new_path.relative_to(snapshot).as_posix()
+    entries[entry['path']] = entry
+    write_manifest(snapshot, entries)
+
+
+def store_delta(snapshot: Path, subpath: str, base_snapshot: Path,
+                base: BinaryIO) -> None:
+    """
+    Replaces the dump of a snapshot by a delta against a newer snapshot.
+
+    The manifest entry of the dump moves to the delta, keeping the size and
+    checksum of the full dump.
+
+    Args:
+        snapshot: Root path of the snapshot whose dump is replaced.
+        subpath: subpaths.fog_db.
+        base_snapshot: Root path of the newer snapshot.
+        base: Dump of base_snapshot, see open_dump.
+    """
+    path = find_dump(snapshot, subpath)
+    delta_path = (snapshot / subpath).with_name(
+        Path(subpath).name + DELTA_SUFFIX)
+    with open_dump(snapshot, subpath) as target:
+        size = write_delta(delta_path, base_snapshot.name, base, target)
+    if path != delta_path:
+        path.unlink()
+
+    move_manifest_entry(snapshot, path, delta_path)
+    logger.info(f"Stored {path} as a delta against {base_snapshot.name}. "
+                f"{size} bytes in {delta_path.stat().st_size} bytes.")
+
+
+def encode_previous(backups_path: Path, subpath: str) -> None:
+    """
+    Replaces the full dump of the second newest snapshot by a delta against
+    the newest one. Call after promoting a snapshot.
+
+    Args:
+        backups_path: Directory containing the backups.
+        subpath: subpaths.fog_db.
+    """
+    paths = snapshots.snapshot_paths(backups_path)
+    if len(paths) < 2:
+        return
+    newest, previous = paths[0], paths[1]
+    newest_dump = find_dump(newest, subpath)
+    previous_dump = find_dump(previous, subpath)
+    if (newest_dump is None or is_delta(newest_dump)
+            or previous_dump is None or is_delta(previous_dump)):
+        return
+    with open_dump(newest, subpath) as base:
+        store_delta(previous, subpath, newest, base)
+
+
+def rebase(backups_path: Path, subpath: str, expiring: list[str]) -> None:
+    """
+    Re-encodes the deltas that refer to snapshots about to expire. Call
+    before expiring them.
+
+    A delta whose base expires is encoded against the nearest newer
+    snapshot that is kept and has a dump, or stored in full if there is
+    none.
+
+    Args:
+        backups_path: Directory containing the backups.
+        subpath: subpaths.fog_db.
+        expiring: Names of the snapshots about to expire.
+    """
+    paths = snapshots.snapshot_paths(backups_path)
+    for i, snapshot in enumerate(paths):
+        if snapshot.name in expiring:
+            continue
+        path = find_dump(snapshot, subpath)
+        if (path is None or not is_delta(path)
+                or read_header(path)['base'] not in expiring):
+            continue
+
+        base_snapshot = None
+        for newer in reversed(paths[:i]):
+            if (newer.name not in expiring
+                    and find_dump(newer, subpath) is not None):
+                base_snapshot = newer
+                break
+        if base_snapshot is not None:
+            with open_dump(base_snapshot, subpath) as base:
+                store_delta(snapshot, subpath, base_snapshot, base)
+        else:
+            full_path = snapshot / subpath
+            tmp_path = full_path.with_name(full_path.name + '.tmp')
+            with (open_dump(snapshot, subpath) as dump,
+                  tmp_path.open('wb') as f):
+                shutil.copyfileobj(dump, f, BLOCK_SIZE)
+            tmp_path.replace(full_path)
+            path.unlink()
+            move_manifest_entry(snapshot, path, full_path)
+            logger.info(f"Stored dump of {snapshot.name} in full, because "
+                        f"its base expires.")
@@ -0,0 +1,361 @@
+"""
+Writes every backup to extra destinations besides paths.backups.
+
+Every [destination:<name>] section of the configuration adds a destination
+with its own rotation. A local destination is a backups directory like
+paths.backups, an s3 destination a bucket, see s3. Files copied from the FOG
+server are read once, and written to paths.backups and to every destination
+at the same time with transfer.TeeWriter. Once the backup is complete, every
+destination is completed from it: a local destination hard links unchanged
+files from its previous backup, and copies the rest, such as the database
+export and the manifests, from paths.backups. A destination that fails is
+left behind without stopping the others.
+"""
+
+import os
+import shutil
+from configparser import ConfigParser, SectionProxy
+from logging import getLogger
+from pathlib import Path
+from threading import Lock, Thread
+from typing import BinaryIO, Callable
+from zoneinfo import ZoneInfo
+
+import digibankup.chunkstore as chunkstore
+import digibankup.snapshots as snapshots
+from digibankup.metrics import PhaseMetrics, RunMetrics
+from digibankup.transfer import TeeTarget, copy_file, copy_tree
+from digibankup.util import rmtree, str_to_bool
+
+logger = getLogger(__name__)
+
+SECTION_PREFIX = 'destination:'
+# Keys of a local destination section, and the section of the configuration
+# each of them overrides for the destination.
+OVERRIDES = {
+    'backups': 'paths',
+    'backup_count': 'settings',
+    'keep_daily': 'settings',
+    'keep_weekly': 'settings',
+    'keep_monthly': 'settings',
+    'max_backups_gb': 'settings',
+    'min_free_percent': 'settings',
+    'prune': 'settings',
+    'fog_db_storage': 'settings',
+}
+
+
+class Destination():
+    """
+    Place that receives a copy of every backup, besides paths.backups.
+
+    Subclasses store the copies: LocalDestination in a directory, and
+    s3.S3Destination in a bucket.
+    """
+    def __init__(self, name: str, config: ConfigParser,
+                 stats: PhaseMetrics | None = None):
+        """
+        Args:
+            name: Name of the destination, following destination: in the
+                name of its section.
+            config: Contains configuration settings for the backup.
+            stats: If set, the files of the destination are counted in it.
+        """
+        self.name: str = name
+        self.section: SectionProxy = config[SECTION_PREFIX + name]
+        self.source_config: ConfigParser = config
+        self.source_root: Path | None = None
+        self.stats: PhaseMetrics = stats or PhaseMetrics()
+        self.error: Exception | None = None
+        self.lock: Lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *e):
+        self.close()
+
+    @property
+    def failed(self) -> bool:
+        return self.error is not None
+
+    def fail(self, error: Exception) -> None:
+        """Gives up on the destination for the rest of the backup."""
+        with self.lock:
+            if self.error is not None:
+                return
+            self.error = error
+        self.stats.success = False
+        logger.error(f"Backup to destination {self.name} failed. "
+                     f"Continuing without it.", exc_info=error)
+
+    def prepare(self, source_root: Path) -> None:
+        """
+        Readies the destination for a backup.
+
+        Args:
+            source_root: Root path of the ongoing backup in paths.backups.
+        """
+        raise NotImplementedError
+
+    def open(self, path: Path) -> BinaryIO | None:
+        """
+        Opens a file of the destination for writing.
+
+        Args:
+            path: Path of the same file in the ongoing backup.
+
+        Returns:
+            File object opened for binary writing, or None if the
+            destination failed or does not take the file while copying.
+        """
+        raise NotImplementedError
+
+    def complete(self) -> None:
+        """
+        Completes the destination from the finished backup in paths.backups.
+        """
+        raise NotImplementedError
+
+    def rotate(self, backups_info: dict) -> str:
+        """
+        Turns the completed backup into a snapshot and expires old ones.
+
+        Args:
+            backups_info: Dict containing date of last backup.
+
+        Returns:
+            Where the snapshot is stored.
+        """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Releases the resources of the destination."""
+
+
+class LocalDestination(Destination):
+    """Backups directory that receives a copy of every backup."""
+    def __init__(self, name: str, config: ConfigParser,
+                 stats: PhaseMetrics | None = None):
+        """
+        Args:
+            name: Name of the destination.
+            config: Contains configuration settings for the backup.
+            stats: If set, the files of the destination are counted in it.
+
+        Raises:
+            ValueError: Raised when the section has no backups key, or a key
+                that cannot differ between destinations.
+        """
+        super().__init__(name, config, stats)
+        if 'backups' not in self.section:
+            raise ValueError(f"Destination {name} has no backups directory.")
+        self.config: ConfigParser = ConfigParser()
+        self.config.read_dict(
+            {section_name: dict(config.items(section_name, raw=True))
+             for section_name in config.sections()})
+        for key, value in self.section.items():
+            if key == 'type':
+                continue
+            if key not in OVERRIDES:
+                raise ValueError(f"Unknown key {key} for destination {name}. "
+                                 f"Choose from type, "
+                                 f"{', '.join(OVERRIDES)}.")
+            self.config[OVERRIDES[key]][key] = value
+        self.backups_path: Path = Path(self.config['paths']['backups'])
+        self.backup_path: Path = self.backups_path / '0'
+        self.previous_path: Path | None = None
+        self.trash_thread: Thread | None = None
+
+    def prepare(self, source_root: Path) -> None:
+        """
+        Readies the destination for a backup.
+
+        An interrupted backup in the destination is removed, because it is
+        not known which of its files are complete.
+
+        Args:
+            source_root: Root path of the ongoing backup in paths.backups.
+        """
+        self.source_root = source_root
+        settings = self.config['settings']
+        workers = int(settings['prune_workers'])
+        try:
+            self.backups_path.mkdir(parents=True, exist_ok=True)
+            self.trash_thread = snapshots.start_emptying_trash(
+                self.backups_path, workers)
+            if self.backup_path.is_dir():
+                logger.warning(f"Directory {self.backup_path} exists. "
+                               f"Recursively removing directory.")
+                rmtree(self.backup_path, workers)
+            self.backup_path.mkdir()
+            if str_to_bool(settings['incremental']):
+                snapshots.migrate(self.backups_path,
+                                  ZoneInfo(settings['timezone']))
+                self.previous_path = snapshots.snapshot_path(
+                    self.backups_path, 1)
+        except OSError as e:
+            self.fail(e)
+
+    def path_of(self, path: Path) -> Path:
+        """Maps a path in the ongoing backup to the same path here."""
+        return self.backup_path / Path(path).relative_to(self.source_root)
+
+    def open(self, path: Path) -> BinaryIO | None:
+        if self.failed:
+            return None
+        dst = self.path_of(path)
+        try:
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            return dst.open('wb')
+        except OSError as e:
+            self.fail(e)
+            return None
+
+    def complete_file(self, src, dst, *, follow_symlinks=True, entry=None):
+        """
+        Completes a file of the destination from the ongoing backup.
+
+        Files that were written while copying from the FOG server only get
+        their metadata. Other files are hard linked from the previous backup
+        of the destination if they have the same size and modification time
+        there, and copied otherwise. Drop-in replacement for shutil.copy2,
+        that reuses the stat results of entry if it is set.
+        """
+        if self.failed:
+            return dst
+        if entry is None:
+            src_stat = os.lstat(src)
+        else:
+            src_stat = entry.stat(follow_symlinks=False)
+        if os.path.lexists(dst):
+            shutil.copystat(src, dst, follow_symlinks=False)
+            self.stats.add_file(0, src_stat.st_size)
+            return dst
+
+        if self.previous_path is not None:
+            previous = self.previous_path / os.path.relpath(src,
+                                                            self.source_root)
+            try:
+                previous_stat = os.lstat(previous)
+                if (previous_stat.st_size == src_stat.st_size
+                        and previous_stat.st_mtime_ns == src_stat.st_mtime_ns
+                        and not os.path.islink(previous)):
+                    os.link(previous, dst)
+                    self.stats.add_file(linked=True)
+                    return dst
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Could not hard link {previous} to {dst}. "
+                               f"Copying instead.", exc_info=e)
+
+        copy_file(src, dst, follow_symlinks=False)
+        self.stats.add_file(src_stat.st_size, src_stat.st_size)
+        return dst
+
+    def complete_chunks(self) -> None:
+        """Copies the chunks of the images the destination lacks."""
+        subpath = self.config['subpaths']['fog_images']
+        referenced = chunkstore.referenced_chunks([self.source_root],
+                                                  subpath)
+        if not referenced:
+            return
+        source = chunkstore.ChunkStore.from_config(self.source_config)
+        store = chunkstore.ChunkStore.from_config(self.config)
+        missing = referenced.difference(store.index)
+        try:
+            for digest in missing:
+                path = store.chunk_path(digest)
+                path.parent.mkdir(exist_ok=True)
+                copy_file(source.chunk_path(digest), path)
+                store.index[digest] = path.stat().st_size
+                self.stats.add_file(store.index[digest],
+                                    store.index[digest])
+        finally:
+            store.write_index()
+        logger.info(f"Copied {len(missing)} chunks to destination "
+                    f"{self.name}.")
+
+    def complete(self) -> None:
+        if self.failed:
+            return
+        logger.info(f"== Completing backup at destination {self.name}. ==")
+        errors = copy_tree(self.source_root, self.backup_path,
+                           self.complete_file,
+                           int(self.config['settings']['copy_workers']))
+        for src, dst, reason in errors:
+            logger.error(f"Could not complete {dst} from {src}: {reason}")
+        if errors:
+            self.fail(OSError(f"Could not complete {len(errors)} files at "
+                              f"{self.backup_path}."))
+            return
+        try:
+            self.complete_chunks()
+        except OSError as e:
+            self.fail(e)
+
+    def rotate(self, backups_info: dict) -> str:
+        import digibankup.backup as backup
+        if self.trash_thread is not None:
+            self.trash_thread.join()
+        return os.fspath(backup.rotate_backups(self.config,
+                                               self.backup_path))
+
+
+def from_config(config: ConfigParser,
+                metrics: RunMetrics | None = None) -> list[Destination]:
+    """
+    Reads the extra destinations from the configuration.
+
+    Args:
+        config: Contains configuration settings for the backup.
+        metrics: If set, every destination counts its files in the phase
+            destination_<name>.
+
+    Returns:
+        Every destination, in the order of their sections.
+
+    Raises:
+        ValueError: Raised when a destination section is invalid.
+    """
+    destinations = []
+    for section in config.sections():
+        if not section.startswith(SECTION_PREFIX):
+            continue
+        name = section[len(SECTION_PREFIX):]
+        stats = None
+        if metrics is not None:
+            stats = metrics.phase(f'destination_{name}')
+        kind = config[section].get('type', 'local')
+        if kind == 'local':
+            destinations.append(LocalDestination(name, config, stats))
+        elif kind == 's3':
+            from digibankup.s3 import S3Destination
+            destinations.append(S3Destination(name, config, stats))
+        else:
+            raise ValueError(f"Unknown type {kind} of destination {name}. "
+                             f"Choose from local, s3.")
+    return destinations
+
+
+def tee_function(destinations: list[Destination]
+                 ) -> Callable[[Path], list[TeeTarget]]:
+    """
+    Prepares a tee function for transfer.copy_file.
+
+    Args:
+        destinations: Destinations to write every copied file to.
+
+    Returns:
+        Function that opens a file of the ongoing backup at every
+        destination that has not failed.
+    """
+    def tee(path: Path) -> list[TeeTarget]:
+        targets = []
+        for destination in destinations:
+            f = destination.open(path)
+            if f is not None:
+                targets.append(TeeTarget(f, destination.fail))
+        return targets
+    return tee
@@ -0,0 +1,82 @@
+"""
+Records every file transfer as a machine-readable event.
+
+Every event is one JSON line in paths.event_log, with the time, file, bytes,
+duration in seconds and result of the transfer. Events are sent to their own
+logger, which does not propagate to the human log, so settings.log_level
+does not affect them. configure_events hands them to a background thread,
+which writes them in batches of settings.event_batch_size, or at least every
+FLUSH_INTERVAL seconds. Without an event log, recording an event costs
+nothing but a check.
+"""
+
+import json
+from logging import INFO, LogRecord, getLogger
+from logging.handlers import BufferingHandler
+from time import monotonic
+
+EVENT_LOGGER = 'digibankup.events'
+# Seconds after which a batch is written even if it is not full.
+FLUSH_INTERVAL = 5
+
+logger = getLogger(EVENT_LOGGER)
+logger.propagate = False
+logger.setLevel(INFO)
+
+
+def record(file: str, size: int | None, duration: float,
+           result: str) -> None:
+    """
+    Records the transfer of a file.
+
+    Args:
+        file: Path of the source file.
+        size: Size of the source file in bytes, or None if it is unknown.
+        duration: Seconds spent on the file.
+        result: What happened to the file, such as copied, linked, resumed
+            or failed.
+    """
+    if not logger.handlers:
+        return
+    logger.info(result, extra={'event': {'file': file, 'bytes': size,
+                                         'duration': round(duration, 6),
+                                         'result': result}})
+
+
+class JsonlHandler(BufferingHandler):
+    """Appends events to a JSONL file in batches."""
+    def __init__(self, filename: str, capacity: int,
+                 interval: float = FLUSH_INTERVAL):
+        """
+        Args:
+            filename: Path of the JSONL file.
+            capacity: Amount of events written at once.
+            interval: Seconds after which a batch is written even if it is
+                not full.
+        """
+        super().__init__(capacity)
+        self.filename: str = filename
+        self.interval: float = interval
+        self.flushed: float = monotonic()
+
+    def shouldFlush(self, record: LogRecord) -> bool:
+        return (len(self.buffer) >= self.capacity
+                or monotonic() - self.flushed >= self.interval)
+
+    def flush(self) -> None:
+        self.acquire()
+        try:
+            if self.buffer:
+                lines = ''.join(
+                    json.dumps({'time': round(record.created, 3)}
+                               | record.event) + '\n'
+                    for record in self.buffer)
+                try:
+                    with open(self.filename, 'a') as f:
+                        f.write(lines)
+                except OSError:
+                    self.handleError(self.buffer[0])
+            self.buffer.clear()
+            self.flushed = monotonic()
+        finally:
+            self.release()
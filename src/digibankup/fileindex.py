@@ -0,0 +1,239 @@
+"""
+Remembers the metadata of every backed up file between runs.
+
+The index is a SQLite database next to paths.info, outside of the backups
+directory, so it survives rotation. It maps every file of the last completed
+backup to the inode, size, modification time and change time of its source.
+A source file that still matches its row is hard linked from the previous
+backup without looking at the previous backup at all. If the index is lost or
+does not belong to the previous backup, it is rebuilt from that backup's
+manifest.
+"""
+
+import os
+import sqlite3
+from configparser import ConfigParser
+from logging import getLogger
+from pathlib import Path
+from threading import Lock
+
+from digibankup.manifest import read_manifest
+from digibankup.compression import SUFFIXES
+
+logger = getLogger(__name__)
+
+BATCH_SIZE = 1000
+COLUMNS = ('path', 'stored', 'inode', 'size', 'mtime_ns', 'ctime_ns',
+           'digest')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    stored TEXT NOT NULL,
+    inode INTEGER,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    ctime_ns INTEGER,
+    digest TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class FileIndex():
+    """
+    Index of the files in the last completed backup.
+
+    Rows are keyed by the destination of a file relative to the root of the
+    backup, without compression suffix, like the journal. Rows rebuilt from a
+    manifest have no inode and change time, and only their size and
+    modification time are compared.
+    """
+    @classmethod
+    def from_config(cls, config: ConfigParser, backup_path: Path,
+                    previous_path: Path | None = None):
+        return cls(Path(config['paths']['file_index']), backup_path,
+                   previous_path)
+
+    def __init__(self, index_path: Path, backup_path: Path,
+                 previous_path: Path | None = None):
+        self.path: Path = index_path
+        self.root: Path = backup_path
+        self.previous_path: Path | None = previous_path
+        self.previous: dict[str, tuple] = {}
+        self.entries: dict[str, tuple] = {}
+        self.loaded: bool = False
+        self.lock: Lock = Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.previous)
+
+    def connect(self) -> sqlite3.Connection:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(self.path)
+        connection.executescript(SCHEMA)
+        return connection
+
+    def load(self) -> None:
+        """
+        Reads the rows of the previous backup in batches.
+
+        Rebuilds them from the manifest of the previous backup if the index
+        is missing, unreadable or was written for another backup.
+        """
+        if self.previous_path is None:
+            return
+        try:
+            connection = self.connect()
+            try:
+                row = connection.execute(
+                    "SELECT value FROM meta WHERE key = 'snapshot'"
+                ).fetchone()
+                if row is not None and row[0] == self.previous_path.name:
+                    cursor = connection.execute(
+                        f"SELECT {', '.join(COLUMNS)} FROM files")
+                    while rows := cursor.fetchmany(BATCH_SIZE):
+                        for row in rows:
+                            self.previous[row[0]] = row
+                    self.loaded = True
+            finally:
+                connection.close()
+        except sqlite3.Error as e:
+            logger.warning(f"Could not read index {self.path}.", exc_info=e)
+            self.previous = {}
+            self.loaded = False
+
+        if self.loaded:
+            logger.info(f"Loaded {len(self.previous)} files from index "
+                        f"{self.path}.")
+        else:
+            self.rebuild()
+
+    def rebuild(self) -> None:
+        """Fills the rows of the previous backup from its manifest."""
+        manifest = read_manifest(self.previous_path)
+        if not manifest:
+            logger.warning(f"Index {self.path} does not match "
+                           f"{self.previous_path}, which has no manifest to "
+                           f"rebuild it from. Comparing with the files of "
+                           f"the previous backup instead.")
+            return
+        for stored, entry in manifest.items():
+            row = (stored, stored, None, entry['size'], entry['mtime_ns'],
+                   None, entry['digest'])
+            self.previous.setdefault(stored, row)
+            for suffix in SUFFIXES.values():
+                if stored.endswith(suffix):
+                    path = stored[:-len(suffix)]
+                    self.previous.setdefault(path, (path,) + row[1:])
+        logger.warning(f"Index {self.path} does not match "
+                       f"{self.previous_path}. Rebuilt "
+                       f"{len(self.previous)} files from its manifest.")
+
+    def key(self, dst) -> str:
+        return os.path.relpath(dst, self.root)
+
+    def match(self, dst,
+              src_stat: os.stat_result) -> tuple[str, str | None] | None:
+        """
+        Looks up a file of the previous backup that matches its source.
+
+        Args:
+            dst: Destination of the file, without compression suffix.
+            src_stat: Result of stat on the source file.
+
+        Returns:
+            Relative path the file was stored at, with its suffix if any, and
+            its checksum, if the source has the same inode, size,
+            modification time and change time as in the previous backup.
+            None if the file is new or changed.
+        """
+        row = self.previous.get(self.key(dst))
+        if row is None:
+            return None
+        _, stored, inode, size, mtime_ns, ctime_ns, digest = row
+        if (size != src_stat.st_size or mtime_ns != src_stat.st_mtime_ns
+                or (inode is not None and inode != src_stat.st_ino)
+                or (ctime_ns is not None
+                    and ctime_ns != src_stat.st_ctime_ns)):
+            return None
+        return stored, digest
+
+    def previous_row(self, dst) -> tuple | None:
+        """Looks up a file of the previous backup by its destination."""
+        return self.previous.get(self.key(dst))
+
+    def keep(self, row: tuple) -> None:
+        """
+        Records a file of the ongoing backup that is known to be unchanged,
+        with the same row as in the previous backup.
+
+        Args:
+            row: Result of previous_row.
+        """
+        with self.lock:
+            self.entries[row[0]] = row
+
+    def record(self, dst, stored, src_stat: os.stat_result,
+               digest: str | None = None) -> None:
+        """
+        Records a file of the ongoing backup.
+
+        Args:
+            dst: Destination of the file, without compression suffix.
+            stored: Path the file was actually written to.
+            src_stat: Result of stat on the source file.
+            digest: Checksum of the file.
+        """
+        key = self.key(dst)
+        row = (key, self.key(stored), src_stat.st_ino, src_stat.st_size,
+               src_stat.st_mtime_ns, src_stat.st_ctime_ns, digest)
+        with self.lock:
+            self.entries[key] = row
+
+    def commit(self, snapshot: str) -> None:
+        """
+        Writes the changes since the previous backup to the index.
+
+        Only changed and deleted rows are written, in batches, in a single
+        transaction. An index that was not loaded from the database is
+        written in full.
+
+        Args:
+            snapshot: Name of the snapshot the ongoing backup was promoted
+                to.
+        """
+        changed = [row for key, row in self.entries.items()
+                   if not self.loaded or self.previous.get(key) != row]
+        deleted = [(key,) for key in self.previous
+                   if self.loaded and key not in self.entries]
+        try:
+            connection = self.connect()
+            with connection:
+                if not self.loaded:
+                    connection.execute("DELETE FROM files")
+                for i in range(0, len(deleted), BATCH_SIZE):
+                    connection.executemany(
+                        "DELETE FROM files WHERE path = ?",
+                        deleted[i:i + BATCH_SIZE])
+                for i in range(0, len(changed), BATCH_SIZE):
+                    connection.executemany(
+                        f"INSERT OR REPLACE INTO files ({', '.join(COLUMNS)}) "
+                        f"VALUES ({', '.join('?' * len(COLUMNS))})",
+                        changed[i:i + BATCH_SIZE])
+                connection.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) "
+                    "VALUES ('snapshot', ?)", (snapshot,))
+            connection.close()
+        except sqlite3.Error as e:
+            logger.error(f"Could not update index {self.path}. It will be "
+                         f"rebuilt from the manifest during the next "
+                         f"backup.", exc_info=e)
+            return
+        logger.info(f"Index {self.path} updated: {len(changed)} changed and "
+                    f"{len(deleted)} deleted files since the previous "
+                    f"backup.")
@@ -1,15 +1,34 @@
 """Backups the FOG Project server."""
 
-from os import fspath, stat
+from os import fspath, stat, lstat, link, stat_result
+from os.path import exists, dirname, relpath
+from stat import S_ISREG
 from logging import getLogger
 from pathlib import Path
-import shutil
 from configparser import ConfigParser
+from threading import Lock
+from time import perf_counter, sleep
 from typing import Callable
+from functools import partial
 
 import requests
 
-from digibankup.util import touch_parents, format_filesize
+import digibankup.chunkstore as chunkstore
+import digibankup.dbdelta as dbdelta
+import digibankup.events as events
+import digibankup.fogcatalog as fogcatalog
+import digibankup.packs as packs
+from digibankup.transfer import copy_tree, copy_file
+from digibankup.compression import Compressor
+from digibankup.throttle import Throttle
+from digibankup.journal import Journal
+from digibankup.manifest import Manifest, file_digest
+from digibankup.fileindex import FileIndex
+from digibankup.watcher import ChangeSet
+from digibankup.scheduler import Scheduler, Task, raise_failures
+from digibankup.metrics import RunMetrics, PhaseMetrics
+from digibankup.session import make_session, get_timeout, download
+from digibankup.util import format_filesize
 from digibankup.config import Backupflags
 
 logger = getLogger(__name__)
@@ -23,7 +42,8 @@ def init_paths(config: ConfigParser, backup_path: Path) -> None:
         config: Contains configuration settings for the backup.
         backup_path: Root destination path of the ongoing backup.
     """
-    touch_parents(backup_path / config['subpaths']['fog_db'])
+    (backup_path / config['subpaths']['fog_db']).parent.mkdir(parents=True,
+                                                              exist_ok=True)
     (backup_path / config['subpaths']['fog_images']).mkdir(parents=True,
                                                            exist_ok=True)
     (backup_path / config['subpaths']['fog_snapins']).mkdir(parents=True,
@@ -87,41 +107,178 @@ def get_webdirdest(fogsettings: dict) -> Path:
     return Path(webdirdest)
 
 
-def backup_db(config: ConfigParser,
-              backup_path: Path, fogsettings: dict) -> None:
+def check_db_dump(config: ConfigParser, size: int, tail: bytes) -> None:
+    """
+    Checks if an exported SQL database looks complete.
+
+    Args:
+        config: Contains configuration settings for the backup.
+        size: Size of the exported SQL database.
+        tail: Last bytes of the exported SQL database.
+
+    Raises:
+        ValueError: Raised when the export is smaller than
+            settings.fog_db_min_size or does not end with a line containing
+            settings.fog_db_trailer.
+    """
+    min_size = int(config['settings']['fog_db_min_size'])
+    trailer = config['settings']['fog_db_trailer'].encode()
+
+    if size < min_size:
+        raise ValueError(f"SQL export is {size} bytes, expected at least "
+                         f"{min_size} bytes.")
+
+    if trailer and trailer not in tail.rstrip().rsplit(b'\n', 1)[-1]:
+        raise ValueError(f"SQL export does not end with "
+                         f"{trailer.decode()!r}.")
+
+
+def backup_db(config: ConfigParser, backup_path: Path, fogsettings: dict,
+              manifest: Manifest | None = None,
+              stats: PhaseMetrics | None = None) -> None:
     """
     Performs backup of the FOG Server SQL database.
 
+    The export is streamed to a temporary file, which only replaces the
+    backup once it is complete and passes check_db_dump. Failed exports are
+    retried settings.http_retries times. The export is compressed on the fly
+    if settings.compression is set.
+
     Args:
         config: Contains configuration settings for the backup.
         backup_path: Root destination path of the ongoing backup.
         fogsettings: Dictionary containing the values of .fogsettings file.
+        manifest: If set, the export is added to it, with a checksum
+            computed while downloading.
+        stats: If set, the export and the retries are counted in it.
+
+    Raises:
+        RuntimeError: Raised when every attempt failed, so the backup is not
+            promoted without its database.
     """
     logger.info("== Backing up FOG Project SQL database. ==")
     fog_db_backup_path = backup_path / config['subpaths']['fog_db']
 
-    r = requests.post(f'http://'
-                      f'{fogsettings['ipaddress']}/'
-                      f'{fogsettings['webroot']}'
-                      f'/management/export.php?type=sql',
-                      data={'nojson': '1'})
-
-    fog_db_backup_path.write_bytes(r.content)
-    logger.info(f"FOG Project SQL database written to {fog_db_backup_path}.")
+    url = (f'http://'
+           f'{fogsettings['ipaddress']}/'
+           f'{fogsettings['webroot']}'
+           f'/management/export.php?type=sql')
+    attempts = int(config['settings']['http_retries']) + 1
+    backoff = float(config['settings']['http_backoff'])
+
+    with (make_session(config, pool_size=1) as session,
+          Compressor.from_config(config) as compressor):
+        if compressor.enabled:
+            fog_db_backup_path = compressor.compressed_path(
+                fog_db_backup_path)
+        tmp_path = fog_db_backup_path.with_name(
+            fog_db_backup_path.name + '.part')
+
+        error = None
+        for attempt in range(1, attempts + 1):
+            hasher = None if manifest is None else manifest.new_hasher()
+            try:
+                with (session.post(url, data={'nojson': '1'}, stream=True,
+                                   timeout=get_timeout(config)) as r,
+                      compressor.wrap(tmp_path.open('wb')) as f):
+                    size, tail = download(r, f, hasher=hasher)
+                check_db_dump(config, size, tail)
+            except (requests.RequestException, ValueError) as e:
+                error = e
+                logger.error(f"Attempt {attempt} of {attempts} to export the "
+                             f"FOG Project SQL database failed.", exc_info=e)
+                tmp_path.unlink(missing_ok=True)
+                if attempt < attempts:
+                    if stats is not None:
+                        stats.retries += 1
+                    sleep(backoff * 2 ** attempt)
+                continue
+
+            tmp_path.replace(fog_db_backup_path)
+            if stats is not None:
+                stats.add_file(size, fog_db_backup_path.stat().st_size)
+            if manifest is not None:
+                manifest.add(fog_db_backup_path, size,
+                             fog_db_backup_path.stat().st_mtime_ns,
+                             manifest.format_digest(hasher))
+            logger.info(f"FOG Project SQL database written to "
+                        f"{fog_db_backup_path}.")
+            return
+
+    raise RuntimeError(f"Could not export FOG Project SQL database to "
+                       f"{fog_db_backup_path}.") from error
+
+
+def is_unchanged(src_stat: stat_result, previous: Path,
+                 compare_size: bool = True) -> bool:
+    """
+    Checks if a file in the previous backup still matches its source.
 
+    Args:
+        src_stat: Result of stat on the source file.
+        previous: Path of the same file in the previous backup.
+        compare_size: Whether to compare sizes. Compressed files in the
+            previous backup only keep the modification time of the source.
 
-def copy_function_maker(logging_min_filesize) -> Callable:
+    Returns:
+        Whether previous exists and has the same size and modification time as
+        the source file.
+    """
+    try:
+        previous_stat = stat(previous)
+    except FileNotFoundError:
+        return False
+    return ((not compare_size or previous_stat.st_size == src_stat.st_size)
+            and previous_stat.st_mtime_ns == src_stat.st_mtime_ns)
+
+
+def copy_function_maker(logging_min_filesize, src_root: Path | None = None,
+                        link_root: Path | None = None,
+                        compressor: Compressor | None = None,
+                        throttle: Throttle | None = None,
+                        journal: Journal | None = None,
+                        manifest: Manifest | None = None,
+                        index: FileIndex | None = None,
+                        stats: PhaseMetrics | None = None,
+                        unchanged_dirs: set[str] | None = None,
+                        changes: ChangeSet | None = None,
+                        tee: Callable | None = None) -> Callable:
     """
-    Prepares a logged copy_function for the shutil.copytree function.
+    Prepares a logged copy_function for the transfer.copy_tree function.
 
     Args:
         logging_min_filesize: Files with a size smaller than this (in bits) are
             not logged. Prevents spam of various tiny files.
+        src_root: Root directory of the tree passed to transfer.copy_tree.
+        link_root: Same tree in the previous backup. If set, files that are
+            unchanged since that backup are hard linked instead of copied.
+        compressor: If enabled, files that compress well are stored
+            compressed, with the suffix of the compressor appended.
+        throttle: If set, reads of copied files wait for the throttle.
+        journal: If set, finished files are recorded in it, and files an
+            interrupted backup already finished are skipped.
+        manifest: If set, every file is added to it, with a checksum
+            computed while copying.
+        index: If set, every file is recorded in it. If it holds the previous
+            backup, unchanged files are found by comparing the source with
+            it instead of with the files under link_root.
+        stats: If set, every file is counted in it.
+        unchanged_dirs: Directories directly under src_root that are known
+            to be unchanged. Their files are hard linked from link_root
+            without comparing them with their source.
+        changes: If set, files in directories that it reports as clean are
+            hard linked from the previous backup in index without even
+            looking at their source.
+        tee: If set, copied files are also written to the files it returns
+            for their path in the backup, see destinations.tee_function.
 
     Returns:
         copy_function that includes logging.
     """
-    def copy_function(src, dst, *, follow_symlinks=True):
+    compress = compressor is not None and compressor.enabled
+    suffixes = ['', compressor.suffix] if compress else ['']
+
+    def copy_function(src, dst, *, follow_symlinks=True, entry=None):
         """Copies files and logs it if the file is large enough..
 
         Args:
@@ -129,25 +286,308 @@ def copy_function_maker(logging_min_filesize) -> Callable:
             dst: Destination directory.
             follow_symlinks: If false, symlinks won't be followed. This
                 resembles GNU's "cp -P src dst".
+            entry: If set, os.DirEntry of src from the walk, whose stat
+                results are reused.
             """
-        filesize = stat(src).st_size
+        start = perf_counter()
+        try:
+            result, size = copy_one(src, dst, follow_symlinks, entry)
+        except OSError:
+            events.record(fspath(src), None, perf_counter() - start,
+                          'failed')
+            raise
+        events.record(fspath(src), size, perf_counter() - start, result)
+        return dst
+
+    def copy_one(src, dst, follow_symlinks, dir_entry) -> tuple[str, int]:
+        """Copies a file. Returns what happened to it, and its size."""
+        if (changes is not None and index is not None and index.enabled
+                and changes.is_clean(dirname(src))):
+            size = keep_unchanged(dst)
+            if size is not None:
+                return 'linked', size
+
+        src_stat = stat(src) if dir_entry is None else dir_entry.stat()
+        if journal is not None and journal.is_done(dst, src_stat):
+            if manifest is not None:
+                entry = journal.entry(dst)
+                manifest.add(journal.root / entry['stored'],
+                             src_stat.st_size, src_stat.st_mtime_ns,
+                             entry.get('digest'))
+            if index is not None:
+                entry = journal.entry(dst)
+                index.record(dst, journal.root / entry['stored'], src_stat,
+                             entry.get('digest'))
+            if stats is not None:
+                stats.add_file()
+            return 'resumed', src_stat.st_size
+
+        stored, digest, linked = copy_or_link(src, dst, src_stat,
+                                              follow_symlinks)
+        if stats is not None:
+            if linked:
+                stats.add_file(linked=True)
+            else:
+                stats.add_file(src_stat.st_size, stat(stored).st_size)
+
+        if manifest is not None:
+            manifest.add(stored, src_stat.st_size, src_stat.st_mtime_ns,
+                         digest)
+        if journal is not None:
+            journal.record(dst, stored, src_stat, digest)
+        if index is not None:
+            index.record(dst, stored, src_stat, digest)
+        return 'linked' if linked else 'copied', src_stat.st_size
+
+    def keep_unchanged(dst) -> int | None:
+        """
+        Links a file of a clean directory from the previous backup. Returns
+        its size, or None if it was not linked.
+        """
+        row = index.previous_row(dst)
+        if row is None:
+            return None
+        _, stored, _, size, mtime_ns, _, digest = row
+        linked = index.root / stored
+        try:
+            if journal is not None and journal.resumed:
+                linked.unlink(missing_ok=True)
+            link(index.previous_path / stored, linked)
+        except OSError as e:
+            logger.warning(f"Could not hard link {fspath(linked)} from the "
+                           f"previous backup.", exc_info=e)
+            return None
+        index.keep(row)
+        if manifest is not None:
+            if not manifest.is_current(digest):
+                digest = None
+            manifest.add(linked, size, mtime_ns, digest)
+        if stats is not None:
+            stats.add_file(linked=True)
+        return size
+
+    def unchanged_candidates(src, dst, src_stat):
+        """Yields (previous, linked, digest) of files that may be linked."""
+        if link_root is not None:
+            rel = fspath(Path(src).relative_to(src_root))
+            if unchanged_dirs and Path(rel).parts[0] in unchanged_dirs:
+                for suffix in suffixes:
+                    previous = link_root / (rel + suffix)
+                    if exists(previous):
+                        linked = fspath(dst) + suffix
+                        digest = None
+                        if manifest is not None:
+                            digest = manifest.previous_digest(linked)
+                        yield previous, linked, digest
+                        return
+        if index is not None and index.enabled:
+            match = index.match(dst, src_stat)
+            if match is None:
+                return
+            stored, digest = match
+            if stored in (index.key(dst) + suffix for suffix in suffixes):
+                if manifest is None or not manifest.is_current(digest):
+                    digest = None
+                yield (index.previous_path / stored,
+                       fspath(index.root / stored), digest)
+            return
+        if link_root is not None:
+            for suffix in suffixes:
+                previous = link_root / (rel + suffix)
+                if is_unchanged(src_stat, previous, compare_size=not suffix):
+                    linked = fspath(dst) + suffix
+                    digest = None
+                    if manifest is not None:
+                        digest = manifest.previous_digest(linked)
+                    yield previous, linked, digest
+
+    def copy_or_link(src, dst, src_stat, follow_symlinks):
+        filesize = src_stat.st_size
+        for previous, linked, digest in unchanged_candidates(src, dst,
+                                                             src_stat):
+            try:
+                if journal is not None and journal.resumed:
+                    Path(linked).unlink(missing_ok=True)
+                link(previous, linked)
+            except OSError as e:
+                logger.warning(f"Could not hard link {fspath(previous)} to "
+                               f"{fspath(dst)}. Copying instead.",
+                               exc_info=e)
+                continue
+            return linked, digest, True
+        if journal is not None and journal.resumed:
+            # The interrupted backup may have left a hard link to the
+            # previous backup here. Writing through it would change that
+            # backup too.
+            for suffix in suffixes:
+                Path(fspath(dst) + suffix).unlink(missing_ok=True)
         if filesize > logging_min_filesize:
             logger.info(f"Copying {fspath(src)} to {fspath(dst)}. "
                         f"Filesize: {format_filesize(filesize)}")
-        shutil.copy2(src=src, dst=dst, follow_symlinks=follow_symlinks)
-        return dst
+        hasher = None if manifest is None else manifest.new_hasher()
+        if (compress and not exists(fspath(src) + compressor.suffix)
+                and compressor.should_compress(src)):
+            stored = compressor.compress_file(src, dst, throttle, hasher,
+                                              tee)
+        else:
+            stored = copy_file(src, dst, follow_symlinks=follow_symlinks,
+                               throttle=throttle, hasher=hasher, tee=tee)
+        if manifest is None:
+            return stored, None, False
+        return stored, manifest.format_digest(hasher), False
     return copy_function
 
 
+def log_copy_errors(errors: list[tuple[str, str, str]]) -> None:
+    """
+    Logs the files that could not be copied.
+
+    Args:
+        errors: (src, dst, reason) for every file that could not be copied.
+    """
+    for src, dst, reason in errors:
+        logger.error(f"Could not copy {src} to {dst}: {reason}")
+    if errors:
+        logger.error(f"{len(errors)} files could not be copied.")
+
+
+def get_link_root(config: ConfigParser, previous_path: Path | None,
+                  subpath: str) -> Path | None:
+    """
+    Determines the tree in the previous backup to hard link unchanged files
+    from.
+
+    Args:
+        config: Contains configuration settings for the backup.
+        previous_path: Root path of the previous completed backup, or None.
+        subpath: Key in the subpaths section of the tree being backed up.
+
+    Returns:
+        Path of the tree in the previous backup, or None if there is nothing
+        to link against.
+    """
+    if previous_path is None:
+        return None
+    link_root = previous_path / config['subpaths'][subpath]
+    if not link_root.is_dir():
+        return None
+    return link_root
+
+
+def copy_tree_packed(config: ConfigParser, src_root: Path, tree_path: Path,
+                     copy_function: Callable,
+                     previous_path: Path | None = None,
+                     manifest: Manifest | None = None,
+                     stats: PhaseMetrics | None = None
+                     ) -> list[tuple[str, str, str]]:
+    """
+    Copies a tree like transfer.copy_tree, packing its small files.
+
+    Regular files smaller than settings.pack_threshold are packed into
+    segments next to tree_path, see packs. Other files are copied with
+    copy_function. Without a threshold, this is transfer.copy_tree.
+
+    Args:
+        config: Contains configuration settings for the backup.
+        src_root: Root of the tree on the FOG server.
+        tree_path: Destination of the tree in the ongoing backup.
+        copy_function: Copies the files that are not packed.
+        previous_path: Same tree in the previous completed backup. Its
+            segments are hard linked where they hold unchanged files.
+        manifest: If set, the segments are added to it.
+        stats: If set, the packed files are counted in it.
+
+    Returns:
+        (src, dst, reason) for every file that could not be copied.
+
+    Raises:
+        FileNotFoundError: Raised when src_root does not exist.
+    """
+    settings = config['settings']
+    threshold = int(settings['pack_threshold'])
+    copy_workers = int(settings['copy_workers'])
+    if threshold <= 0:
+        return copy_tree(src_root, tree_path, copy_function, copy_workers)
+
+    small: list[tuple[str, str, stat_result]] = []
+    lock = Lock()
+
+    def collect_small(src, dst, *, follow_symlinks=True, entry=None):
+        src_stat = lstat(src) if entry is None else entry.stat(
+            follow_symlinks=False)
+        if S_ISREG(src_stat.st_mode) and src_stat.st_size < threshold:
+            with lock:
+                small.append((src, relpath(src, src_root), src_stat))
+            return dst
+        return copy_function(src, dst, follow_symlinks=follow_symlinks,
+                             entry=entry)
+
+    errors = copy_tree(src_root, tree_path, collect_small, copy_workers)
+
+    packs_path = packs.packs_path_of(tree_path)
+    previous_packs_path = None
+    if previous_path is not None:
+        previous_packs_path = packs.packs_path_of(previous_path)
+    try:
+        entries, linked, pack_errors = packs.pack_files(
+            small, packs_path, int(settings['pack_size']),
+            previous_packs_path)
+    except OSError as e:
+        return errors + [(fspath(src_root), fspath(packs_path), str(e))]
+    errors += pack_errors
+    logger.info(f"Packed {len(entries)} small files into {packs_path}, "
+                f"{linked} of them in segments linked from the previous "
+                f"backup.")
+
+    if stats is not None:
+        for entry in entries[:linked]:
+            stats.add_file(linked=True)
+        for entry in entries[linked:]:
+            stats.add_file(entry['size'], entry['size'])
+    if manifest is not None:
+        linked_segments = {packs.segment_name(entry['segment'])
+                           for entry in entries[:linked]}
+        for path in sorted(packs_path.iterdir()):
+            path_stat = stat(path)
+            digest = None
+            if path.name in linked_segments:
+                digest = manifest.previous_digest(path)
+            if digest is None and manifest.enabled:
+                digest = file_digest(path, manifest.algorithm)
+            manifest.add(path, path_stat.st_size, path_stat.st_mtime_ns,
+                         digest)
+    return errors
+
+
 def backup_images(config: ConfigParser, backup_path: Path,
-                  fogsettings: dict) -> None:
+                  fogsettings: dict,
+                  previous_path: Path | None = None,
+                  throttle: Throttle | None = None,
+                  journal: Journal | None = None,
+                  manifest: Manifest | None = None,
+                  index: FileIndex | None = None,
+                  stats: PhaseMetrics | None = None,
+                  changes: ChangeSet | None = None,
+                  tee: Callable | None = None) -> None:
     """
     Performs backup of the FOG Server images folder.
 
+    With settings.fog_images_selection set to catalog, the images table in
+    the SQL export decides which images are backed up, see fogcatalog.
+
     Args:
         config: Contains configuration settings for the backup.
         backup_path: Root destination path of the ongoing backup.
         fogsettings: Dictionary containing the values of .fogsettings file.
+        previous_path: Root path of the previous completed backup. Unchanged
+            files are hard linked from it instead of copied.
+        throttle: If set, reads from the FOG server wait for the throttle.
+        journal: Journal of the ongoing backup, used to resume it.
+        manifest: Manifest of the ongoing backup.
+        index: Index of the previous backup, used to find unchanged files.
+        stats: If set, the files of the phase are counted in it.
+        changes: Directories changed since the previous backup, if known.
+        tee: If set, copied files are also written to other destinations.
     """
     logger.info("== Backing up FOG Project images. ==")
 
@@ -155,19 +595,132 @@ def backup_images(config: ConfigParser, backup_path: Path,
     fog_images_backup_path = backup_path / config['subpaths']['fog_images']
 
     logging_min_filesize = int(config['settings']['logging_min_filesize'])
-    copy_function = copy_function_maker(logging_min_filesize)
+    copy_workers = int(config['settings']['copy_workers'])
+
+    selection = select_images(config, backup_path, fog_images_path,
+                              previous_path)
+    ignore = None
+    unchanged_dirs = None
+    if selection is not None:
+        ignore = selection.ignore(fog_images_path)
+        unchanged_dirs = selection.unchanged
+
+    if config['settings']['fog_images_storage'] == 'chunks':
+        backup_images_chunked(config, backup_path, fog_images_path,
+                              previous_path, throttle, stats, ignore)
+    else:
+        link_root = get_link_root(config, previous_path, 'fog_images')
+        try:
+            with Compressor.from_config(config) as compressor:
+                copy_function = copy_function_maker(
+                    logging_min_filesize, src_root=fog_images_path,
+                    link_root=link_root, compressor=compressor,
+                    throttle=throttle, journal=journal, manifest=manifest,
+                    index=index, stats=stats, unchanged_dirs=unchanged_dirs,
+                    changes=changes, tee=tee)
+                errors = copy_tree(fog_images_path, fog_images_backup_path,
+                                   copy_function, copy_workers, ignore)
+            log_copy_errors(errors)
+        except FileNotFoundError as e:
+            logger.error(f"Could not copy images from {fog_images_path} to "
+                         f"{fog_images_backup_path}.", exc_info=e)
+        logger.info(f"FOG Project images written to "
+                    f"{fog_images_backup_path}.")
+
+    if selection is not None:
+        fogcatalog.write_fingerprints(
+            fogcatalog.catalog_path_of(fog_images_backup_path),
+            selection.fingerprints)
+
+
+def select_images(config: ConfigParser, backup_path: Path,
+                  fog_images_path: Path,
+                  previous_path: Path | None = None
+                  ) -> fogcatalog.Selection | None:
+    """
+    Selects the images to back up from the images table of FOG.
 
+    Args:
+        config: Contains configuration settings for the backup.
+        backup_path: Root destination path of the ongoing backup.
+        fog_images_path: FOG Server images folder.
+        previous_path: Root path of the previous completed backup.
+
+    Returns:
+        The selection, or None if the whole images folder is backed up,
+        because settings.fog_images_selection is all or the images table
+        could not be read.
+    """
+    if config['settings']['fog_images_selection'] != 'catalog':
+        return None
+    catalog = fogcatalog.load_catalog(config, backup_path, previous_path)
+    if catalog is None:
+        return None
+
+    previous = {}
+    if previous_path is not None:
+        previous = fogcatalog.read_fingerprints(fogcatalog.catalog_path_of(
+            previous_path / config['subpaths']['fog_images']))
     try:
-        shutil.copytree(fog_images_path, fog_images_backup_path,
-                        copy_function=copy_function, dirs_exist_ok=True)
-    except (shutil.Error, FileNotFoundError) as e:
-        logger.error(f"Could not copy images from {fog_images_path} to "
-                     f"{fog_images_backup_path}.", exc_info=e)
-    logger.info(f"FOG Project images written to {fog_images_backup_path}.")
+        return fogcatalog.select(catalog, fog_images_path, previous)
+    except FileNotFoundError as e:
+        logger.error(f"Could not list images in {fog_images_path}.",
+                     exc_info=e)
+        return None
+
+
+def backup_images_chunked(config: ConfigParser, backup_path: Path,
+                          fog_images_path: Path,
+                          previous_path: Path | None = None,
+                          throttle: Throttle | None = None,
+                          stats: PhaseMetrics | None = None,
+                          ignore: Callable | None = None) -> None:
+    """
+    Performs backup of the FOG Server images folder into the chunk store.
+
+    Only a manifest is written to the numbered backup directory. The file
+    contents are stored deduplicated in the chunk store under paths.backups.
+
+    Args:
+        config: Contains configuration settings for the backup.
+        backup_path: Root destination path of the ongoing backup.
+        fog_images_path: FOG Server images folder.
+        previous_path: Root path of the previous completed backup. Files that
+            are unchanged since then are not read again.
+        throttle: If set, reads from the FOG server wait for the throttle.
+        stats: If set, the files of the phase are counted in it.
+        ignore: If set, entries it returns are not stored, like the ignore
+            argument of shutil.copytree.
+    """
+    subpath = config['subpaths']['fog_images']
+    manifest_path = chunkstore.manifest_path_of(backup_path / subpath)
+    previous_manifest_path = None
+    if previous_path is not None:
+        previous_manifest_path = chunkstore.manifest_path_of(
+            previous_path / subpath)
+
+    store = chunkstore.ChunkStore.from_config(config)
+    try:
+        chunkstore.backup_tree(
+            store, fog_images_path, manifest_path, previous_manifest_path,
+            int(config['settings']['logging_min_filesize']), throttle,
+            config['settings']['checksum'], stats, ignore)
+    except OSError as e:
+        logger.error(f"Could not store images from {fog_images_path} in "
+                     f"chunk store {store.root}.", exc_info=e)
+    logger.info(f"FOG Project images manifest written to {manifest_path}.")
 
 
 def backup_snapins(config: ConfigParser, backup_path: Path,
-                   fogsettings: dict) -> None:
+                   fogsettings: dict,
+                   previous_path: Path | None = None,
+                   throttle: Throttle | None = None,
+                   journal: Journal | None = None,
+                   manifest: Manifest | None = None,
+                   index: FileIndex | None = None,
+                   stats: PhaseMetrics | None = None,
+                   changes: ChangeSet | None = None,
+                   tee: Callable | None = None) -> None:
     """
     Performs backup of the FOG Server snapins.
 
@@ -175,6 +728,15 @@ def backup_snapins(config: ConfigParser, backup_path: Path,
         config: Contains configuration settings for the backup.
         backup_path: Root destination path of the ongoing backup.
         fogsettings: Dictionary containing the values of .fogsettings file.
+        previous_path: Root path of the previous completed backup. Unchanged
+            files are hard linked from it instead of copied.
+        throttle: If set, reads from the FOG server wait for the throttle.
+        journal: Journal of the ongoing backup, used to resume it.
+        manifest: Manifest of the ongoing backup.
+        index: Index of the previous backup, used to find unchanged files.
+        stats: If set, the files of the phase are counted in it.
+        changes: Directories changed since the previous backup, if known.
+        tee: If set, copied files are also written to other destinations.
     """
     logger.info("== Backing up FOG Project snapins. ==")
 
@@ -182,12 +744,26 @@ def backup_snapins(config: ConfigParser, backup_path: Path,
     fog_snapins_backup_path = backup_path / config['subpaths']['fog_snapins']
 
     logging_min_filesize = int(config['settings']['logging_min_filesize'])
-    copy_function = copy_function_maker(logging_min_filesize)
+    link_root = get_link_root(config, previous_path, 'fog_snapins')
 
     try:
-        shutil.copytree(fog_snapins_path, fog_snapins_backup_path,
-                        copy_function=copy_function, dirs_exist_ok=True)
-    except (shutil.Error, FileNotFoundError) as e:
+        with Compressor.from_config(config) as compressor:
+            copy_function = copy_function_maker(logging_min_filesize,
+                                                src_root=fog_snapins_path,
+                                                link_root=link_root,
+                                                compressor=compressor,
+                                                throttle=throttle,
+                                                journal=journal,
+                                                manifest=manifest,
+                                                index=index,
+                                                stats=stats,
+                                                changes=changes,
+                                                tee=tee)
+            errors = copy_tree_packed(config, fog_snapins_path,
+                                      fog_snapins_backup_path, copy_function,
+                                      link_root, manifest, stats)
+        log_copy_errors(errors)
+    except FileNotFoundError as e:
         logger.error(f"Could not copy snapins from {fog_snapins_path} to "
                      f"{fog_snapins_backup_path}.", exc_info=e)
 
@@ -195,7 +771,15 @@ def backup_snapins(config: ConfigParser, backup_path: Path,
 
 
 def backup_reports(config: ConfigParser, backup_path: Path,
-                   fogsettings: dict) -> None:
+                   fogsettings: dict,
+                   previous_path: Path | None = None,
+                   throttle: Throttle | None = None,
+                   journal: Journal | None = None,
+                   manifest: Manifest | None = None,
+                   index: FileIndex | None = None,
+                   stats: PhaseMetrics | None = None,
+                   changes: ChangeSet | None = None,
+                   tee: Callable | None = None) -> None:
     """
     Performs backup of the FOG Server reports.
 
@@ -203,6 +787,15 @@ def backup_reports(config: ConfigParser, backup_path: Path,
         config: Contains configuration settings for the backup.
         backup_path: Root destination path of the ongoing backup.
         fogsettings: Dictionary containing the values of .fogsettings file.
+        previous_path: Root path of the previous completed backup. Unchanged
+            files are hard linked from it instead of copied.
+        throttle: If set, reads from the FOG server wait for the throttle.
+        journal: Journal of the ongoing backup, used to resume it.
+        manifest: Manifest of the ongoing backup.
+        index: Index of the previous backup, used to find unchanged files.
+        stats: If set, the files of the phase are counted in it.
+        changes: Directories changed since the previous backup, if known.
+        tee: If set, copied files are also written to other destinations.
     """
     logger.info("== Backing up FOG Project reports. ==")
 
@@ -210,39 +803,129 @@ def backup_reports(config: ConfigParser, backup_path: Path,
     fog_reports_backup_path = backup_path / config['subpaths']['fog_reports']
 
     logging_min_filesize = int(config['settings']['logging_min_filesize'])
-    copy_function = copy_function_maker(logging_min_filesize)
+    link_root = get_link_root(config, previous_path, 'fog_reports')
 
     try:
-        shutil.copytree(fog_reports_path, fog_reports_backup_path,
-                        copy_function=copy_function, dirs_exist_ok=True)
-    except (shutil.Error, FileNotFoundError) as e:
+        with Compressor.from_config(config) as compressor:
+            copy_function = copy_function_maker(logging_min_filesize,
+                                                src_root=fog_reports_path,
+                                                link_root=link_root,
+                                                compressor=compressor,
+                                                throttle=throttle,
+                                                journal=journal,
+                                                manifest=manifest,
+                                                index=index,
+                                                stats=stats,
+                                                changes=changes,
+                                                tee=tee)
+            errors = copy_tree_packed(config, fog_reports_path,
+                                      fog_reports_backup_path, copy_function,
+                                      link_root, manifest, stats)
+        log_copy_errors(errors)
+    except FileNotFoundError as e:
         logger.error(f"Could not copy reports from {fog_reports_path} to "
                      f"{fog_reports_backup_path}.", exc_info=e)
 
     logger.info(f"FOG Project reports written to {fog_reports_backup_path}.")
 
 
+def log_throttle(throttle: Throttle) -> None:
+    logger.info(f"Reads from the FOG server waited "
+                f"{throttle.throttled:.1f} s in total for the throttle.")
+
+
 def backup(config: ConfigParser, backup_path: Path,
-           backupflags: Backupflags) -> None:
+           backupflags: Backupflags,
+           previous_path: Path | None = None,
+           journal: Journal | None = None,
+           manifest: Manifest | None = None,
+           index: FileIndex | None = None,
+           scheduler: Scheduler | None = None,
+           metrics: RunMetrics | None = None,
+           changes: ChangeSet | None = None,
+           tee: Callable | None = None) -> None:
     """
     Performs backup of FOG server.
 
+    The database export and the copies of the images, snapins and reports
+    run concurrently as tasks of a scheduler. The export uses the http
+    resource, the copies the source resource, and all of them the
+    destination resource.
+
     Args:
         config: Contains configuration settings for the backup.
         backup_path: Root destination path of the ongoing backup.
         backupflags: Contains flags indicating which backups to perform.
+        previous_path: Root path of the previous completed backup, used for
+            incremental snapshots. None performs a full backup.
+        journal: Journal of the ongoing backup, used to resume it.
+        manifest: Manifest of the ongoing backup.
+        index: Index of the previous backup, used to find unchanged files.
+        scheduler: If set, the tasks are only added to it, and run with the
+            other tasks of the backup when the caller runs it. Otherwise
+            they run before this function returns.
+        metrics: If set, every task counts its files in the phase of the
+            same name.
+        changes: Directories changed since the previous backup, if known.
+            Files in other directories are linked without looking at them.
+        tee: If set, copied files are also written to the files it returns,
+            so other destinations get them without reading them again.
+
+    Raises:
+        RuntimeError: Raised when scheduler is not set and a task failed.
     """
     logger.info("==== Backing up FOG Project server. ====")
 
     init_paths(config, backup_path)
 
     fogsettings = get_fogsettings(config)
+    throttle = Throttle.from_config(config)
+
+    run = scheduler is None
+    if run:
+        scheduler = Scheduler.from_config(config, metrics)
+
+    def phase(name: str) -> PhaseMetrics | None:
+        return None if metrics is None else metrics.phase(name)
+
+    def copy_task(function: Callable, name: str) -> None:
+        shared = throttle.share()
+        stats = phase(name)
+        function(config, backup_path, fogsettings, previous_path, shared,
+                 journal, manifest, index, stats, changes, tee)
+        if stats is not None:
+            stats.throttled = shared.throttled
 
+    copies = []
     if backupflags.fog_db:
-        backup_db(config, backup_path, fogsettings)
-    if backupflags.fog_images:
-        backup_images(config, backup_path, fogsettings)
-    if backupflags.fog_snapins:
-        backup_snapins(config, backup_path, fogsettings)
-    if backupflags.fog_reports:
-        backup_reports(config, backup_path, fogsettings)
+        scheduler.add(Task('fog_db', partial(backup_db, config, backup_path,
+                                             fogsettings, manifest,
+                                             phase('fog_db')),
+                           resources=('http', 'destination')))
+    for name, function in (('fog_images', backup_images),
+                           ('fog_snapins', backup_snapins),
+                           ('fog_reports', backup_reports)):
+        if getattr(backupflags, name):
+            after = ()
+            if (name == 'fog_images' and backupflags.fog_db
+                    and config['settings']['fog_images_selection']
+                    == 'catalog'
+                    and (previous_path is None
+                         or dbdelta.find_dump(previous_path,
+                                              config['subpaths']['fog_db'])
+                         is None)):
+                # The images table is read from the new SQL export. With an
+                # export in the previous backup to fall back on, the images
+                # do not wait for it.
+                after = ('fog_db',)
+            scheduler.add(Task(name, partial(copy_task, function, name),
+                               resources=('source', 'destination'),
+                               after=after))
+            copies.append(name)
+
+    if throttle.enabled and copies:
+        scheduler.add(Task('fog_throttle', partial(log_throttle, throttle),
+                           after=tuple(copies)))
+
+    if run:
+        raise_failures(scheduler.run())
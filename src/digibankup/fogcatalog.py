@@ -0,0 +1,325 @@
+"""
+Reads the image list of the FOG Project server from its SQL export.
+
+FOG keeps the directory, settings and state of every image in its images
+table. Disabled images, and captures in progress in the dev directory, are
+left out of the backup of the images folder. Every backed up image gets a
+fingerprint of its metadata and file sizes, written next to the images in the
+backup, so an image that did not change since the previous backup is linked
+from it without comparing its files with their sources.
+"""
+
+import os
+import re
+import json
+from configparser import ConfigParser
+from dataclasses import dataclass, field
+from logging import getLogger
+from pathlib import Path
+from typing import BinaryIO, Callable, Iterator
+
+import digibankup.dbdelta as dbdelta
+from digibankup.compression import open_decompressed
+
+logger = getLogger(__name__)
+
+CATALOG_SUFFIX = '.catalog.json'
+# Directory under storageLocation that FOG captures images into, before
+# moving them to their own directory once the capture completes.
+DEV_DIR = 'dev'
+# Captures in progress in DEV_DIR are named after the MAC address of the
+# host, with or without separators. Other entries, such as postinitscripts,
+# are kept.
+CAPTURE_DIR = re.compile(r'[0-9a-f]{12}|[0-9a-f]{2}([:-][0-9a-f]{2}){5}',
+                         re.IGNORECASE)
+# Columns of the images table that change when an image is captured again
+# or its settings change. Deploying an image changes none of them.
+METADATA_COLUMNS = ('imageName', 'imagePath', 'imageDateTime', 'imageSize',
+                    'imageTypeID', 'imagePartitionTypeID', 'imageOSID',
+                    'imageFormat', 'imageCompress')
+
+TOKEN = re.compile(r"\s*(?:'((?:[^'\\]|\\.|'')*)'|(NULL)|([(),;])"
+                   r"|([^\s(),;']+))", re.S)
+ESCAPE = re.compile(r"\\(.)|''", re.S)
+ESCAPES = {'0': '\0', 'b': '\b', 'n': '\n', 'r': '\r', 't': '\t',
+           'Z': '\x1a'}
+
+
+@dataclass
+class FogImage:
+    """
+    Image in the images table of FOG.
+
+    Attributes:
+        name: Name of the image in the FOG web interface.
+        path: Directory of the image, relative to storageLocation.
+        enabled: Whether the image can be deployed.
+        metadata: Values of METADATA_COLUMNS.
+    """
+    name: str
+    path: str
+    enabled: bool
+    metadata: dict[str, str | None]
+
+    @property
+    def directory(self) -> str:
+        """Name of the directory directly under storageLocation."""
+        return self.path.strip('/').split('/')[0]
+
+
+@dataclass
+class Selection:
+    """
+    Images to back up.
+
+    Attributes:
+        skipped: Names of the entries directly under storageLocation that
+            are not backed up.
+        skipped_dev: Names of the captures in progress in its dev directory,
+            which are not backed up either.
+        unchanged: Directories of the images whose fingerprint matches the
+            previous backup.
+        fingerprints: Fingerprint of every backed up image, by directory.
+    """
+    skipped: set[str] = field(default_factory=set)
+    skipped_dev: set[str] = field(default_factory=set)
+    unchanged: set[str] = field(default_factory=set)
+    fingerprints: dict[str, dict] = field(default_factory=dict)
+
+    def ignore(self, root: Path) -> Callable[[str, list[str]], set[str]]:
+        """
+        Prepares an ignore function for copying the images folder.
+
+        Args:
+            root: The images folder.
+
+        Returns:
+            Function with the signature of the ignore argument of
+            shutil.copytree, ignoring the skipped entries of root and of
+            its dev directory.
+        """
+        root = os.path.normpath(root)
+        dev = os.path.join(root, DEV_DIR)
+
+        def ignore(dirpath: str, names: list[str]) -> set[str]:
+            dirpath = os.path.normpath(dirpath)
+            if dirpath == root:
+                return self.skipped.intersection(names)
+            if dirpath == dev:
+                return self.skipped_dev.intersection(names)
+            return set()
+        return ignore
+
+
+def unescape(value: str) -> str:
+    """Decodes the escape sequences of a MySQL string literal."""
+    return ESCAPE.sub(lambda m: "'" if m.group(1) is None
+                      else ESCAPES.get(m.group(1), m.group(1)), value)
+
+
+def parse_rows(values: str) -> Iterator[list[str | None]]:
+    """
+    Parses the rows of an INSERT statement.
+
+    Args:
+        values: The statement from the first row onwards, e.g.
+            "(1,'a',NULL),(2,'b',NULL);".
+
+    Yields:
+        Values of every row, as strings or None for NULL.
+    """
+    row = None
+    position = 0
+    while match := TOKEN.match(values, position):
+        position = match.end()
+        string, null, punctuation, bare = match.groups()
+        if punctuation == '(':
+            row = []
+        elif punctuation == ')':
+            if row is not None:
+                yield row
+            row = None
+        elif punctuation is not None or row is None:
+            continue
+        elif string is not None:
+            row.append(unescape(string))
+        elif null is not None:
+            row.append(None)
+        else:
+            row.append(bare)
+
+
+def read_catalog(f: BinaryIO) -> list[FogImage] | None:
+    """
+    Reads the images table from a SQL dump.
+
+    Args:
+        f: The dump, opened for binary reading.
+
+    Returns:
+        Every image in the table, or None if the dump has no images table.
+    """
+    columns: list[str] | None = None
+    in_create = False
+    images = []
+    for line in f:
+        if line.startswith(b'CREATE TABLE `images` ('):
+            columns = []
+            in_create = True
+            continue
+        if in_create:
+            stripped = line.strip()
+            if stripped.startswith(b'`'):
+                columns.append(stripped[1:stripped.index(b'`', 1)].decode())
+            elif stripped.startswith(b')'):
+                in_create = False
+            continue
+        if not line.startswith(b'INSERT INTO `images` '):
+            continue
+
+        head, _, values = line.decode(errors='replace').partition(' VALUES ')
+        row_columns = re.findall(r'`(\w+)`', head)[1:] or columns or []
+        for row in parse_rows(values):
+            image = dict(zip(row_columns, row))
+            if not image.get('imagePath'):
+                continue
+            images.append(FogImage(
+                name=image.get('imageName') or image['imagePath'],
+                path=image['imagePath'],
+                enabled=image.get('imageEnabled', '1') != '0',
+                metadata={column: image.get(column)
+                          for column in METADATA_COLUMNS}))
+        if columns is None:
+            columns = row_columns
+    if columns is None:
+        return None
+    return images
+
+
+def load_catalog(config: ConfigParser, backup_path: Path,
+                 previous_path: Path | None = None) -> list[FogImage] | None:
+    """
+    Reads the images table from the newest available SQL export.
+
+    Args:
+        config: Contains configuration settings for the backup.
+        backup_path: Root destination path of the ongoing backup. Its export
+            is used if it has one.
+        previous_path: Root path of the previous completed backup, whose
+            export is used otherwise.
+
+    Returns:
+        Every image in the table, or None if no export could be read.
+    """
+    subpath = config['subpaths']['fog_db']
+    for root in (backup_path, previous_path):
+        if root is None:
+            continue
+        dump_path = dbdelta.find_dump(root, subpath)
+        if dump_path is None:
+            continue
+        try:
+            if dbdelta.is_delta(dump_path):
+                f = dbdelta.open_dump(root, subpath)
+            else:
+                f = open_decompressed(dump_path)
+            with f:
+                catalog = read_catalog(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read the FOG image list from "
+                           f"{dump_path}.", exc_info=e)
+            continue
+        if catalog is not None:
+            logger.info(f"Read {len(catalog)} images from {dump_path}.")
+            return catalog
+    logger.warning("No SQL export with a FOG image list found. Backing up "
+                   "the whole images folder.")
+    return None
+
+
+def fingerprint(image: FogImage, directory: Path) -> dict:
+    """
+    Describes an image by its metadata and the sizes of its files.
+
+    Args:
+        image: The image.
+        directory: Directory of the image.
+
+    Returns:
+        The fingerprint, which survives a round trip through JSON.
+    """
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            files[os.path.relpath(path, directory)] = os.stat(path).st_size
+    return {'metadata': image.metadata, 'files': files}
+
+
+def catalog_path_of(tree_path: Path) -> Path:
+    """Determines where the fingerprints of the images are stored."""
+    return tree_path.with_name(tree_path.name + CATALOG_SUFFIX)
+
+
+def read_fingerprints(path: Path) -> dict[str, dict]:
+    """Reads the fingerprints of a backup. Empty if it has none."""
+    try:
+        with path.open('r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def write_fingerprints(path: Path, fingerprints: dict[str, dict]) -> None:
+    """Atomically writes the fingerprints of the images of a backup."""
+    tmp_path = path.with_suffix('.tmp')
+    with tmp_path.open('w') as f:
+        json.dump(fingerprints, f, sort_keys=True)
+    tmp_path.replace(path)
+
+
+def select(catalog: list[FogImage], images_root: Path,
+           previous: dict[str, dict] | None = None) -> Selection:
+    """
+    Decides which entries of the images folder to back up.
+
+    The captures in progress in the dev directory and the directories of
+    disabled images are skipped. Other entries, such as postdownloadscripts,
+    dev/postinitscripts or directories FOG does not know, are backed up.
+
+    Args:
+        catalog: Images in the images table.
+        images_root: The images folder, storageLocation.
+        previous: Fingerprints of the previous backup.
+
+    Returns:
+        The selection.
+    """
+    previous = previous or {}
+    images = {image.directory: image for image in catalog}
+    selection = Selection()
+    for entry in sorted(os.scandir(images_root), key=lambda e: e.name):
+        if entry.name == DEV_DIR and entry.is_dir():
+            for capture in os.scandir(entry.path):
+                if (capture.is_dir(follow_symlinks=False)
+                        and CAPTURE_DIR.fullmatch(capture.name)):
+                    logger.info(f"Skipping capture in progress in "
+                                f"{capture.path}.")
+                    selection.skipped_dev.add(capture.name)
+            continue
+        image = images.get(entry.name)
+        if image is None or not entry.is_dir():
+            continue
+        if not image.enabled:
+            logger.info(f"Skipping disabled image {image.name} in "
+                        f"{entry.path}.")
+            selection.skipped.add(entry.name)
+            continue
+        selection.fingerprints[entry.name] = fingerprint(image,
+                                                         Path(entry.path))
+        if previous.get(entry.name) == selection.fingerprints[entry.name]:
+            selection.unchanged.add(entry.name)
+    logger.info(f"Backing up {len(selection.fingerprints)} FOG images, "
+                f"{len(selection.unchanged)} of them unchanged. Skipping "
+                f"{len(selection.skipped)} directories.")
+    return selection
@@ -0,0 +1,169 @@
+"""
+Keeps track of the files finished by the ongoing backup, so an interrupted
+backup can be resumed instead of started over.
+"""
+
+import os
+import json
+from logging import getLogger
+from pathlib import Path
+from threading import Lock
+from time import monotonic
+from configparser import ConfigParser
+
+logger = getLogger(__name__)
+
+JOURNAL_NAME = '.journal'
+FLUSH_INTERVAL = 5
+FLUSH_COUNT = 256
+
+# Settings that change what ends up in the backup. A journal written with
+# other values for these settings cannot be resumed.
+JOURNAL_SETTINGS = ('compression', 'fog_images_storage', 'checksum')
+
+
+class Journal():
+    """
+    Journal of the files finished by the ongoing backup.
+
+    Every finished file is appended as a JSON line with the size and
+    modification time of its source. Lines are flushed in batches, so a crash
+    loses at most the last few entries, which are then simply copied again.
+    """
+    @classmethod
+    def from_config(cls, config: ConfigParser, backup_path: Path):
+        return cls(backup_path, {key: config['settings'][key]
+                                 for key in JOURNAL_SETTINGS})
+
+    def __init__(self, backup_path: Path, settings: dict[str, str]):
+        self.root: Path = backup_path
+        self.path: Path = backup_path / JOURNAL_NAME
+        self.settings: dict[str, str] = settings
+        self.entries: dict[str, dict] = {}
+        self.seen: set[str] = set()
+        self.resumed: bool = False
+        self.lock: Lock = Lock()
+        self.f = None
+        self.unflushed: int = 0
+        self.last_flush: float = monotonic()
+
+    def load(self) -> bool:
+        """
+        Reads the journal of an interrupted backup.
+
+        Returns:
+            Whether the journal exists and was written with the same
+            settings, so the interrupted backup can be resumed.
+        """
+        try:
+            with self.path.open('r') as f:
+                header = json.loads(f.readline())
+                if header.get('settings') != self.settings:
+                    logger.warning(f"Journal {self.path} was written with "
+                                   f"different settings.")
+                    return False
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last line may be cut off by the interruption.
+                        break
+                    self.entries[entry['path']] = entry
+        except FileNotFoundError:
+            return False
+        except (json.JSONDecodeError, AttributeError, KeyError) as e:
+            logger.warning(f"Could not parse journal {self.path}.",
+                           exc_info=e)
+            return False
+        self.resumed = True
+        return True
+
+    def open(self) -> None:
+        """Opens the journal for appending, writing a header if it is new."""
+        if self.resumed:
+            self.f = self.path.open('a')
+        else:
+            self.f = self.path.open('w')
+            self.f.write(json.dumps({'settings': self.settings}) + '\n')
+            self.f.flush()
+
+    def close(self) -> None:
+        if self.f is not None:
+            with self.lock:
+                self.f.close()
+                self.f = None
+
+    def key(self, dst) -> str:
+        return os.path.relpath(dst, self.root)
+
+    def is_done(self, dst, src_stat: os.stat_result) -> bool:
+        """
+        Checks if the interrupted backup already finished a file.
+
+        Args:
+            dst: Destination of the file, without compression suffix.
+            src_stat: Result of stat on the source file.
+
+        Returns:
+            Whether the file was finished from a source with the same size
+            and modification time, and its stored copy still exists.
+        """
+        key = self.key(dst)
+        entry = self.entries.get(key)
+        if (entry is None
+                or entry['size'] != src_stat.st_size
+                or entry['mtime_ns'] != src_stat.st_mtime_ns
+                or not (self.root / entry['stored']).exists()):
+            return False
+        with self.lock:
+            self.seen.add(key)
+        return True
+
+    def entry(self, dst) -> dict:
+        return self.entries[self.key(dst)]
+
+    def record(self, dst, stored, src_stat: os.stat_result,
+               digest: str | None = None) -> None:
+        """
+        Records a finished file.
+
+        Args:
+            dst: Destination of the file, without compression suffix.
+            stored: Path the file was actually written to.
+            src_stat: Result of stat on the source file.
+            digest: Checksum of the file, kept for the manifest.
+        """
+        entry = {'path': self.key(dst),
+                 'stored': self.key(stored),
+                 'size': src_stat.st_size,
+                 'mtime_ns': src_stat.st_mtime_ns,
+                 'digest': digest}
+        with self.lock:
+            self.seen.add(entry['path'])
+            self.entries[entry['path']] = entry
+            self.f.write(json.dumps(entry) + '\n')
+            self.unflushed += 1
+            now = monotonic()
+            if (self.unflushed >= FLUSH_COUNT
+                    or now - self.last_flush >= FLUSH_INTERVAL):
+                self.f.flush()
+                self.unflushed = 0
+                self.last_flush = now
+
+    def prune(self) -> None:
+        """
+        Deletes files finished by the interrupted backup that were not part
+        of this run, because their source has been deleted since.
+        """
+        stale = [entry for key, entry in self.entries.items()
+                 if key not in self.seen]
+        for entry in stale:
+            (self.root / entry['stored']).unlink(missing_ok=True)
+        if stale:
+            logger.info(f"Deleted {len(stale)} files of the interrupted "
+                        f"backup whose source no longer exists.")
+
+    def remove(self) -> None:
+        """Closes and deletes the journal once the backup is complete."""
+        self.close()
+        self.path.unlink(missing_ok=True)
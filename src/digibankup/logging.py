@@ -1,7 +1,51 @@
-"""Configures logging when running Digibankup as a standalone utility."""
+"""
+Configures logging when running Digibankup as a standalone utility.
+
+Loggers only put their records on a queue, and a background thread per
+queue writes them to the log file, the console and the event log. A slow
+disk under the log file, such as the NAS being backed up to, then no longer
+stalls the threads that copy files. The event log is configured on its own,
+so it is written even when the human log is turned off.
+"""
+import atexit
 import logging
 import logging.handlers
 from configparser import ConfigParser
+from queue import SimpleQueue
+from typing import Callable
+
+import digibankup.events as events
+
+
+def start_listener(logger: logging.Logger,
+                   handlers: list[logging.Handler]) -> Callable[[], None]:
+    """
+    Sends the records of a logger to handlers in a background thread.
+
+    The thread is stopped and the handlers are closed when Python exits.
+
+    Args:
+        logger: The logger.
+        handlers: Handlers that write the records.
+
+    Returns:
+        Function that does so right away instead.
+    """
+    queue = SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(queue)
+    listener = logging.handlers.QueueListener(queue, *handlers,
+                                              respect_handler_level=True)
+    logger.addHandler(queue_handler)
+    listener.start()
+
+    def stop():
+        atexit.unregister(stop)
+        logger.removeHandler(queue_handler)
+        listener.stop()
+        for handler in handlers:
+            handler.close()
+    atexit.register(stop)
+    return stop
 
 
 def configure_logging(config: ConfigParser):
@@ -12,6 +56,7 @@ def configure_logging(config: ConfigParser):
         config: Configuration settings for the backup.
     """
     logger = logging.getLogger("digibankup")
+    settings = config['settings']
 
     formatter = logging.Formatter(
         "[%(asctime)s] [%(levelname)s] %(message)s",
@@ -20,13 +65,28 @@ def configure_logging(config: ConfigParser):
     rotating_handler = logging.handlers.TimedRotatingFileHandler(
         filename=config['paths']['log'],
         when='W0',
-        backupCount=int(config['settings']['backup_count'])
+        backupCount=int(settings['backup_count'])
     )
     rotating_handler.setFormatter(formatter)
-    logger.addHandler(rotating_handler)
 
     stream_handler = logging.StreamHandler()
     stream_handler.setFormatter(formatter)
-    logger.addHandler(stream_handler)
 
-    logger.setLevel(logging.INFO)
+    start_listener(logger, [rotating_handler, stream_handler])
+    logger.setLevel(settings['log_level'].upper())
+
+
+def configure_events(config: ConfigParser) -> Callable[[], None]:
+    """
+    Writes the transfer events to paths.event_log, whether or not logging is
+    configured.
+
+    Args:
+        config: Configuration settings for the backup.
+
+    Returns:
+        Function that stops writing events, writing the last batch.
+    """
+    return start_listener(events.logger, [events.JsonlHandler(
+        config['paths']['event_log'],
+        int(config['settings']['event_batch_size']))])
@@ -0,0 +1,206 @@
+"""
+Records the size, modification time and checksum of every file in a backup.
+
+Checksums are computed while files are copied, in the same read pass, and
+written to a sorted JSONL manifest in the root of the backup. Requires the
+xxhash package for xxh3 checksums.
+"""
+
+import os
+import json
+import hashlib
+from configparser import ConfigParser
+from logging import getLogger
+from pathlib import Path
+from threading import Lock
+
+logger = getLogger(__name__)
+
+MANIFEST_NAME = 'manifest.jsonl'
+
+
+def new_hasher(algorithm: str):
+    """
+    Creates a hash object.
+
+    Args:
+        algorithm: blake2b or xxh3.
+
+    Returns:
+        Object with the update and hexdigest methods of hashlib objects.
+    """
+    if algorithm == 'blake2b':
+        return hashlib.blake2b(digest_size=32)
+    if algorithm == 'xxh3':
+        import xxhash
+        return xxhash.xxh3_128()
+    raise ValueError(f"Unknown checksum algorithm {algorithm}. "
+                     f"Choose from none, blake2b, xxh3.")
+
+
+def format_digest(algorithm: str, hasher) -> str:
+    return f"{algorithm}:{hasher.hexdigest()}"
+
+
+def digest_algorithm(digest: str) -> str:
+    """Determines the algorithm of a checksum in the format of manifests."""
+    return digest.split(':', 1)[0]
+
+
+class ChecksumError(OSError):
+    """Raised when a restored file does not match its recorded checksum."""
+
+
+def file_digest(path: Path, algorithm: str) -> str:
+    """
+    Computes the checksum of a file by reading it.
+
+    Args:
+        path: Path of the file.
+        algorithm: blake2b or xxh3.
+
+    Returns:
+        Checksum in the format used in manifests.
+    """
+    hasher = new_hasher(algorithm)
+    with path.open('rb') as f:
+        while block := f.read(1024 * 1024):
+            hasher.update(block)
+    return format_digest(algorithm, hasher)
+
+
+class Manifest():
+    """
+    Manifest of a backup under construction.
+
+    Entries are keyed by the path of the stored file relative to the root of
+    the backup. Sizes, modification times and checksums are those of the
+    source, so they also describe compressed files.
+    """
+    @classmethod
+    def from_config(cls, config: ConfigParser, backup_path: Path,
+                    previous_path: Path | None = None):
+        previous = {}
+        if previous_path is not None:
+            previous = read_manifest(previous_path)
+        return cls(backup_path, config['settings']['checksum'], previous)
+
+    def __init__(self, backup_path: Path, algorithm: str,
+                 previous: dict[str, dict] | None = None):
+        self.root: Path = backup_path
+        self.algorithm: str = algorithm
+        self.previous: dict[str, dict] = previous or {}
+        self.entries: dict[str, dict] = {}
+        self.lock: Lock = Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.algorithm != 'none'
+
+    def new_hasher(self):
+        """Returns a hash object, or None if checksums are disabled."""
+        if not self.enabled:
+            return None
+        return new_hasher(self.algorithm)
+
+    def format_digest(self, hasher) -> str | None:
+        if hasher is None:
+            return None
+        return format_digest(self.algorithm, hasher)
+
+    def key(self, stored) -> str:
+        return os.path.relpath(stored, self.root)
+
+    def previous_digest(self, stored) -> str | None:
+        """
+        Looks up the checksum of a file in the manifest of the previous
+        backup, for files that are hard linked from it.
+
+        Args:
+            stored: Path of the file in the ongoing backup.
+
+        Returns:
+            Checksum of the file in the previous backup, or None if unknown.
+        """
+        entry = self.previous.get(self.key(stored))
+        if entry is None or not self.is_current(entry['digest']):
+            return None
+        return entry['digest']
+
+    def is_current(self, digest: str | None) -> bool:
+        """Checks if a digest was computed with the configured algorithm."""
+        return (self.enabled and digest is not None
+                and digest.startswith(f"{self.algorithm}:"))
+
+    def add(self, stored, size: int, mtime_ns: int,
+            digest: str | None) -> None:
+        """
+        Adds a stored file to the manifest.
+
+        Args:
+            stored: Path the file was written to.
+            size: Size of the source file.
+            mtime_ns: Modification time of the source file.
+            digest: Checksum of the source file, or None if unknown.
+        """
+        entry = {'path': self.key(stored),
+                 'size': size,
+                 'mtime_ns': mtime_ns,
+                 'digest': digest}
+        with self.lock:
+            self.entries[entry['path']] = entry
+
+    def write(self) -> Path:
+        """
+        Writes the manifest, sorted by path.
+
+        Returns:
+            Path of the written manifest.
+        """
+        manifest_path = write_manifest(self.root, self.entries)
+        logger.info(f"Manifest of {len(self.entries)} files written to "
+                    f"{manifest_path}.")
+        return manifest_path
+
+
+def write_manifest(backup_path: Path, entries: dict[str, dict]) -> Path:
+    """
+    Atomically replaces the manifest of a backup.
+
+    Args:
+        backup_path: Root path of the backup.
+        entries: Manifest entries keyed by their path relative to
+            backup_path.
+
+    Returns:
+        Path of the written manifest.
+    """
+    manifest_path = backup_path / MANIFEST_NAME
+    tmp_path = manifest_path.with_suffix('.tmp')
+    with tmp_path.open('w') as f:
+        for key in sorted(entries):
+            f.write(json.dumps(entries[key]) + '\n')
+    tmp_path.replace(manifest_path)
+    return manifest_path
+
+
+def read_manifest(backup_path: Path) -> dict[str, dict]:
+    """
+    Reads the manifest of a completed backup.
+
+    Args:
+        backup_path: Root path of the backup.
+
+    Returns:
+        Manifest entries keyed by their path relative to backup_path. Empty if
+        the backup has no manifest.
+    """
+    entries = {}
+    try:
+        with (backup_path / MANIFEST_NAME).open('r') as f:
+            for line in f:
+                entry = json.loads(line)
+                entries[entry['path']] = entry
+    except FileNotFoundError:
+        pass
+    return entries
@@ -0,0 +1,305 @@
+"""
+Measures the phases of every backup run.
+
+Every run is appended as a JSON line to the run history next to paths.info,
+with the duration, bytes read and written, file count, throughput, retries,
+throttled time and peak memory use of each phase. The last run can also be
+written in the textfile format of the Prometheus node_exporter, together with
+the median duration of every phase over the previous successful runs, so an
+alert can fire when a phase gets much slower than usual.
+"""
+
+import json
+import os
+import resource
+import statistics
+from collections.abc import Iterator
+from configparser import ConfigParser
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+from logging import getLogger
+from pathlib import Path
+from threading import Lock
+from time import monotonic
+from zoneinfo import ZoneInfo
+
+from digibankup.util import format_filesize
+
+logger = getLogger(__name__)
+
+# Amount of previous successful runs the median durations are taken over.
+MEDIAN_RUNS = 10
+
+PHASE_FIELDS = ('duration', 'bytes_read', 'bytes_written', 'files', 'linked',
+                'retries', 'throttled', 'peak_rss', 'success')
+
+# Prometheus metric name, help text and PhaseMetrics field of every phase
+# metric.
+PHASE_GAUGES = (
+    ('duration_seconds', 'Duration of the phase.', 'duration'),
+    ('read_bytes', 'Bytes read from the source.', 'bytes_read'),
+    ('written_bytes', 'Bytes written to the backup.', 'bytes_written'),
+    ('files', 'Files in the backup.', 'files'),
+    ('linked_files', 'Files hard linked from the previous backup.', 'linked'),
+    ('retries', 'Retried requests.', 'retries'),
+    ('throttled_seconds', 'Time reads waited for the throttle, summed over '
+     'threads.',
+     'throttled'),
+    ('peak_rss_bytes', 'Peak resident memory of the process at the end of '
+     'the phase.', 'peak_rss'),
+    ('throughput_bytes_per_second', 'Bytes read per second.', 'throughput'),
+    ('success', 'Whether the phase succeeded.', 'success'),
+)
+
+
+def peak_rss() -> int:
+    """Returns the peak resident memory of the process in bytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@dataclass
+class PhaseMetrics:
+    """
+    Metrics of one phase of a backup. Safe to update from several threads.
+    """
+    duration: float = 0
+    bytes_read: int = 0
+    bytes_written: int = 0
+    files: int = 0
+    linked: int = 0
+    retries: int = 0
+    throttled: float = 0
+    peak_rss: int = 0
+    success: bool = True
+    lock: Lock = field(default_factory=Lock, repr=False, compare=False)
+
+    @property
+    def throughput(self) -> float:
+        if not self.duration:
+            return 0
+        return self.bytes_read / self.duration
+
+    def add_file(self, bytes_read: int = 0, bytes_written: int = 0,
+                 linked: bool = False) -> None:
+        """
+        Counts a file of the phase.
+
+        Args:
+            bytes_read: Bytes read from the source for the file.
+            bytes_written: Bytes written to the backup for the file.
+            linked: Whether the file was hard linked instead of copied.
+        """
+        with self.lock:
+            self.files += 1
+            self.linked += linked
+            self.bytes_read += bytes_read
+            self.bytes_written += bytes_written
+
+    def to_dict(self) -> dict:
+        return ({key: getattr(self, key) for key in PHASE_FIELDS}
+                | {'throughput': self.throughput})
+
+
+class RunMetrics():
+    """Metrics of a backup run, by phase."""
+    @classmethod
+    def from_config(cls, config: ConfigParser):
+        textfile = config['paths']['prometheus_textfile']
+        return cls(Path(config['paths']['history']),
+                   Path(textfile) if textfile else None,
+                   ZoneInfo(config['settings']['timezone']))
+
+    def __init__(self, history_path: Path, textfile_path: Path | None,
+                 timezone: ZoneInfo):
+        self.history_path: Path = history_path
+        self.textfile_path: Path | None = textfile_path
+        self.timezone: ZoneInfo = timezone
+        self.started: datetime = datetime.now(timezone)
+        self.start: float = monotonic()
+        self.finished: datetime | None = None
+        self.duration: float = 0
+        self.success: bool = False
+        self.phases: dict[str, PhaseMetrics] = {}
+        self.lock: Lock = Lock()
+
+    def phase(self, name: str) -> PhaseMetrics:
+        """Returns the metrics of a phase, creating them if needed."""
+        with self.lock:
+            return self.phases.setdefault(name, PhaseMetrics())
+
+    @contextmanager
+    def measure(self, name: str) -> Iterator[PhaseMetrics]:
+        """
+        Measures the duration and peak memory use of a phase.
+
+        Args:
+            name: Name of the phase.
+
+        Yields:
+            The metrics of the phase. The phase is marked as failed if the
+            block raises.
+        """
+        phase = self.phase(name)
+        start = monotonic()
+        try:
+            yield phase
+        except BaseException:
+            phase.success = False
+            raise
+        finally:
+            phase.duration = monotonic() - start
+            phase.peak_rss = peak_rss()
+
+    def finish(self, success: bool) -> None:
+        self.finished = datetime.now(self.timezone)
+        self.duration = monotonic() - self.start
+        self.success = success
+
+    def to_dict(self) -> dict:
+        return {'started': self.started.isoformat(),
+                'finished': self.finished and self.finished.isoformat(),
+                'duration': self.duration,
+                'success': self.success,
+                'peak_rss': peak_rss(),
+                'phases': {name: phase.to_dict()
+                           for name, phase in self.phases.items()}}
+
+    def write(self) -> None:
+        """Appends the run to the history and writes the textfile if set."""
+        run = self.to_dict()
+        history = read_history(self.history_path)
+        try:
+            self.history_path.parent.mkdir(parents=True, exist_ok=True)
+            with self.history_path.open('a') as f:
+                f.write(json.dumps(run) + '\n')
+        except OSError as e:
+            logger.error(f"Could not write run history {self.history_path}.",
+                         exc_info=e)
+
+        for name, phase in run['phases'].items():
+            logger.info(f"Phase {name}: {phase['duration']:.1f} s, "
+                        f"{phase['files']} files, "
+                        f"{format_filesize(phase['bytes_read'])} read, "
+                        f"{format_filesize(phase['bytes_written'])} written.")
+
+        if self.textfile_path is not None:
+            try:
+                write_textfile(self.textfile_path, run, history)
+            except OSError as e:
+                logger.error(f"Could not write Prometheus textfile "
+                             f"{self.textfile_path}.", exc_info=e)
+
+
+def read_history(history_path: Path) -> list[dict]:
+    """
+    Reads the run history.
+
+    Args:
+        history_path: Path of the run history.
+
+    Returns:
+        Every recorded run, from oldest to newest. Lines that cannot be
+        parsed are skipped.
+    """
+    runs = []
+    try:
+        with history_path.open('r') as f:
+            for line in f:
+                try:
+                    runs.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return runs
+
+
+def last_success(history: list[dict]) -> str | None:
+    """
+    Finds the end of the last successful run.
+
+    Args:
+        history: Runs from oldest to newest, as returned by read_history.
+
+    Returns:
+        ISO 8601 time the last successful run finished, or None.
+    """
+    for run in reversed(history):
+        if run.get('success') and run.get('finished'):
+            return run['finished']
+    return None
+
+
+def median_durations(history: list[dict]) -> dict[str, float]:
+    """
+    Determines the median duration of every phase in previous runs.
+
+    Args:
+        history: Runs from oldest to newest, as returned by read_history.
+
+    Returns:
+        Median duration per phase over the last MEDIAN_RUNS successful runs.
+    """
+    durations: dict[str, list[float]] = {}
+    for run in [run for run in history if run.get('success')][-MEDIAN_RUNS:]:
+        for name, phase in run.get('phases', {}).items():
+            durations.setdefault(name, []).append(phase['duration'])
+    return {name: statistics.median(values)
+            for name, values in durations.items()}
+
+
+def write_textfile(textfile_path: Path, run: dict,
+                   history: list[dict]) -> None:
+    """
+    Writes a run in the textfile format of the node_exporter.
+
+    The file is replaced atomically, so the node_exporter never reads a
+    partial file.
+
+    Args:
+        textfile_path: Path of the .prom file.
+        run: The run, as returned by RunMetrics.to_dict.
+        history: Previous runs, as returned by read_history.
+    """
+    lines = []
+
+    def gauge(name: str, description: str, samples: list[tuple[str, float]]):
+        lines.append(f"# HELP digibankup_{name} {description}")
+        lines.append(f"# TYPE digibankup_{name} gauge")
+        for labels, value in samples:
+            lines.append(f"digibankup_{name}{labels} {float(value)}")
+
+    finished = datetime.fromisoformat(run['finished'] or run['started'])
+    gauge('last_run_timestamp_seconds', 'End of the last run.',
+          [('', finished.timestamp())])
+    gauge('last_run_success', 'Whether the last run succeeded.',
+          [('', run['success'])])
+    gauge('last_run_duration_seconds', 'Duration of the last run.',
+          [('', run['duration'])])
+    if run['success']:
+        gauge('last_success_timestamp_seconds',
+              'End of the last successful run.', [('', finished.timestamp())])
+    else:
+        previous = last_success(history)
+        if previous is not None:
+            gauge('last_success_timestamp_seconds',
+                  'End of the last successful run.',
+                  [('', datetime.fromisoformat(previous).timestamp())])
+
+    for name, description, key in PHASE_GAUGES:
+        gauge(f"phase_{name}", description,
+              [(f'{{phase="{phase}"}}', metrics[key])
+               for phase, metrics in run['phases'].items()])
+
+    medians = median_durations(history)
+    gauge('phase_median_duration_seconds',
+          f"Median duration of the phase over the last {MEDIAN_RUNS} "
+          f"successful runs before the last run.",
+          [(f'{{phase="{phase}"}}', median)
+           for phase, median in medians.items()])
+
+    textfile_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = textfile_path.with_name(textfile_path.name + '.tmp')
+    tmp_path.write_text('\n'.join(lines) + '\n')
+    os.replace(tmp_path, textfile_path)
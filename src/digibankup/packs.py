@@ -0,0 +1,266 @@
+"""
+Packs small files into tar segments with an index.
+
+A segment is a plain uncompressed tar file, so it can be unpacked with tar.
+The index entry of every packed file holds its segment, and the offset and
+size of its contents in that segment, so a single file is read back with one
+seek instead of scanning the segment.
+
+Trees with many small files, such as the snapins and reports, can be stored
+with their small files packed into the directory <tree>.packs next to the
+tree, which holds the segments and index.jsonl. Writing a handful of
+segments costs far fewer operations on the NAS than creating, writing and
+stamping every file on its own.
+"""
+
+import io
+import os
+import json
+import shutil
+import tarfile
+from pathlib import Path
+from threading import Lock
+from typing import BinaryIO, Callable
+
+PACKS_SUFFIX = '.packs'
+INDEX_NAME = 'index.jsonl'
+
+
+class PackWriter():
+    """
+    Streams files into consecutive tar segments.
+
+    A new segment is started once the current one reaches segment_size, so a
+    segment only exceeds it by its last file. Safe to use from several
+    threads.
+    """
+    def __init__(self, open_segment: Callable[[int], BinaryIO],
+                 segment_size: int, first_segment: int = 0):
+        """
+        Args:
+            open_segment: Opens segment number n for binary writing. The
+                returned file object only has to support write and close.
+            segment_size: Size in bytes after which a new segment starts.
+            first_segment: Number of the first segment.
+        """
+        self.open_segment: Callable[[int], BinaryIO] = open_segment
+        self.segment_size: int = segment_size
+        self.segment: int = first_segment - 1
+        self.f: BinaryIO | None = None
+        self.tar: tarfile.TarFile | None = None
+        self.lock: Lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *e):
+        self.close()
+
+    def finish_segment(self) -> None:
+        if self.tar is None:
+            return
+        try:
+            self.tar.close()
+        finally:
+            self.f.close()
+            self.tar = self.f = None
+
+    def add(self, path: Path | str, name: str) -> dict:
+        """
+        Adds a file, or a symlink as a symlink.
+
+        Args:
+            path: Path of the file.
+            name: Name of the file in the segment and the index.
+
+        Returns:
+            Index entry of the file, with its name as path, segment, offset,
+            size, mtime_ns and mode.
+
+        Raises:
+            OSError: Raised when the file cannot be read. Nothing is written
+                to the segment then, so other files can still be added.
+        """
+        with self.lock:
+            if self.tar is None or self.tar.offset >= self.segment_size:
+                self.finish_segment()
+                self.segment += 1
+                self.f = self.open_segment(self.segment)
+                self.tar = tarfile.open(fileobj=self.f, mode='w|',
+                                        format=tarfile.PAX_FORMAT)
+            st = os.lstat(path)
+            tarinfo = self.tar.gettarinfo(path, arcname=name)
+            data = None
+            if tarinfo.isreg():
+                # Read in full first, so a file that shrinks or vanishes
+                # cannot leave a partial member in the segment.
+                with open(path, 'rb') as f:
+                    data = f.read()
+                tarinfo.size = len(data)
+            header = tarinfo.tobuf(self.tar.format, self.tar.encoding,
+                                   self.tar.errors)
+            offset = self.tar.offset + len(header)
+            if data is not None:
+                self.tar.addfile(tarinfo, io.BytesIO(data))
+            else:
+                self.tar.addfile(tarinfo)
+            return {'path': name, 'segment': self.segment, 'offset': offset,
+                    'size': tarinfo.size, 'mtime_ns': st.st_mtime_ns,
+                    'mode': st.st_mode}
+
+    def close(self) -> None:
+        with self.lock:
+            self.finish_segment()
+
+
+def read_entry(f: BinaryIO, entry: dict) -> bytes:
+    """
+    Reads the contents of a packed file.
+
+    Args:
+        f: The segment of the file, opened for binary reading.
+        entry: Index entry of the file.
+
+    Returns:
+        Contents of the file.
+    """
+    f.seek(entry['offset'])
+    return f.read(entry['size'])
+
+
+def packs_path_of(tree_path: Path) -> Path:
+    """Determines where the packed small files of a tree are stored."""
+    return tree_path.with_name(tree_path.name + PACKS_SUFFIX)
+
+
+def segment_name(segment: int) -> str:
+    return f'{segment:05d}.tar'
+
+
+def read_index(packs_path: Path) -> list[dict]:
+    """Reads the index of packed files. Empty if there is none."""
+    try:
+        with (packs_path / INDEX_NAME).open('r') as f:
+            return [json.loads(line) for line in f]
+    except FileNotFoundError:
+        return []
+
+
+def write_index(packs_path: Path, entries: list[dict]) -> None:
+    """Atomically writes the index of packed files."""
+    index_path = packs_path / INDEX_NAME
+    tmp_path = index_path.with_suffix('.tmp')
+    with tmp_path.open('w') as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + '\n')
+    tmp_path.replace(index_path)
+
+
+def is_unchanged(entry: dict, name: str, st: os.stat_result) -> bool:
+    return (entry['path'] == name and entry['size'] == st.st_size
+            and entry['mtime_ns'] == st.st_mtime_ns
+            and entry['mode'] == st.st_mode)
+
+
+def pack_files(files: list[tuple[str, str, os.stat_result]],
+               packs_path: Path, segment_size: int,
+               previous_path: Path | None = None
+               ) -> tuple[list[dict], int, list[tuple[str, str, str]]]:
+    """
+    Packs files into segments, replacing earlier packs at packs_path.
+
+    The files are packed in the order of their names. Leading segments of
+    the previous backup that hold exactly the next files, unchanged, are hard
+    linked instead of written again, so a tree that only gained or changed
+    files near its end mostly costs links.
+
+    Args:
+        files: (path, name, stat result) of every file to pack.
+        packs_path: Directory to write the segments and index to.
+        segment_size: Size in bytes after which a new segment starts.
+        previous_path: Packs of the same tree in the previous backup.
+
+    Returns:
+        The index entries, how many files were in linked segments, and
+        (src, dst, reason) for every file that could not be packed. A file
+        that cannot be read does not stop the others from being packed.
+    """
+    files = sorted(files, key=lambda file: file[1])
+    if packs_path.exists():
+        shutil.rmtree(packs_path)
+    packs_path.mkdir(parents=True)
+
+    entries: list[dict] = []
+    segments: dict[int, list[dict]] = {}
+    if previous_path is not None:
+        for entry in read_index(previous_path):
+            segments.setdefault(entry['segment'], []).append(entry)
+
+    segment = 0
+    while segment in segments:
+        previous = segments[segment]
+        following = files[len(entries):len(entries) + len(previous)]
+        if (len(following) < len(previous)
+                or not all(is_unchanged(entry, name, st) for entry,
+                           (_, name, st) in zip(previous, following))):
+            break
+        try:
+            os.link(previous_path / segment_name(segment),
+                    packs_path / segment_name(segment))
+        except OSError:
+            break
+        entries += previous
+        segment += 1
+    linked = len(entries)
+
+    def open_segment(n: int) -> BinaryIO:
+        return (packs_path / segment_name(n)).open('wb')
+
+    errors = []
+    with PackWriter(open_segment, segment_size, segment) as packer:
+        for path, name, _ in files[linked:]:
+            try:
+                entries.append(packer.add(path, name))
+            except OSError as e:
+                errors.append((os.fspath(path),
+                               os.fspath(packs_path / name), str(e)))
+    write_index(packs_path, entries)
+    return entries, linked, errors
+
+
+def extract_files(packs_path: Path, dst: Path) -> list[tuple[str, str, str]]:
+    """
+    Restores packed files with their mode and modification time.
+
+    Args:
+        packs_path: Directory with the segments and index.
+        dst: Directory to restore the files into, at their names.
+
+    Returns:
+        (src, dst, reason) for every file that could not be restored.
+    """
+    errors = []
+    segments: dict[int, list[dict]] = {}
+    for entry in read_index(packs_path):
+        segments.setdefault(entry['segment'], []).append(entry)
+    for segment, entries in segments.items():
+        segment_path = packs_path / segment_name(segment)
+        try:
+            f = segment_path.open('rb')
+        except OSError as e:
+            errors += [(os.fspath(segment_path),
+                        os.fspath(dst / entry['path']), str(e))
+                       for entry in entries]
+            continue
+        with f:
+            for entry in entries:
+                path = dst / entry['path']
+                try:
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    path.write_bytes(read_entry(f, entry))
+                    os.chmod(path, entry['mode'] & 0o7777)
+                    os.utime(path, ns=(entry['mtime_ns'], entry['mtime_ns']))
+                except OSError as e:
+                    errors.append((os.fspath(segment_path), os.fspath(path),
+                                   str(e)))
+    return errors
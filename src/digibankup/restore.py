@@ -0,0 +1,362 @@
+"""
+Restores a snapshot to the FOG Project server.
+
+Every target is copied back concurrently with the copy functions of the
+backup, keeping holes in sparse images and the modes and modification times
+of the files. Compressed files are decompressed on the way, and files are
+checked against the checksums in the manifest of the snapshot in the same
+read pass. The database dump can be written to a file, imported through the
+web interface of the FOG server, or both.
+"""
+
+import os
+import shutil
+from configparser import ConfigParser
+from functools import partial
+from logging import getLogger
+from pathlib import Path
+from time import monotonic
+from typing import BinaryIO, Callable
+
+import digibankup.chunkstore as chunkstore
+import digibankup.dbdelta as dbdelta
+import digibankup.fog as fog
+import digibankup.packs as packs
+import digibankup.snapshots as snapshots
+from digibankup.compression import SUFFIXES, BLOCK_SIZE, open_decompressed
+from digibankup.manifest import (read_manifest, new_hasher, format_digest,
+                                 digest_algorithm, file_digest,
+                                 ChecksumError)
+from digibankup.scheduler import Scheduler, Task
+from digibankup.session import make_session, get_timeout
+from digibankup.transfer import copy_tree, copy_file, write_sparse
+
+logger = getLogger(__name__)
+
+# Targets of a restore and their keys in the subpaths section.
+TARGETS = {
+    'db': 'fog_db',
+    'images': 'fog_images',
+    'snapins': 'fog_snapins',
+    'reports': 'fog_reports',
+}
+# Form field of the database file on the import page of the FOG server.
+IMPORT_FIELD = 'dbFile'
+
+
+def find_snapshot(backups_path: Path, generation: int = 1,
+                  name: str | None = None) -> Path:
+    """
+    Determines the snapshot to restore.
+
+    Args:
+        backups_path: Directory containing the backups.
+        generation: 1 for the last completed backup, 2 for the one before...
+        name: If set, the name of the snapshot, overriding generation.
+
+    Returns:
+        Path of the snapshot.
+
+    Raises:
+        FileNotFoundError: Raised when there is no such snapshot.
+    """
+    if name is not None:
+        snapshot = backups_path / snapshots.SNAPSHOTS_DIR / name
+        if name not in snapshots.read_index(backups_path):
+            raise FileNotFoundError(f"No snapshot named {name} in "
+                                    f"{backups_path}.")
+        return snapshot
+    snapshot = snapshots.snapshot_path(backups_path, generation)
+    if snapshot is None:
+        raise FileNotFoundError(f"No snapshot {generation} in "
+                                f"{backups_path}.")
+    return snapshot
+
+
+def get_destinations(config: ConfigParser, fogsettings: dict | None,
+                     to: Path | None) -> dict[str, Path]:
+    """
+    Determines where every target is restored to.
+
+    Args:
+        config: Contains configuration settings for the backup.
+        fogsettings: Dictionary containing the values of .fogsettings file.
+            Only used if to is None.
+        to: If set, every target is restored under this directory at its
+            subpath, instead of to the FOG server. The database dump is only
+            written to a file if this is set.
+
+    Returns:
+        Destination of every target.
+    """
+    if to is not None:
+        return {target: to / config['subpaths'][subpath]
+                for target, subpath in TARGETS.items()}
+    return {'images': Path(fogsettings['storageLocation']),
+            'snapins': Path(config['paths']['fog_snapins']),
+            'reports': fog.get_webdirdest(fogsettings) / 'lib/reports'}
+
+
+def decompress_file(src: Path, dst: Path, hasher=None) -> None:
+    """
+    Decompresses a stored file and copies its metadata.
+
+    Args:
+        src: Stored file, with its compression suffix.
+        dst: Path to write the original contents to. Blocks of zeros are
+            left as holes.
+        hasher: If set, the original contents are added to this hash object.
+    """
+    with open_decompressed(src) as fsrc, dst.open('wb') as fdst:
+        while block := fsrc.read(BLOCK_SIZE):
+            if hasher is not None:
+                hasher.update(block)
+            write_sparse(fdst, block)
+        fdst.truncate()
+    shutil.copystat(src, dst)
+
+
+def is_compressed(stored: Path, entry: dict | None) -> bool:
+    """
+    Checks if a stored file was compressed by the backup.
+
+    A source file that already had a compression suffix is stored as-is,
+    with the size recorded in the manifest. Without a manifest, every file
+    with a compression suffix is taken to be compressed by the backup.
+
+    Args:
+        stored: Path of the stored file.
+        entry: Manifest entry of the file, or None.
+    """
+    if stored.suffix not in SUFFIXES.values():
+        return False
+    return entry is None or entry['size'] != stored.stat().st_size
+
+
+def copy_function_maker(snapshot: Path, entries: dict[str, dict],
+                        verify: bool = True) -> Callable:
+    """
+    Prepares a restoring copy_function for the transfer.copy_tree function.
+
+    Args:
+        snapshot: Root path of the snapshot being restored.
+        entries: Manifest of the snapshot.
+        verify: Whether to check files against their checksum in entries.
+
+    Returns:
+        copy_function that decompresses and verifies files.
+    """
+    def copy_function(src, dst, *, follow_symlinks=True, entry=None):
+        stored = Path(src)
+        entry = entries.get(os.path.relpath(stored, snapshot))
+        hasher = algorithm = None
+        if verify and entry is not None and entry.get('digest'):
+            algorithm = digest_algorithm(entry['digest'])
+            hasher = new_hasher(algorithm)
+
+        if is_compressed(stored, entry):
+            dst = Path(dst).with_suffix('')
+            decompress_file(stored, dst, hasher)
+        else:
+            copy_file(src, dst, follow_symlinks=follow_symlinks,
+                      hasher=hasher)
+        if (hasher is not None
+                and format_digest(algorithm, hasher) != entry['digest']):
+            raise ChecksumError(f"Checksum of {os.fspath(dst)} does not "
+                                f"match the manifest of {snapshot.name}.")
+        return dst
+    return copy_function
+
+
+def verify_packs(snapshot: Path, packs_path: Path,
+                 entries: dict[str, dict]) -> None:
+    """
+    Checks the segments of packed files against the manifest.
+
+    Raises:
+        ChecksumError: Raised when a segment does not match the manifest.
+    """
+    for path in sorted(packs_path.iterdir()):
+        entry = entries.get(os.path.relpath(path, snapshot))
+        if entry is None or not entry.get('digest'):
+            continue
+        digest = file_digest(path, digest_algorithm(entry['digest']))
+        if digest != entry['digest']:
+            raise ChecksumError(f"Checksum of {os.fspath(path)} does not "
+                                f"match the manifest of {snapshot.name}.")
+
+
+def restore_tree(config: ConfigParser, snapshot: Path, target: str,
+                 dst: Path, verify: bool = True) -> None:
+    """
+    Restores the images, snapins or reports of a snapshot.
+
+    Images that were stored in the chunk store are reassembled from it, and
+    packed small files are unpacked.
+
+    Args:
+        config: Contains configuration settings for the backup.
+        snapshot: Root path of the snapshot.
+        target: images, snapins or reports.
+        dst: Directory to restore the files into.
+        verify: Whether to check files against the manifest of the snapshot.
+
+    Raises:
+        FileNotFoundError: Raised when the snapshot does not contain target.
+        RuntimeError: Raised when files could not be restored.
+    """
+    src = snapshot / config['subpaths'][TARGETS[target]]
+    workers = int(config['settings']['copy_workers'])
+    manifest_path = chunkstore.manifest_path_of(src)
+
+    logger.info(f"== Restoring {target} from {snapshot.name} to {dst}. ==")
+    start = monotonic()
+    dst.mkdir(parents=True, exist_ok=True)
+    if manifest_path.is_file():
+        errors = chunkstore.extract_tree(
+            chunkstore.ChunkStore.from_config(config), manifest_path, dst,
+            workers, verify)
+    else:
+        entries = read_manifest(snapshot)
+        copy_function = copy_function_maker(snapshot, entries, verify)
+        errors = copy_tree(src, dst, copy_function, workers)
+        packs_path = packs.packs_path_of(src)
+        if packs_path.is_dir():
+            if verify:
+                verify_packs(snapshot, packs_path, entries)
+            errors += packs.extract_files(packs_path, dst)
+
+    fog.log_copy_errors(errors)
+    if errors:
+        raise RuntimeError(f"Could not restore {len(errors)} {target} "
+                           f"files.")
+    logger.info(f"Restored {target} to {dst} in "
+                f"{monotonic() - start:.1f} s.")
+
+
+def import_db(config: ConfigParser, fogsettings: dict,
+              dump: BinaryIO) -> None:
+    """
+    Uploads a database dump to the import page of the FOG server.
+
+    Args:
+        config: Contains configuration settings for the backup.
+        fogsettings: Dictionary containing the values of .fogsettings file.
+        dump: The SQL dump, opened for binary reading.
+
+    Raises:
+        requests.HTTPError: Raised when the server refuses the import.
+    """
+    url = (f"http://{fogsettings['ipaddress']}/{fogsettings['webroot']}/"
+           f"{config['settings']['fog_db_import_path']}")
+    logger.info(f"Importing the FOG Project SQL database through {url}.")
+    with make_session(config, pool_size=1) as session:
+        response = session.post(url, data={'importbtn': '1'},
+                                files={IMPORT_FIELD: ('db.sql', dump)},
+                                timeout=get_timeout(config))
+        response.raise_for_status()
+    logger.info("FOG Project SQL database imported.")
+
+
+def restore_db(config: ConfigParser, snapshot: Path, dst: Path | None,
+               fogsettings: dict | None = None, verify: bool = True) -> None:
+    """
+    Restores the database dump of a snapshot.
+
+    Args:
+        config: Contains configuration settings for the backup.
+        snapshot: Root path of the snapshot.
+        dst: If set, the dump is written to this file.
+        fogsettings: If set, the dump is imported into the FOG server it
+            describes.
+        verify: Whether to check the dump against the manifest of the
+            snapshot. Dumps stored as deltas are always checked.
+
+    Raises:
+        ChecksumError: Raised when the dump does not match the manifest.
+        FileNotFoundError: Raised when the snapshot has no dump.
+    """
+    subpath = config['subpaths']['fog_db']
+    logger.info(f"== Restoring FOG Project SQL database from "
+                f"{snapshot.name}. ==")
+    stored = dbdelta.find_dump(snapshot, subpath)
+    entry = None
+    if stored is not None:
+        entry = read_manifest(snapshot).get(os.path.relpath(stored,
+                                                            snapshot))
+    with dbdelta.open_dump(snapshot, subpath) as dump:
+        if verify and entry is not None and entry.get('digest'):
+            algorithm = digest_algorithm(entry['digest'])
+            hasher = new_hasher(algorithm)
+            while block := dump.read(BLOCK_SIZE):
+                hasher.update(block)
+            if format_digest(algorithm, hasher) != entry['digest']:
+                raise ChecksumError(f"Checksum of the dump of "
+                                    f"{snapshot.name} does not match its "
+                                    f"manifest.")
+
+        if dst is not None:
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = dst.with_name(dst.name + '.part')
+            dump.seek(0)
+            with tmp_path.open('wb') as f:
+                shutil.copyfileobj(dump, f, BLOCK_SIZE)
+            tmp_path.replace(dst)
+            logger.info(f"FOG Project SQL database written to {dst}.")
+        if fogsettings is not None:
+            dump.seek(0)
+            import_db(config, fogsettings, dump)
+
+
+def restore(config: ConfigParser, snapshot: Path, targets: list[str],
+            to: Path | None = None, import_database: bool = False,
+            verify: bool = True) -> None:
+    """
+    Restores targets of a snapshot concurrently.
+
+    The copies use the source and destination resources of the scheduler,
+    and the import of the database the http resource, like the backup.
+
+    Args:
+        config: Contains configuration settings for the backup.
+        snapshot: Root path of the snapshot.
+        targets: Keys of TARGETS to restore.
+        to: If set, every target is restored under this directory instead of
+            to the FOG server.
+        import_database: Whether to import the database dump into the FOG
+            server.
+        verify: Whether to check files against the manifest of the snapshot.
+
+    Raises:
+        ValueError: Raised when the database is restored without to or
+            import_database, so there is nowhere to restore it to.
+        RuntimeError: Raised when a target could not be restored.
+    """
+    if 'db' in targets and to is None and not import_database:
+        raise ValueError("Restoring the database needs a directory to "
+                         "restore to or an import into the FOG server.")
+
+    fogsettings = None
+    if to is None or import_database:
+        fogsettings = fog.get_fogsettings(config)
+    destinations = get_destinations(config, fogsettings, to)
+
+    scheduler = Scheduler.from_config(config)
+    for target in targets:
+        if target == 'db':
+            resources = ('destination', 'http') if import_database else (
+                'destination',)
+            scheduler.add(Task('db', partial(
+                restore_db, config, snapshot, destinations.get('db'),
+                fogsettings if import_database else None, verify),
+                resources=resources))
+        else:
+            scheduler.add(Task(target, partial(
+                restore_tree, config, snapshot, target,
+                destinations[target], verify),
+                resources=('source', 'destination')))
+
+    failures = scheduler.run()
+    if failures:
+        raise RuntimeError(f"Could not restore {', '.join(failures)}.")
+    logger.info(f"Restored {', '.join(targets)} from {snapshot.name}.")
@@ -0,0 +1,383 @@
+"""
+Decides which snapshots to keep.
+
+Besides the newest settings.backup_count snapshots, the newest snapshot of
+each of the last keep_daily days, keep_weekly weeks and keep_monthly months
+is kept. On top of that, settings.max_backups_gb and min_free_percent expire
+the oldest kept snapshots, but never the newest one, until the backups fit.
+
+The space a snapshot takes is not the size of its files, because unchanged
+files are hard links shared with the snapshots around it, and images share
+chunks. The allocated size and link count of every inode of a snapshot are
+cached in the sizes directory, so a snapshot is only walked once, or again
+after dbdelta rewrote its dump. Expiring a set of snapshots frees the inodes
+whose links all lie in that set, and the chunks only that set references.
+"""
+
+import os
+import json
+from collections import Counter
+from configparser import ConfigParser
+from dataclasses import dataclass, field
+from datetime import datetime
+from logging import getLogger
+from pathlib import Path
+from typing import Iterable
+
+import digibankup.chunkstore as chunkstore
+import digibankup.dbdelta as dbdelta
+import digibankup.snapshots as snapshots
+from digibankup.util import format_filesize
+from digibankup.walk import TreeWalker
+
+logger = getLogger(__name__)
+
+SIZES_DIR = 'sizes'
+GIGABYTE = 1024 ** 3
+# Rules of a policy, with the function that puts a snapshot in its period.
+PERIODS = {
+    'daily': lambda time: time.date(),
+    'weekly': lambda time: time.isocalendar()[:2],
+    'monthly': lambda time: (time.year, time.month),
+}
+
+
+@dataclass
+class Policy:
+    """
+    Rules deciding which snapshots to keep.
+
+    Attributes:
+        keep_last: Amount of newest snapshots to keep.
+        keep_daily: Amount of days to keep the newest snapshot of.
+        keep_weekly: Amount of weeks to keep the newest snapshot of.
+        keep_monthly: Amount of months to keep the newest snapshot of.
+        max_size: Bytes the backups may take. 0 is unlimited.
+        min_free_percent: Percentage of the filesystem of the backups to
+            keep free. 0 is no minimum.
+    """
+    keep_last: int
+    keep_daily: int = 0
+    keep_weekly: int = 0
+    keep_monthly: int = 0
+    max_size: int = 0
+    min_free_percent: float = 0
+
+    @classmethod
+    def from_config(cls, config: ConfigParser):
+        settings = config['settings']
+        return cls(
+            keep_last=int(settings['backup_count']),
+            keep_daily=int(settings['keep_daily']),
+            keep_weekly=int(settings['keep_weekly']),
+            keep_monthly=int(settings['keep_monthly']),
+            max_size=int(float(settings['max_backups_gb']) * GIGABYTE),
+            min_free_percent=float(settings['min_free_percent'])
+        )
+
+    @property
+    def limits_space(self) -> bool:
+        return self.max_size > 0 or self.min_free_percent > 0
+
+
+@dataclass
+class Plan:
+    """
+    Outcome of a policy.
+
+    Attributes:
+        names: Every snapshot, from newest to oldest.
+        keep: Rules that keep each kept snapshot.
+        expire: Snapshots to expire, from newest to oldest.
+        for_space: Snapshots among expire that only expire to meet the
+            space limits.
+        usage: Space taken by the snapshots, if it was computed.
+    """
+    names: list[str]
+    keep: dict[str, list[str]] = field(default_factory=dict)
+    expire: list[str] = field(default_factory=list)
+    for_space: list[str] = field(default_factory=list)
+    usage: 'Usage | None' = None
+
+
+class Usage():
+    """Space taken by snapshots, counting shared inodes and chunks once."""
+    def __init__(self, inodes: dict[str, dict[int, list[int]]],
+                 chunks: dict[str, set[str]], chunk_sizes: dict[str, int]):
+        """
+        Args:
+            inodes: Allocated bytes and links of every inode, by snapshot.
+            chunks: Digests of the chunks referenced, by snapshot.
+            chunk_sizes: Size of every chunk in the chunk store.
+        """
+        self.inodes: dict[str, dict[int, list[int]]] = inodes
+        self.chunks: dict[str, set[str]] = chunks
+        self.chunk_sizes: dict[str, int] = chunk_sizes
+        self.links: Counter = Counter()
+        self.sizes: dict[int, int] = {}
+        for snapshot_inodes in inodes.values():
+            for inode, (size, links) in snapshot_inodes.items():
+                self.links[inode] += links
+                self.sizes[inode] = size
+        self.references: Counter = Counter()
+        for snapshot_chunks in chunks.values():
+            self.references.update(snapshot_chunks)
+
+    def total(self) -> int:
+        """Bytes taken by all snapshots together."""
+        return (sum(self.sizes.values())
+                + sum(self.chunk_sizes.get(digest, 0)
+                      for digest in self.references))
+
+    def freed(self, names: Iterable[str]) -> int:
+        """Bytes freed by deleting a set of snapshots."""
+        links = Counter()
+        references = Counter()
+        for name in names:
+            for inode, (_, count) in self.inodes.get(name, {}).items():
+                links[inode] += count
+            references.update(self.chunks.get(name, ()))
+        return (sum(self.sizes[inode] for inode, count in links.items()
+                    if count == self.links[inode])
+                + sum(self.chunk_sizes.get(digest, 0)
+                      for digest, count in references.items()
+                      if count == self.references[digest]))
+
+
+def snapshot_time(name: str) -> datetime:
+    """Reads the time of a snapshot from its name."""
+    return datetime.strptime(name.split('-')[0], snapshots.NAME_FORMAT)
+
+
+def scan(snapshot: Path) -> dict[int, list[int]]:
+    """
+    Walks a snapshot.
+
+    Returns:
+        Allocated bytes and amount of links in the snapshot, by inode.
+    """
+    inodes: dict[int, list[int]] = {}
+    for visit in TreeWalker(snapshot):
+        if visit.entry is None:
+            continue
+        st = visit.entry.stat(follow_symlinks=False)
+        if st.st_ino in inodes:
+            inodes[st.st_ino][1] += 1
+        else:
+            inodes[st.st_ino] = [st.st_blocks * 512, 1]
+    return inodes
+
+
+def version_of(snapshot: Path) -> list[int] | None:
+    """
+    Identifies the state of a snapshot. Snapshots do not change, except
+    when dbdelta rewrites their dump, which replaces their manifest.
+    """
+    try:
+        st = os.stat(snapshot / 'manifest.jsonl')
+    except FileNotFoundError:
+        return None
+    return [st.st_ino, st.st_mtime_ns]
+
+
+def load_sizes(backups_path: Path, snapshot: Path) -> dict[int, list[int]]:
+    """
+    Reads the cached sizes of a snapshot, walking it if they are missing or
+    outdated.
+
+    Args:
+        backups_path: Directory containing the backups.
+        snapshot: Path of the snapshot.
+
+    Returns:
+        Allocated bytes and amount of links in the snapshot, by inode.
+    """
+    cache_path = backups_path / SIZES_DIR / f'{snapshot.name}.json'
+    version = version_of(snapshot)
+    try:
+        with cache_path.open('r') as f:
+            cached = json.load(f)
+        if cached['version'] == version:
+            return {int(inode): value
+                    for inode, value in cached['inodes'].items()}
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        pass
+
+    logger.info(f"Computing the size of snapshot {snapshot.name}.")
+    inodes = scan(snapshot)
+    cache_path.parent.mkdir(exist_ok=True)
+    tmp_path = cache_path.with_suffix('.tmp')
+    with tmp_path.open('w') as f:
+        json.dump({'version': version, 'inodes': inodes}, f)
+    tmp_path.replace(cache_path)
+    return inodes
+
+
+def prune_sizes(backups_path: Path, names: list[str]) -> None:
+    """Deletes the cached sizes of snapshots that are gone."""
+    sizes_path = backups_path / SIZES_DIR
+    if not sizes_path.is_dir():
+        return
+    for entry in sizes_path.iterdir():
+        if entry.stem not in names:
+            entry.unlink(missing_ok=True)
+
+
+def measure(config: ConfigParser, backups_path: Path,
+            names: list[str]) -> Usage:
+    """
+    Determines the space taken by snapshots.
+
+    Args:
+        config: Contains configuration settings for the backup.
+        backups_path: Directory containing the backups.
+        names: Names of the snapshots.
+
+    Returns:
+        The space accounting.
+    """
+    subpath = config['subpaths']['fog_images']
+    inodes = {}
+    chunks = {}
+    for name in names:
+        snapshot = backups_path / snapshots.SNAPSHOTS_DIR / name
+        inodes[name] = load_sizes(backups_path, snapshot)
+        chunks[name] = chunkstore.referenced_chunks([snapshot], subpath)
+    chunk_sizes = {}
+    if (backups_path / 'chunks').is_dir():
+        chunk_sizes = chunkstore.ChunkStore.from_config(config).index
+    return Usage(inodes, chunks, chunk_sizes)
+
+
+def keep_by_rules(names: list[str], policy: Policy) -> dict[str, list[str]]:
+    """
+    Applies the keep rules of a policy.
+
+    Args:
+        names: Names of the snapshots, from newest to oldest.
+        policy: The policy.
+
+    Returns:
+        Rules that keep each kept snapshot.
+    """
+    keep: dict[str, list[str]] = {}
+    for name in names[:policy.keep_last]:
+        keep[name] = ['last']
+    for rule, period_of in PERIODS.items():
+        amount = getattr(policy, f'keep_{rule}')
+        periods = []
+        for name in names:
+            if len(periods) >= amount:
+                break
+            period = period_of(snapshot_time(name))
+            if period in periods:
+                continue
+            periods.append(period)
+            keep.setdefault(name, []).append(rule)
+    return keep
+
+
+def plan(config: ConfigParser, backups_path: Path,
+         usage: bool = False) -> Plan:
+    """
+    Applies the retention policy of the configuration to the snapshots,
+    without changing anything.
+
+    Args:
+        config: Contains configuration settings for the backup.
+        backups_path: Directory containing the backups.
+        usage: Whether to compute the space taken by the snapshots, even if
+            the policy does not limit space.
+
+    Returns:
+        The plan.
+    """
+    policy = Policy.from_config(config)
+    names = snapshots.read_index(backups_path)
+    result = Plan(names, keep_by_rules(names, policy))
+    result.expire = [name for name in names if name not in result.keep]
+    if not (usage or policy.limits_space) or not names:
+        return result
+
+    result.usage = measure(config, backups_path, names)
+    if not policy.limits_space:
+        return result
+
+    total = result.usage.total()
+    fs = os.statvfs(backups_path)
+    capacity = fs.f_blocks * fs.f_frsize
+    available = fs.f_bavail * fs.f_frsize
+
+    def over_limits(freed: int) -> bool:
+        if policy.max_size and total - freed > policy.max_size:
+            return True
+        return bool(policy.min_free_percent and capacity
+                    and (available + freed) * 100 / capacity
+                    < policy.min_free_percent)
+
+    freed = result.usage.freed(result.expire)
+    for name in reversed(names[1:]):
+        if not over_limits(freed):
+            break
+        if name not in result.keep:
+            continue
+        del result.keep[name]
+        result.for_space.append(name)
+        result.expire = [n for n in names if n not in result.keep]
+        freed = result.usage.freed(result.expire)
+    if over_limits(freed):
+        logger.warning("The backups exceed the space limits even with only "
+                       "the newest snapshot left.")
+    return result
+
+
+def describe(result: Plan) -> list[str]:
+    """Lists every snapshot with its exclusive size and fate."""
+    lines = []
+    for name in result.names:
+        size = ''
+        if result.usage is not None:
+            size = format_filesize(result.usage.freed([name]))
+        if name in result.keep:
+            fate = f"keep ({', '.join(result.keep[name])})"
+        elif name in result.for_space:
+            fate = "expire (space)"
+        else:
+            fate = "expire"
+        lines.append(f"{name:<20}{size:>10}  {fate}")
+    if result.usage is not None:
+        lines.append(f"Total {format_filesize(result.usage.total())}, "
+                     f"{format_filesize(result.usage.freed(result.expire))} "
+                     f"freed by expiring {len(result.expire)} snapshots.")
+    return lines
+
+
+def apply(config: ConfigParser, backups_path: Path, result: Plan) -> None:
+    """
+    Expires the snapshots of a plan.
+
+    The expired snapshots are moved to the trash at once, and deleted later
+    in the background or by snapshots.empty_trash. Database deltas based on
+    them are re-encoded first, and the chunks only they referenced are
+    deleted.
+
+    Args:
+        config: Contains configuration settings for the backup.
+        backups_path: Directory containing the backups.
+        result: The plan.
+    """
+    if result.for_space:
+        logger.info(f"Expiring snapshots {', '.join(result.for_space)} to "
+                    f"meet the space limits.")
+    if config['settings']['fog_db_storage'] == 'delta':
+        dbdelta.rebase(backups_path, config['subpaths']['fog_db'],
+                       result.expire)
+    snapshots.expire(backups_path, result.expire)
+    prune_sizes(backups_path, snapshots.read_index(backups_path))
+
+    if (backups_path / 'chunks').is_dir():
+        store = chunkstore.ChunkStore.from_config(config)
+        # An interrupted backup in ./0 keeps its chunks for its resume.
+        store.collect_garbage(chunkstore.referenced_chunks(
+            snapshots.snapshot_paths(backups_path) + [backups_path / '0'],
+            config['subpaths']['fog_images']))
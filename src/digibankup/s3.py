@@ -0,0 +1,639 @@
+"""
+Stores a copy of every backup in a bucket of an S3-compatible server.
+
+Requires the optional dependency boto3. Every backup becomes a snapshot
+under <prefix>snapshots/<name>/ in the bucket:
+
+    files/<path>       Large files, one object each.
+    packs/<n>.tar      Small files and symlinks, packed together, see packs.
+    catalog.jsonl      Every file of the snapshot with its size, modification
+                       time, mode, and object, or pack and offset.
+    chunks.txt         Chunks of the images referenced by the snapshot.
+
+Chunks of a chunk store are shared by the snapshots under <prefix>chunks/.
+<prefix>index.json lists the snapshots from newest to oldest, and
+<prefix>info.json holds the backups_info of the last backup. The index is
+only replaced once a snapshot is complete, so an interrupted backup leaves
+no trace but objects that the next rotation removes.
+
+Large files copied from the FOG server are uploaded while they are read,
+as multipart uploads whose parts are uploaded in parallel. Large files that
+did not change since the previous snapshot are copied inside the bucket.
+"""
+
+import io
+import json
+import os
+import stat
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from configparser import ConfigParser
+from datetime import datetime
+from logging import getLogger
+from pathlib import Path
+from time import sleep
+from zoneinfo import ZoneInfo
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+import digibankup.chunkstore as chunkstore
+import digibankup.retention as retention
+from digibankup.destinations import Destination
+from digibankup.metrics import PhaseMetrics
+from digibankup.packs import PackWriter
+from digibankup.snapshots import NAME_FORMAT
+from digibankup.util import str_to_bool
+
+logger = getLogger(__name__)
+
+INDEX_KEY = 'index.json'
+INFO_KEY = 'info.json'
+SNAPSHOTS_PREFIX = 'snapshots/'
+CHUNKS_PREFIX = 'chunks/'
+# S3 refuses parts smaller than 5 MiB, except for the last one.
+MIN_PART_SIZE = 5 * 1024 * 1024
+# Parts of a single upload waiting to be sent, besides the one being filled.
+MAX_PENDING_PARTS = 2
+# Largest object that S3 copies with a single CopyObject request.
+MAX_COPY_SIZE = 5 * 1024 * 1024 * 1024
+# Maximum number of parts of a multipart upload.
+MAX_PARTS = 10000
+# Maximum number of keys per DeleteObjects request.
+DELETE_BATCH_SIZE = 1000
+# Keys of an s3 destination section, and their defaults.
+DEFAULTS = {
+    'type': 's3',
+    'bucket': None,
+    'prefix': '',
+    'endpoint_url': '',
+    'region': '',
+    'access_key_id': '',
+    'secret_access_key': '',
+    'backup_count': None,
+    'keep_daily': None,
+    'keep_weekly': None,
+    'keep_monthly': None,
+    'part_size': str(8 * 1024 * 1024),
+    'upload_workers': '4',
+    'small_file_size': str(1024 * 1024),
+    'pack_size': str(64 * 1024 * 1024),
+}
+# Retention settings that limit the space of local backups, and do not apply
+# to a bucket.
+SPACE_KEYS = ('max_backups_gb', 'min_free_percent')
+# Error codes that retrying does not fix.
+PERMANENT_ERRORS = {'NoSuchKey', 'NoSuchBucket', 'NoSuchUpload', 'NotFound',
+                    '404', 'AccessDenied', 'InvalidAccessKeyId',
+                    'SignatureDoesNotMatch'}
+
+
+class ObjectWriter():
+    """
+    Writable file object that streams its contents into an object.
+
+    The contents are cut into parts of part_size, which are uploaded in
+    parallel by the executor of the destination, each with its own retries.
+    At most MAX_PENDING_PARTS parts per writer wait for their upload, so
+    memory use is bounded by the part size. Contents of a single part are
+    uploaded with one request when the writer is closed.
+    """
+    def __init__(self, destination: 'S3Destination', key: str,
+                 min_size: int = 0):
+        """
+        Args:
+            destination: Destination of the object.
+            key: Key of the object.
+            min_size: Contents smaller than this are not uploaded at all, so
+                the destination can pack them instead.
+        """
+        self.destination: S3Destination = destination
+        self.key: str = key
+        self.min_size: int = min_size
+        self.buffer: bytearray = bytearray()
+        self.position: int = 0
+        self.upload_id: str | None = None
+        self.pending: deque[Future] = deque()
+        self.parts: list[dict] = []
+        self.uploaded: bool = False
+        self.closed: bool = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *e):
+        if e[0] is not None:
+            self.abort()
+        self.close()
+
+    def write(self, data: bytes) -> int:
+        self.buffer += data
+        self.position += len(data)
+        part_size = self.destination.part_size
+        while len(self.buffer) >= part_size:
+            self.submit(bytes(self.buffer[:part_size]))
+            del self.buffer[:part_size]
+        return len(data)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        """Moves forward over a hole, which is written as zeros."""
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        if offset < self.position or whence == os.SEEK_END:
+            raise io.UnsupportedOperation("Objects are written sequentially.")
+        self.fill(offset - self.position)
+        return self.position
+
+    def truncate(self, size: int) -> int:
+        """Extends the contents with zeros up to size."""
+        if size < self.position:
+            raise io.UnsupportedOperation("Objects are written sequentially.")
+        self.fill(size - self.position)
+        return size
+
+    def fill(self, length: int) -> None:
+        part_size = self.destination.part_size
+        while length > 0:
+            zeros = min(length, part_size)
+            self.write(bytes(zeros))
+            length -= zeros
+
+    def submit(self, data: bytes) -> None:
+        """Uploads a part in the background."""
+        destination = self.destination
+        try:
+            if self.upload_id is None:
+                self.upload_id = destination.call(
+                    'create_multipart_upload', Key=self.key)['UploadId']
+            number = len(self.parts) + len(self.pending) + 1
+            self.pending.append(destination.executor.submit(
+                destination.upload_part, self.key, self.upload_id, number,
+                data))
+            while len(self.pending) > MAX_PENDING_PARTS:
+                self.parts.append(self.pending.popleft().result())
+        except BaseException:
+            self.abort()
+            raise
+
+    def abort(self) -> None:
+        """Gives up on the object, removing its uploaded parts."""
+        if self.closed:
+            return
+        self.closed = True
+        self.buffer.clear()
+        for future in self.pending:
+            future.cancel()
+        if self.upload_id is None:
+            return
+        for future in self.pending:
+            if not future.cancelled():
+                future.exception()
+        try:
+            self.destination.call('abort_multipart_upload', Key=self.key,
+                                  UploadId=self.upload_id)
+        except OSError as e:
+            logger.warning(f"Could not abort the upload of {self.key}.",
+                           exc_info=e)
+
+    def close(self) -> None:
+        """
+        Uploads the rest of the contents and completes the object.
+
+        Raises:
+            OSError: Raised when the object could not be uploaded.
+        """
+        if self.closed:
+            return
+        try:
+            if self.upload_id is None:
+                if self.position < self.min_size:
+                    self.closed = True
+                    return
+                self.destination.call('put_object', Key=self.key,
+                                      Body=bytes(self.buffer))
+            else:
+                if self.buffer:
+                    self.submit(bytes(self.buffer))
+                while self.pending:
+                    self.parts.append(self.pending.popleft().result())
+                self.destination.call(
+                    'complete_multipart_upload', Key=self.key,
+                    UploadId=self.upload_id,
+                    MultipartUpload={'Parts': self.parts})
+        except BaseException:
+            self.abort()
+            raise
+        self.closed = True
+        self.uploaded = True
+        self.buffer = bytearray()
+
+
+class S3Destination(Destination):
+    """Bucket of an S3-compatible server that receives every backup."""
+    def __init__(self, name: str, config: ConfigParser,
+                 stats: PhaseMetrics | None = None):
+        """
+        Args:
+            name: Name of the destination.
+            config: Contains configuration settings for the backup.
+            stats: If set, the files of the destination are counted in it.
+
+        Raises:
+            ValueError: Raised when the section has no bucket, an unknown key
+                or a part size below the minimum of S3.
+        """
+        super().__init__(name, config, stats)
+        section = self.section
+        for key in section:
+            if key in SPACE_KEYS:
+                raise ValueError(f"Destination {name} cannot have {key}. "
+                                 f"Space limits do not apply to an s3 "
+                                 f"destination. Use backup_count, "
+                                 f"keep_daily, keep_weekly and keep_monthly "
+                                 f"instead.")
+            if key not in DEFAULTS:
+                raise ValueError(f"Unknown key {key} for destination {name}. "
+                                 f"Choose from {', '.join(DEFAULTS)}.")
+        if 'bucket' not in section:
+            raise ValueError(f"Destination {name} has no bucket.")
+        settings = config['settings']
+
+        def get(key: str) -> str:
+            return section.get(key, DEFAULTS[key])
+
+        self.bucket: str = section['bucket']
+        self.prefix: str = get('prefix')
+        if self.prefix and not self.prefix.endswith('/'):
+            self.prefix += '/'
+        self.policy: retention.Policy = retention.Policy(**{
+            f'keep_{rule}': int(section.get(key, settings[key]))
+            for rule, key in (('last', 'backup_count'),
+                              ('daily', 'keep_daily'),
+                              ('weekly', 'keep_weekly'),
+                              ('monthly', 'keep_monthly'))})
+        if any(float(settings[key]) for key in SPACE_KEYS):
+            logger.warning(f"The space limits {', '.join(SPACE_KEYS)} do "
+                           f"not apply to destination {name}.")
+        self.part_size: int = int(get('part_size'))
+        if self.part_size < MIN_PART_SIZE:
+            raise ValueError(f"part_size of destination {name} must be at "
+                             f"least {MIN_PART_SIZE} bytes.")
+        self.workers: int = int(get('upload_workers'))
+        self.small_file_size: int = int(get('small_file_size'))
+        self.pack_size: int = int(get('pack_size'))
+        self.incremental: bool = str_to_bool(settings['incremental'])
+        self.timezone: ZoneInfo = ZoneInfo(settings['timezone'])
+        self.attempts: int = int(settings['http_retries']) + 1
+        self.backoff: float = float(settings['http_backoff'])
+        self.client = boto3.client(
+            's3',
+            endpoint_url=get('endpoint_url') or None,
+            region_name=get('region') or None,
+            aws_access_key_id=get('access_key_id') or None,
+            aws_secret_access_key=get('secret_access_key') or None,
+            config=Config(max_pool_connections=max(10, 2 * self.workers)))
+        self.executor: ThreadPoolExecutor | None = None
+        self.snapshots: list[str] = []
+        self.snapshot: str | None = None
+        self.previous: dict[str, dict] = {}
+        self.writers: dict[str, ObjectWriter] = {}
+        self.chunks: set[str] = set()
+
+    def key(self, *parts: str) -> str:
+        return self.prefix + ''.join(parts)
+
+    def snapshot_key(self, snapshot: str, *parts: str) -> str:
+        return self.key(SNAPSHOTS_PREFIX, snapshot, '/', *parts)
+
+    def call(self, method: str, **kwargs) -> dict:
+        """
+        Sends a request about the bucket, retrying failures.
+
+        Args:
+            method: Name of the method of the boto3 client.
+            **kwargs: Arguments of the method besides Bucket.
+
+        Returns:
+            Response of the request.
+
+        Raises:
+            FileNotFoundError: Raised when the object does not exist.
+            OSError: Raised when every attempt failed.
+        """
+        for attempt in range(1, self.attempts + 1):
+            try:
+                return getattr(self.client, method)(Bucket=self.bucket,
+                                                    **kwargs)
+            except (BotoCoreError, ClientError) as e:
+                code = None
+                if isinstance(e, ClientError):
+                    code = e.response.get('Error', {}).get('Code')
+                if code in ('NoSuchKey', 'NotFound', '404'):
+                    raise FileNotFoundError(
+                        f"s3://{self.bucket}/{kwargs.get('Key')}") from e
+                if code in PERMANENT_ERRORS or attempt == self.attempts:
+                    raise OSError(f"{method} on bucket {self.bucket} failed "
+                                  f"after {attempt} attempts: {e}") from e
+                self.stats.retries += 1
+                wait = self.backoff * 2 ** (attempt - 1)
+                logger.warning(f"{method} on bucket {self.bucket} failed. "
+                               f"Retrying in {wait} seconds.", exc_info=e)
+                sleep(wait)
+
+    def upload_part(self, key: str, upload_id: str, number: int,
+                    data: bytes) -> dict:
+        response = self.call('upload_part', Key=key, UploadId=upload_id,
+                             PartNumber=number, Body=data)
+        return {'PartNumber': number, 'ETag': response['ETag']}
+
+    def upload_part_copy(self, key: str, upload_id: str, number: int,
+                         source: dict, first: int, last: int) -> dict:
+        response = self.call('upload_part_copy', Key=key,
+                             UploadId=upload_id, PartNumber=number,
+                             CopySource=source,
+                             CopySourceRange=f'bytes={first}-{last}')
+        return {'PartNumber': number,
+                'ETag': response['CopyPartResult']['ETag']}
+
+    def copy_key(self, key: str, source_key: str, size: int) -> None:
+        """
+        Copies an object inside the bucket.
+
+        Objects larger than MAX_COPY_SIZE are copied in parts, in parallel.
+
+        Args:
+            key: Key of the copy.
+            source_key: Key of the object to copy.
+            size: Size of the object in bytes.
+
+        Raises:
+            OSError: Raised when the object could not be copied.
+        """
+        source = {'Bucket': self.bucket, 'Key': source_key}
+        if size <= MAX_COPY_SIZE:
+            self.call('copy_object', Key=key, CopySource=source)
+            return
+        part_size = max(self.part_size, -(-size // MAX_PARTS))
+        upload_id = self.call('create_multipart_upload', Key=key)['UploadId']
+        futures = []
+        try:
+            for number, first in enumerate(range(0, size, part_size), 1):
+                futures.append(self.executor.submit(
+                    self.upload_part_copy, key, upload_id, number, source,
+                    first, min(first + part_size, size) - 1))
+            parts = [future.result() for future in futures]
+            self.call('complete_multipart_upload', Key=key,
+                      UploadId=upload_id, MultipartUpload={'Parts': parts})
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            for future in futures:
+                if not future.cancelled():
+                    future.exception()
+            try:
+                self.call('abort_multipart_upload', Key=key,
+                          UploadId=upload_id)
+            except OSError as e:
+                logger.warning(f"Could not abort the copy to {key}.",
+                               exc_info=e)
+            raise
+
+    def get_bytes(self, key: str) -> bytes | None:
+        """Downloads an object. None if it does not exist."""
+        try:
+            return self.call('get_object', Key=key)['Body'].read()
+        except FileNotFoundError:
+            return None
+
+    def put_bytes(self, key: str, data: bytes) -> None:
+        self.call('put_object', Key=key, Body=data)
+
+    def list_keys(self, prefix: str, delimiter: str | None = None
+                  ) -> list[str]:
+        """
+        Lists the keys, or with a delimiter the common prefixes, under a
+        prefix.
+        """
+        kwargs = {'Prefix': prefix}
+        if delimiter is not None:
+            kwargs['Delimiter'] = delimiter
+        keys = []
+        while True:
+            response = self.call('list_objects_v2', **kwargs)
+            keys += [entry['Key'] for entry in response.get('Contents', [])]
+            keys += [entry['Prefix']
+                     for entry in response.get('CommonPrefixes', [])]
+            if not response.get('IsTruncated'):
+                return keys
+            kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+    def delete_keys(self, keys: list[str]) -> None:
+        """Deletes objects in batches."""
+        for start in range(0, len(keys), DELETE_BATCH_SIZE):
+            batch = keys[start:start + DELETE_BATCH_SIZE]
+            response = self.call('delete_objects', Delete={
+                'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+            for error in response.get('Errors', []):
+                logger.warning(f"Could not delete {error['Key']}: "
+                               f"{error.get('Message')}")
+
+    def read_catalog(self, snapshot: str) -> dict[str, dict]:
+        """Reads the files of a snapshot, by path. Empty if unknown."""
+        data = self.get_bytes(self.snapshot_key(snapshot, 'catalog.jsonl'))
+        if data is None:
+            return {}
+        catalog = {}
+        for line in data.splitlines():
+            entry = json.loads(line)
+            catalog[entry['path']] = entry
+        return catalog
+
+    def prepare(self, source_root: Path) -> None:
+        """
+        Readies the destination for a backup.
+
+        Reads the index and the catalog of the previous snapshot.
+
+        Args:
+            source_root: Root path of the ongoing backup in paths.backups.
+        """
+        self.source_root = source_root
+        try:
+            data = self.get_bytes(self.key(INDEX_KEY))
+            if data is not None:
+                self.snapshots = json.loads(data)['snapshots']
+            name = datetime.now(self.timezone).strftime(NAME_FORMAT)
+            self.snapshot = name
+            number = 1
+            while self.snapshot in self.snapshots:
+                self.snapshot = f'{name}-{number}'
+                number += 1
+            if self.incremental and self.snapshots:
+                self.previous = self.read_catalog(self.snapshots[0])
+            self.executor = ThreadPoolExecutor(
+                self.workers, thread_name_prefix=f'destination_{self.name}')
+        except OSError as e:
+            self.fail(e)
+
+    def relative(self, path: Path | str) -> str:
+        return Path(os.path.relpath(path, self.source_root)).as_posix()
+
+    def open(self, path: Path) -> ObjectWriter | None:
+        """
+        Opens an object for a file that is being copied.
+
+        Small files are not uploaded while copying, but packed by complete.
+        """
+        if self.failed:
+            return None
+        rel = self.relative(path)
+        writer = ObjectWriter(self, self.snapshot_key(self.snapshot, 'files/',
+                                                      rel),
+                              self.small_file_size)
+        with self.lock:
+            self.writers[rel] = writer
+        return writer
+
+    def open_pack(self, segment: int) -> ObjectWriter:
+        return ObjectWriter(self, self.snapshot_key(self.snapshot, 'packs/',
+                                                    f'{segment:05d}.tar'))
+
+    def upload_file(self, path: str, key: str) -> None:
+        with open(path, 'rb') as src, ObjectWriter(self, key) as dst:
+            while data := src.read(self.part_size):
+                dst.write(data)
+
+    def upload_chunk(self, path: Path, key: str) -> None:
+        self.put_bytes(key, path.read_bytes())
+
+    def complete_file(self, path: str, packer: PackWriter) -> dict:
+        """
+        Stores a file of the ongoing backup in the snapshot.
+
+        Args:
+            path: Path of the file.
+            packer: Packs the small files of the snapshot.
+
+        Returns:
+            Catalog entry of the file.
+        """
+        rel = self.relative(path)
+        st = os.lstat(path)
+        entry = {'path': rel, 'size': st.st_size,
+                 'mtime_ns': st.st_mtime_ns, 'mode': st.st_mode}
+        writer = self.writers.get(rel)
+        if (writer is not None and writer.uploaded
+                and writer.position == st.st_size):
+            self.stats.add_file(0, st.st_size)
+            return entry | {'key': writer.key}
+
+        if stat.S_ISLNK(st.st_mode) or st.st_size < self.small_file_size:
+            packed = packer.add(path, rel)
+            self.stats.add_file(st.st_size, st.st_size)
+            return packed | {'pack': self.snapshot_key(
+                self.snapshot, 'packs/', f"{packed['segment']:05d}.tar")}
+
+        key = self.snapshot_key(self.snapshot, 'files/', rel)
+        previous = self.previous.get(rel)
+        if (previous is not None and 'key' in previous
+                and previous['size'] == st.st_size
+                and previous['mtime_ns'] == st.st_mtime_ns):
+            self.copy_key(key, previous['key'], st.st_size)
+            self.stats.add_file(linked=True)
+        else:
+            self.upload_file(path, key)
+            self.stats.add_file(st.st_size, st.st_size)
+        return entry | {'key': key}
+
+    def complete_chunks(self) -> None:
+        """Uploads the chunks of the images the bucket lacks."""
+        subpath = self.source_config['subpaths']['fog_images']
+        self.chunks = chunkstore.referenced_chunks([self.source_root],
+                                                   subpath)
+        if not self.chunks:
+            return
+        prefix = self.key(CHUNKS_PREFIX)
+        existing = {key[len(prefix):] for key in self.list_keys(prefix)}
+        missing = self.chunks.difference(existing)
+        store = chunkstore.ChunkStore.from_config(self.source_config)
+        futures = []
+        for digest in missing:
+            futures.append(self.executor.submit(
+                self.upload_chunk, store.chunk_path(digest), prefix + digest))
+            self.stats.add_file(store.index[digest], store.index[digest])
+        for future in futures:
+            future.result()
+        logger.info(f"Uploaded {len(missing)} chunks to destination "
+                    f"{self.name}.")
+
+    def complete(self) -> None:
+        if self.failed:
+            return
+        logger.info(f"== Completing backup at destination {self.name}. ==")
+        try:
+            catalog = []
+            with PackWriter(self.open_pack, self.pack_size) as packer:
+                for dirpath, dirnames, filenames in os.walk(self.source_root):
+                    dirnames.sort()
+                    for name in sorted(filenames):
+                        catalog.append(self.complete_file(
+                            os.path.join(dirpath, name), packer))
+                    for name in dirnames:
+                        if os.path.islink(os.path.join(dirpath, name)):
+                            catalog.append(self.complete_file(
+                                os.path.join(dirpath, name), packer))
+            self.complete_chunks()
+            self.put_bytes(self.snapshot_key(self.snapshot, 'chunks.txt'),
+                           ''.join(f'{digest}\n'
+                                   for digest in sorted(self.chunks)).encode())
+            self.put_bytes(self.snapshot_key(self.snapshot, 'catalog.jsonl'),
+                           ''.join(json.dumps(entry) + '\n'
+                                   for entry in catalog).encode())
+        except OSError as e:
+            self.fail(e)
+
+    def rotate(self, backups_info: dict) -> str:
+        """
+        Adds the completed snapshot to the index and expires the ones that
+        backup_count and the keep_daily, keep_weekly and keep_monthly rules
+        do not keep.
+
+        Also stores backups_info, with the time of this backup.
+        """
+        snapshots = [self.snapshot] + self.snapshots
+        keep = retention.keep_by_rules(snapshots, self.policy)
+        kept = [snapshot for snapshot in snapshots if snapshot in keep]
+        self.put_bytes(self.key(INDEX_KEY),
+                       json.dumps({'snapshots': kept}).encode())
+        info = dict(backups_info)
+        info['last_datetime'] = datetime.now(self.timezone).isoformat()
+        self.put_bytes(self.key(INFO_KEY), json.dumps(info).encode())
+
+        prefix = self.key(SNAPSHOTS_PREFIX)
+        for snapshot_prefix in self.list_keys(prefix, '/'):
+            snapshot = snapshot_prefix[len(prefix):].rstrip('/')
+            if snapshot in kept:
+                continue
+            logger.info(f"Removing snapshot {snapshot} from destination "
+                        f"{self.name}.")
+            self.delete_keys(self.list_keys(snapshot_prefix))
+
+        chunks_prefix = self.key(CHUNKS_PREFIX)
+        stored = self.list_keys(chunks_prefix)
+        if stored:
+            referenced = set()
+            for snapshot in kept:
+                data = self.get_bytes(self.snapshot_key(snapshot,
+                                                        'chunks.txt'))
+                referenced.update((data or b'').decode().split())
+            garbage = [key for key in stored
+                       if key[len(chunks_prefix):] not in referenced]
+            self.delete_keys(garbage)
+            logger.info(f"Removed {len(garbage)} unreferenced chunks from "
+                        f"destination {self.name}.")
+        return f's3://{self.bucket}/{self.snapshot_key(self.snapshot)}'
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
@@ -0,0 +1,191 @@
+"""
+Runs the parts of a backup concurrently.
+
+Every task names the resources it uses, such as the disk of the FOG server or
+the destination, and the tasks it has to wait for. A task starts as soon as
+its dependencies have finished and every resource it uses has a free slot, so
+an export waiting on the network overlaps with copies waiting on disk.
+"""
+
+from collections import Counter
+from concurrent.futures import (ThreadPoolExecutor, Future, wait,
+                                FIRST_COMPLETED)
+from configparser import ConfigParser
+from dataclasses import dataclass
+from logging import getLogger
+from time import monotonic
+from typing import Callable
+
+from digibankup.metrics import RunMetrics
+
+logger = getLogger(__name__)
+
+# Resources of the backup and the settings limiting how many tasks use them
+# at the same time.
+RESOURCES = {
+    'source': 'max_source_tasks',
+    'destination': 'max_destination_tasks',
+    'http': 'max_http_tasks',
+}
+
+
+class TaskSkipped(Exception):
+    """Raised for a task that did not run because a dependency failed."""
+
+
+@dataclass
+class Task:
+    """
+    Part of a backup.
+
+    Attributes:
+        name: Unique name of the task, used in logs and dependencies.
+        function: Performs the task. Called without arguments.
+        resources: Resources the task uses while it runs.
+        after: Names of the tasks that have to finish first.
+    """
+    name: str
+    function: Callable[[], None]
+    resources: tuple[str, ...] = ()
+    after: tuple[str, ...] = ()
+
+
+class Scheduler():
+    """Runs tasks concurrently within per-resource limits."""
+    @classmethod
+    def from_config(cls, config: ConfigParser,
+                    metrics: RunMetrics | None = None):
+        return cls({resource: int(config['settings'][setting])
+                    for resource, setting in RESOURCES.items()}, metrics)
+
+    def __init__(self, limits: dict[str, int],
+                 metrics: RunMetrics | None = None):
+        """
+        Args:
+            limits: Maximum amount of running tasks per resource. 0 or a
+                missing resource is unlimited.
+            metrics: If set, every task is measured as the phase of the same
+                name.
+        """
+        self.limits: dict[str, int] = limits
+        self.metrics: RunMetrics | None = metrics
+        self.tasks: dict[str, Task] = {}
+
+    def add(self, task: Task) -> None:
+        """
+        Adds a task to run.
+
+        Args:
+            task: The task.
+
+        Raises:
+            ValueError: Raised when a task with the same name was added.
+        """
+        if task.name in self.tasks:
+            raise ValueError(f"Task {task.name} was already added.")
+        self.tasks[task.name] = task
+
+    def available(self, task: Task, in_use: Counter) -> bool:
+        return all(not self.limits.get(resource)
+                   or in_use[resource] < self.limits[resource]
+                   for resource in task.resources)
+
+    def call(self, task: Task) -> None:
+        if self.metrics is None:
+            task.function()
+            return
+        with self.metrics.measure(task.name):
+            task.function()
+
+    def skip_failed(self, pending: dict[str, Task],
+                    failures: dict[str, BaseException]) -> None:
+        """Removes the pending tasks that depend on failed tasks."""
+        skipped = True
+        while skipped:
+            skipped = False
+            for task in list(pending.values()):
+                failed = [name for name in task.after if name in failures]
+                if failed:
+                    del pending[task.name]
+                    failures[task.name] = TaskSkipped(
+                        f"{', '.join(failed)} failed.")
+                    if self.metrics is not None:
+                        self.metrics.phase(task.name).success = False
+                    logger.error(f"Skipped {task.name} because "
+                                 f"{', '.join(failed)} failed.")
+                    skipped = True
+
+    def run(self) -> dict[str, BaseException]:
+        """
+        Runs all added tasks and waits for them to finish.
+
+        A failing task does not stop the others, but the tasks that depend
+        on it are skipped.
+
+        Returns:
+            The exception of every task that failed or was skipped, by name.
+
+        Raises:
+            ValueError: Raised when tasks depend on unknown tasks or on each
+                other in a cycle.
+        """
+        for task in self.tasks.values():
+            unknown = [name for name in task.after if name not in self.tasks]
+            if unknown:
+                raise ValueError(f"Task {task.name} depends on unknown tasks "
+                                 f"{', '.join(unknown)}.")
+
+        pending: dict[str, Task] = dict(self.tasks)
+        running: dict[Future, tuple[Task, float]] = {}
+        in_use: Counter = Counter()
+        finished: set[str] = set()
+        failures: dict[str, BaseException] = {}
+
+        with ThreadPoolExecutor(max_workers=max(len(self.tasks), 1),
+                                thread_name_prefix='task') as executor:
+            while pending or running:
+                self.skip_failed(pending, failures)
+                for task in list(pending.values()):
+                    if (all(name in finished for name in task.after)
+                            and self.available(task, in_use)):
+                        del pending[task.name]
+                        in_use.update(task.resources)
+                        running[executor.submit(self.call, task)] = (
+                            task, monotonic())
+
+                if not running:
+                    if pending:
+                        raise ValueError(f"Tasks {', '.join(pending)} depend "
+                                         f"on each other in a cycle.")
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task, start = running.pop(future)
+                    in_use.subtract(task.resources)
+                    elapsed = monotonic() - start
+                    exception = future.exception()
+                    if exception is not None:
+                        failures[task.name] = exception
+                        logger.error(f"Task {task.name} failed after "
+                                     f"{elapsed:.1f} s.", exc_info=exception)
+                    else:
+                        finished.add(task.name)
+                        logger.info(f"Task {task.name} finished in "
+                                    f"{elapsed:.1f} s.")
+        return failures
+
+
+def raise_failures(failures: dict[str, BaseException]) -> None:
+    """
+    Stops the backup if any task failed, so it is not promoted.
+
+    Args:
+        failures: Result of Scheduler.run.
+
+    Raises:
+        RuntimeError: Raised when failures is not empty.
+    """
+    if failures:
+        raise RuntimeError(f"Could not back up {', '.join(failures)}. The "
+                           f"next run resumes the backup.")
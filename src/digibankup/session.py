@@ -0,0 +1,105 @@
+"""Prepares pooled HTTP sessions shared by the backups of web servers."""
+
+from time import monotonic
+from logging import getLogger
+from typing import BinaryIO
+from configparser import ConfigParser
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from digibankup.util import format_filesize
+
+logger = getLogger(__name__)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+CHUNK_SIZE = 1024 * 1024
+PROGRESS_INTERVAL = 10
+
+
+def make_session(config: ConfigParser, pool_size: int = 4) -> requests.Session:
+    """
+    Creates a session that reuses connections and retries failed requests.
+
+    Failed connections and responses with a status in RETRY_STATUSES are
+    retried with exponential backoff, honouring Retry-After headers.
+
+    Args:
+        config: Contains configuration settings for the backup.
+        pool_size: Amount of connections kept open per host.
+
+    Returns:
+        Session to perform requests with.
+    """
+    retry = Retry(
+        total=int(config['settings']['http_retries']),
+        backoff_factor=float(config['settings']['http_backoff']),
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=None,
+        respect_retry_after_header=True
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          max_retries=retry)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_timeout(config: ConfigParser) -> tuple[float, float]:
+    """
+    Determines the timeouts of HTTP requests.
+
+    Args:
+        config: Contains configuration settings for the backup.
+
+    Returns:
+        Connect timeout and read timeout in seconds, as accepted by requests.
+    """
+    return (float(config['settings']['http_connect_timeout']),
+            float(config['settings']['http_read_timeout']))
+
+
+def download(response: requests.Response, f: BinaryIO,
+             tail_size: int = 4096, hasher=None) -> tuple[int, bytes]:
+    """
+    Streams the body of a response to a file in bounded chunks.
+
+    Logs the throughput every PROGRESS_INTERVAL seconds.
+
+    Args:
+        response: Response of a request performed with stream=True.
+        f: File object opened for binary writing.
+        tail_size: Amount of bytes at the end of the body to return.
+        hasher: If set, the body is added to this hash object.
+
+    Returns:
+        Amount of bytes written, and the last tail_size bytes of the body.
+
+    Raises:
+        requests.HTTPError: Raised when the response has an error status.
+    """
+    response.raise_for_status()
+
+    start = last_report = monotonic()
+    size = 0
+    tail = b''
+    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+        f.write(chunk)
+        if hasher is not None:
+            hasher.update(chunk)
+        size += len(chunk)
+        tail = (tail + chunk)[-tail_size:]
+        now = monotonic()
+        if now - last_report >= PROGRESS_INTERVAL:
+            last_report = now
+            logger.info(f"Received {format_filesize(size)} from "
+                        f"{response.url} at "
+                        f"{format_filesize(size / (now - start))}/s.")
+
+    elapsed = max(monotonic() - start, 1e-9)
+    logger.info(f"Received {format_filesize(size)} from {response.url} in "
+                f"{elapsed:.1f} s ({format_filesize(size / elapsed)}/s).")
+    return size, tail
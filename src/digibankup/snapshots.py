@@ -0,0 +1,240 @@
+"""
+Stores completed backups as immutable, timestamped snapshot directories.
+
+The index file lists the snapshots from newest to oldest. Promoting the
+ongoing backup is a single rename into the snapshots directory, and expired
+snapshots are renamed into the trash directory, to be deleted later. The
+numbered names of earlier versions (backups/1 is the last completed backup)
+are kept as symlinks into the snapshots directory.
+"""
+
+import os
+import json
+from datetime import datetime
+from logging import getLogger
+from pathlib import Path
+from threading import Thread
+from zoneinfo import ZoneInfo
+
+from digibankup.util import rmtree
+
+logger = getLogger(__name__)
+
+SNAPSHOTS_DIR = 'snapshots'
+TRASH_DIR = 'trash'
+INDEX_NAME = 'index.json'
+NAME_FORMAT = '%Y%m%dT%H%M%S'
+
+
+def read_index(backups_path: Path) -> list[str]:
+    """
+    Reads the names of the snapshots.
+
+    Args:
+        backups_path: Directory containing the backups.
+
+    Returns:
+        Names of the snapshots, from newest to oldest.
+    """
+    try:
+        with (backups_path / INDEX_NAME).open('r') as f:
+            return json.load(f)['snapshots']
+    except FileNotFoundError:
+        return []
+
+
+def write_index(backups_path: Path, names: list[str]) -> None:
+    """
+    Atomically replaces the index and updates the numbered symlinks.
+
+    Args:
+        backups_path: Directory containing the backups.
+        names: Names of the snapshots, from newest to oldest.
+    """
+    index_path = backups_path / INDEX_NAME
+    tmp_path = index_path.with_suffix('.tmp')
+    with tmp_path.open('w') as f:
+        json.dump({'snapshots': names}, f)
+    tmp_path.replace(index_path)
+    update_links(backups_path, names)
+
+
+def update_links(backups_path: Path, names: list[str]) -> None:
+    """
+    Points backups/1, backups/2, ... at the snapshots in the index.
+
+    Args:
+        backups_path: Directory containing the backups.
+        names: Names of the snapshots, from newest to oldest.
+    """
+    for generation, name in enumerate(names, 1):
+        link_path = backups_path / str(generation)
+        target = os.path.join(SNAPSHOTS_DIR, name)
+        if link_path.is_symlink() and os.readlink(link_path) == target:
+            continue
+        tmp_path = backups_path / f'.{generation}.tmp'
+        tmp_path.unlink(missing_ok=True)
+        os.symlink(target, tmp_path)
+        tmp_path.replace(link_path)
+
+    for entry in backups_path.iterdir():
+        if (entry.name.isdigit() and entry.is_symlink()
+                and int(entry.name) > len(names)):
+            entry.unlink()
+
+
+def snapshot_paths(backups_path: Path) -> list[Path]:
+    """
+    Determines the paths of all snapshots.
+
+    Args:
+        backups_path: Directory containing the backups.
+
+    Returns:
+        Paths of the snapshots, from newest to oldest.
+    """
+    return [backups_path / SNAPSHOTS_DIR / name
+            for name in read_index(backups_path)]
+
+
+def snapshot_path(backups_path: Path, generation: int) -> Path | None:
+    """
+    Determines the path of a snapshot by its number.
+
+    Args:
+        backups_path: Directory containing the backups.
+        generation: 1 for the last completed backup, 2 for the one before...
+
+    Returns:
+        Path of the snapshot, or None if there are fewer snapshots.
+    """
+    paths = snapshot_paths(backups_path)
+    if not 1 <= generation <= len(paths):
+        return None
+    return paths[generation - 1]
+
+
+def migrate(backups_path: Path, timezone: ZoneInfo) -> None:
+    """
+    Moves numbered backup directories of earlier versions into the snapshots
+    directory.
+
+    Args:
+        backups_path: Directory containing the backups.
+        timezone: Timezone of the snapshot names.
+    """
+    legacy = sorted(
+        (i for i in backups_path.iterdir()
+         if i.name.isdigit() and i.name != '0'
+         and i.is_dir() and not i.is_symlink()),
+        key=lambda x: int(x.name)
+    )
+    if not legacy:
+        return
+
+    logger.info(f"Moving {len(legacy)} numbered backup directories into "
+                f"{backups_path / SNAPSHOTS_DIR}.")
+    (backups_path / SNAPSHOTS_DIR).mkdir(exist_ok=True)
+    names = read_index(backups_path)
+    for directory in legacy:
+        mtime = datetime.fromtimestamp(directory.stat().st_mtime, timezone)
+        name = unique_name(backups_path, mtime.strftime(NAME_FORMAT))
+        directory.rename(backups_path / SNAPSHOTS_DIR / name)
+        names.append(name)
+    write_index(backups_path, names)
+
+
+def unique_name(backups_path: Path, name: str) -> str:
+    """Appends a counter to a snapshot name if it is already taken."""
+    candidate = name
+    counter = 1
+    while (backups_path / SNAPSHOTS_DIR / candidate).exists():
+        candidate = f"{name}-{counter}"
+        counter += 1
+    return candidate
+
+
+def promote(backups_path: Path, backup_path: Path,
+            timezone: ZoneInfo) -> Path:
+    """
+    Turns the ongoing backup into the newest snapshot.
+
+    Args:
+        backups_path: Directory containing the backups.
+        backup_path: Root path of the completed backup.
+        timezone: Timezone of the snapshot name.
+
+    Returns:
+        Path of the new snapshot.
+    """
+    (backups_path / SNAPSHOTS_DIR).mkdir(exist_ok=True)
+    name = unique_name(backups_path,
+                       datetime.now(timezone).strftime(NAME_FORMAT))
+    snapshot = backups_path / SNAPSHOTS_DIR / name
+    backup_path.rename(snapshot)
+    write_index(backups_path, [name] + read_index(backups_path))
+    return snapshot
+
+
+def expire(backups_path: Path, expiring: list[str]) -> list[str]:
+    """
+    Moves snapshots into the trash.
+
+    Args:
+        backups_path: Directory containing the backups.
+        expiring: Names of the snapshots to expire, see retention.
+
+    Returns:
+        Names of the expired snapshots.
+    """
+    names = read_index(backups_path)
+    expired = [name for name in names if name in expiring]
+    if not expired:
+        return []
+
+    write_index(backups_path,
+                [name for name in names if name not in expired])
+    (backups_path / TRASH_DIR).mkdir(exist_ok=True)
+    for name in expired:
+        snapshot = backups_path / SNAPSHOTS_DIR / name
+        if snapshot.exists():
+            snapshot.rename(backups_path / TRASH_DIR / name)
+    logger.info(f"Moved expired snapshots {', '.join(expired)} to the trash.")
+    return expired
+
+
+def empty_trash(backups_path: Path, workers: int) -> None:
+    """
+    Deletes the expired snapshots in the trash.
+
+    Args:
+        backups_path: Directory containing the backups.
+        workers: Amount of threads deleting files at the same time.
+    """
+    trash_path = backups_path / TRASH_DIR
+    if not trash_path.is_dir():
+        return
+    for entry in trash_path.iterdir():
+        logger.info(f"Deleting expired snapshot {entry}.")
+        try:
+            rmtree(entry, workers)
+        except OSError as e:
+            logger.error(f"Could not delete expired snapshot {entry}.",
+                         exc_info=e)
+
+
+def start_emptying_trash(backups_path: Path, workers: int) -> Thread:
+    """
+    Deletes the expired snapshots in the trash in a background thread.
+
+    Args:
+        backups_path: Directory containing the backups.
+        workers: Amount of threads deleting files at the same time.
+
+    Returns:
+        The started thread.
+    """
+    thread = Thread(target=empty_trash, args=(backups_path, workers),
+                    name='empty-trash')
+    thread.start()
+    return thread
@@ -1,18 +1,312 @@
-"""Performs backup of the SnipeIT server. (NOT IMPLEMENTED)"""
-from os import PathLike
+"""
+Performs backup of the Snipe IT server through its REST API.
+
+Every API resource is paged through with limit and offset, fetching pages
+concurrently on a pooled session, and streamed as compressed JSONL into the
+snipeit subpath. Once a resource has been exported, later runs only fetch the
+records updated since, and merge them with the export in the previous backup.
+"""
+
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from configparser import ConfigParser
 from logging import getLogger
+from pathlib import Path
+from threading import Lock
+from time import monotonic, sleep, time
+
 import requests
-from configparser import ConfigParser
 
+from digibankup.compression import Compressor, open_decompressed
 from digibankup.config import Backupflags
+from digibankup.manifest import Manifest
+from digibankup.metrics import PhaseMetrics
+from digibankup.session import make_session, get_timeout
+from digibankup.util import str_to_bool
 
 logger = getLogger(__name__)
 
+# Pause when the rate limit is exhausted and the server does not say for how
+# long, in seconds.
+RATE_LIMIT_PAUSE = 60
+# Statuses meaning the API token may not read a resource.
+SKIPPED_STATUSES = (401, 403, 404)
+
+
+class RateLimiter():
+    """
+    Pauses all requests once the server reports its rate limit is exhausted.
+    """
+    def __init__(self):
+        self.lock: Lock = Lock()
+        self.resume_at: float = 0
+
+    def wait(self) -> None:
+        with self.lock:
+            delay = self.resume_at - monotonic()
+        if delay > 0:
+            sleep(delay)
+
+    def update(self, response: requests.Response) -> None:
+        """
+        Reads the rate limit headers of a response.
+
+        Args:
+            response: Response of the Snipe IT API.
+        """
+        if response.headers.get('X-RateLimit-Remaining') != '0':
+            return
+        delay = RATE_LIMIT_PAUSE
+        if 'Retry-After' in response.headers:
+            delay = float(response.headers['Retry-After'])
+        elif 'X-RateLimit-Reset' in response.headers:
+            delay = float(response.headers['X-RateLimit-Reset']) - time()
+        logger.info(f"Snipe IT rate limit reached. Pausing requests for "
+                    f"{max(delay, 0):.0f} s.")
+        with self.lock:
+            self.resume_at = max(self.resume_at, monotonic() + delay)
+
+
+class Exporter():
+    """Fetches pages of Snipe IT API resources."""
+    @classmethod
+    def from_config(cls, config: ConfigParser):
+        return cls(api_endpoint=config['snipe_it']['api_endpoint'],
+                   api_token=config['snipe_it']['api_token'],
+                   page_size=int(config['snipe_it']['page_size']),
+                   workers=int(config['snipe_it']['workers']),
+                   session=make_session(
+                       config, pool_size=int(config['snipe_it']['workers'])),
+                   timeout=get_timeout(config))
+
+    def __init__(self, api_endpoint: str, api_token: str, page_size: int,
+                 workers: int, session: requests.Session,
+                 timeout: tuple[float, float]):
+        self.api_endpoint: str = api_endpoint
+        self.page_size: int = page_size
+        self.workers: int = workers
+        self.session: requests.Session = session
+        self.session.headers.update({
+            'Accept': 'application/json',
+            'Authorization': f'Bearer {api_token}',
+        })
+        self.timeout: tuple[float, float] = timeout
+        self.rate_limiter: RateLimiter = RateLimiter()
+        self.bytes_read: int = 0
+        self.lock: Lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *e):
+        self.session.close()
+
+    def page(self, resource: str, offset: int,
+             sort: str = 'id', order: str = 'asc') -> dict:
+        """
+        Fetches a page of records.
+
+        Args:
+            resource: Name of the resource in the API, e.g. hardware.
+            offset: Amount of records to skip.
+            sort: Field to sort the records by.
+            order: asc or desc.
+
+        Returns:
+            The decoded response, with the records in rows and the amount of
+            records in total.
+
+        Raises:
+            requests.HTTPError: Raised when the response has an error status.
+            ValueError: Raised when the API reports an error in the body.
+        """
+        self.rate_limiter.wait()
+        response = self.session.get(
+            self.api_endpoint + resource,
+            params={'limit': self.page_size, 'offset': offset,
+                    'sort': sort, 'order': order},
+            timeout=self.timeout)
+        self.rate_limiter.update(response)
+        response.raise_for_status()
+        with self.lock:
+            self.bytes_read += len(response.content)
+        page = response.json()
+        if page.get('status') == 'error':
+            raise ValueError(f"Snipe IT API error for {resource}: "
+                             f"{page.get('messages')}")
+        return page
+
+    def all_records(self, resource: str):
+        """
+        Fetches every record of a resource, fetching pages concurrently.
+
+        At most twice the amount of workers pages are fetched ahead, so
+        memory use does not depend on the amount of records.
+
+        Args:
+            resource: Name of the resource in the API, e.g. hardware.
+
+        Yields:
+            Every record, in order of id.
+        """
+        first = self.page(resource, 0)
+        yield from first['rows']
+        offsets = iter(range(len(first['rows']), first['total'],
+                             self.page_size))
+        pending: deque[Future] = deque()
+        with ThreadPoolExecutor(max_workers=self.workers,
+                                thread_name_prefix='snipeit') as executor:
+            for offset in offsets:
+                pending.append(executor.submit(self.page, resource, offset))
+                while len(pending) > self.workers * 2:
+                    yield from pending.popleft().result()['rows']
+            while pending:
+                yield from pending.popleft().result()['rows']
+
+    def updated_records(self, resource: str,
+                        since: str) -> tuple[list[dict], int] | None:
+        """
+        Fetches the records of a resource updated since a given time.
+
+        Pages are fetched newest first until a page reaches an older record.
+        Servers that ignore the sort would end the fetch too early, so it is
+        given up once a fetched page has a record newer than the one before.
+
+        Args:
+            resource: Name of the resource in the API, e.g. hardware.
+            since: updated_at of the newest record of the previous export.
+
+        Returns:
+            Records updated at or after since, and the total amount of
+            records of the resource. None if the server did not sort the
+            records by updated_at.
+        """
+        records = []
+        offset = 0
+        previous = None
+        while True:
+            page = self.page(resource, offset, sort='updated_at',
+                             order='desc')
+            times = [updated_at(record) for record in page['rows']]
+            for current in times:
+                if previous is not None and current > previous:
+                    logger.warning(f"Snipe IT did not sort {resource} by "
+                                   "updated_at. Fetching all records.")
+                    return None
+                previous = current
+            for record, current in zip(page['rows'], times):
+                if current < since:
+                    return records, page['total']
+                records.append(record)
+            offset += len(page['rows'])
+            if not page['rows'] or offset >= page['total']:
+                return records, page['total']
+
+
+def updated_at(record: dict) -> str:
+    """
+    Reads the update time of a record.
+
+    Args:
+        record: Record of the Snipe IT API.
+
+    Returns:
+        Update time as 'YYYY-MM-DD HH:MM:SS', which sorts chronologically.
+        Empty if the record has none.
+    """
+    value = record.get('updated_at')
+    if isinstance(value, dict):
+        value = value.get('datetime')
+    return value or ''
+
+
+def read_export(path: Path) -> dict[int, dict]:
+    """Reads an export of a previous backup, keyed by record id."""
+    with open_decompressed(path) as f:
+        return {record['id']: record
+                for record in map(json.loads, f)}
+
+
+def find_export(directory: Path, resource: str) -> Path | None:
+    """Finds the export of a resource, whatever its compression suffix."""
+    for path in sorted(directory.glob(f'{resource}.jsonl*')):
+        if not path.name.endswith('.part'):
+            return path
+    return None
+
+
+def export_resource(exporter: Exporter, compressor: Compressor,
+                    resource: str, snipeit_path: Path,
+                    previous_export: Path | None, since: str | None,
+                    manifest: Manifest | None = None) -> tuple[str, int]:
+    """
+    Exports a resource to compressed JSONL.
+
+    Args:
+        exporter: Fetches pages from the API.
+        compressor: Compresses the export.
+        resource: Name of the resource in the API, e.g. hardware.
+        snipeit_path: Directory to write the export to.
+        previous_export: Export of the resource in the previous backup.
+        since: updated_at of the newest record in previous_export. If both
+            are set, only records updated since are fetched.
+        manifest: If set, the export is added to it.
+
+    Returns:
+        updated_at of the newest exported record, and the amount of bytes
+        written.
+    """
+    dst = compressor.compressed_path(snipeit_path / f'{resource}.jsonl')
+    tmp_path = dst.with_name(dst.name + '.part')
+
+    records = None
+    fetched = None
+    if previous_export is not None and since:
+        fetched = exporter.updated_records(resource, since)
+    if fetched is not None:
+        updated, total = fetched
+        merged = read_export(previous_export)
+        merged.update((record['id'], record) for record in updated)
+        if len(merged) != total:
+            # Records were deleted since the previous backup, which the
+            # updated records do not reveal.
+            logger.info(f"Snipe IT {resource} has {total} records, expected "
+                        f"{len(merged)}. Fetching all records.")
+        else:
+            logger.info(f"Fetched {len(updated)} Snipe IT {resource} updated "
+                        f"since {since}.")
+            records = (merged[key] for key in sorted(merged))
+    if records is None:
+        records = exporter.all_records(resource)
+
+    hasher = None if manifest is None else manifest.new_hasher()
+    newest = since or ''
+    count = 0
+    size = 0
+    with compressor.wrap(tmp_path.open('wb')) as f:
+        for record in records:
+            line = (json.dumps(record, sort_keys=True) + '\n').encode()
+            f.write(line)
+            if hasher is not None:
+                hasher.update(line)
+            newest = max(newest, updated_at(record))
+            count += 1
+            size += len(line)
+    tmp_path.replace(dst)
+    if manifest is not None:
+        manifest.add(dst, size, dst.stat().st_mtime_ns,
+                     manifest.format_digest(hasher))
+    logger.info(f"Exported {count} Snipe IT {resource} to {dst}.")
+    return newest, dst.stat().st_size
+
 
-#  Currently not implemented because Snipe IT version does not support backups.
-#  Component would work if Snipe IT were updated.
-def backup(config: ConfigParser, backup_path: PathLike,
-           backupflags: Backupflags) -> None:
+def backup(config: ConfigParser, backup_path: Path,
+           backupflags: Backupflags,
+           backups_info: dict | None = None,
+           previous_path: Path | None = None,
+           manifest: Manifest | None = None,
+           stats: PhaseMetrics | None = None) -> None:
     """Performs backup of Snipe IT inventory.
 
     Args:
@@ -20,23 +314,79 @@ def backup(config: ConfigParser, backup_path: PathLike,
         backup_path: Root destination path of the ongoing backup.
         backupflags: Contains flags indicating which backups to perform.
             If the snipeit flag is not True the body of this function will not
-            execute."""
-    return
+            execute.
+        backups_info: Dict containing date of last backup. The updated_at of
+            the newest record of every resource is stored in it, so the next
+            backup only fetches newer records.
+        previous_path: Root path of the previous completed backup, whose
+            exports are merged with the updated records.
+        manifest: Manifest of the ongoing backup.
+        stats: If set, the exports are counted in it.
 
+    Raises:
+        RuntimeError: Raised when a resource could not be exported.
+    """
     if not backupflags.snipeit:
         return
 
     logger.info("==== Backing up Snipe IT server. ====")
 
-    url = config['snipe_it']['api_endpoint'] + 'settings/backups'
+    snipeit_path = backup_path / config['subpaths']['snipeit']
+    snipeit_path.mkdir(parents=True, exist_ok=True)
+    previous_dir = None
+    if previous_path is not None:
+        previous_dir = previous_path / config['subpaths']['snipeit']
 
-    headers = {
-        "accept": "application/json",
-        "Authorization": "Bearer " + config['snipe_it']['api_token']
-    }
+    incremental = (str_to_bool(config['snipe_it']['incremental'])
+                   and backups_info is not None)
+    newest = {}
+    if backups_info is not None:
+        newest = dict(backups_info.get('snipeit_updated_at', {}))
 
-    response = requests.get(url, headers=headers)
+    # Exports are always compressed, with gzip unless set otherwise.
+    algorithm = config['settings']['compression']
+    if algorithm == 'none':
+        algorithm = 'gzip'
 
-    print(response)
+    resources = [resource.strip()
+                 for resource in config['snipe_it']['resources'].split(',')
+                 if resource.strip()]
+    failed = []
+    with (Exporter.from_config(config) as exporter,
+          Compressor(algorithm, int(config['settings']['compression_level']),
+                     int(config['settings']['compression_threads']))
+          as compressor):
+        for resource in resources:
+            previous_export = None
+            if incremental and previous_dir is not None:
+                previous_export = find_export(previous_dir, resource)
+            try:
+                newest[resource], written = export_resource(
+                    exporter, compressor, resource, snipeit_path,
+                    previous_export, newest.get(resource), manifest)
+            except requests.HTTPError as e:
+                if e.response.status_code in SKIPPED_STATUSES:
+                    logger.warning(f"Snipe IT API refused {resource} with "
+                                   f"status {e.response.status_code}. "
+                                   f"Skipping it.")
+                    continue
+                logger.error(f"Could not export Snipe IT {resource}.",
+                             exc_info=e)
+                failed.append(resource)
+                continue
+            except (requests.RequestException, ValueError, KeyError) as e:
+                logger.error(f"Could not export Snipe IT {resource}.",
+                             exc_info=e)
+                failed.append(resource)
+                continue
+            if stats is not None:
+                stats.add_file(0, written)
+        if stats is not None:
+            stats.bytes_read += exporter.bytes_read
 
-    logger.error("CANNOT BACK UP SNIPE IT. SNIPE IT BACKUP NOT IMPLEMENTED.")
+    if backups_info is not None:
+        backups_info['snipeit_updated_at'] = newest
+    if failed:
+        raise RuntimeError(f"Could not export Snipe IT "
+                           f"{', '.join(failed)}.")
+    logger.info(f"Snipe IT written to {snipeit_path}.")
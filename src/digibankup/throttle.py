@@ -0,0 +1,208 @@
+"""
+Limits the load the backup puts on the FOG server.
+
+Reads are throttled with token buckets for bandwidth and I/O operations,
+with different limits per time of day, and the process can lower its own CPU
+and I/O priority.
+"""
+
+import os
+from datetime import datetime, time
+from logging import getLogger
+from subprocess import check_call, CalledProcessError
+from threading import Lock
+from time import monotonic, sleep
+from zoneinfo import ZoneInfo
+from configparser import ConfigParser
+
+logger = getLogger(__name__)
+
+MEGABYTE = 1000 * 1000
+
+
+class TokenBucket():
+    """
+    Thread-safe token bucket.
+
+    Tokens are reserved before they are available, so waiting threads are
+    served in the order they asked and never starve each other.
+    """
+    def __init__(self, rate: float):
+        self.lock: Lock = Lock()
+        self.rate: float = 0
+        self.tokens: float = 0
+        self.last: float = monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate: float) -> None:
+        """
+        Changes the rate of the bucket.
+
+        Args:
+            rate: Tokens per second. The bucket holds at most one second worth
+                of tokens. 0 disables the limit.
+        """
+        with self.lock:
+            if rate != self.rate:
+                self.rate = rate
+                self.tokens = min(self.tokens, rate)
+
+    def reserve(self, amount: float) -> float:
+        """
+        Takes tokens from the bucket.
+
+        Args:
+            amount: Amount of tokens to take.
+
+        Returns:
+            Seconds to wait before the tokens may be used.
+        """
+        with self.lock:
+            if not self.rate:
+                return 0
+            now = monotonic()
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+
+def parse_schedule(schedule: str) -> list[tuple[time, time, float, float]]:
+    """
+    Parses settings.throttle_schedule.
+
+    Args:
+        schedule: Comma separated windows in the format
+            HH:MM-HH:MM/max_read_mbps/max_iops, e.g. '08:00-16:30/20/200'.
+            A window may cross midnight.
+
+    Returns:
+        Start, end, maximum bytes per second and maximum operations per second
+        of every window.
+
+    Raises:
+        ValueError: Raised when a window is not in the expected format.
+    """
+    windows = []
+    for window in schedule.split(','):
+        window = window.strip()
+        if not window:
+            continue
+        try:
+            hours, mbps, iops = window.split('/')
+            start, end = hours.split('-')
+            windows.append((time.fromisoformat(start.strip()),
+                            time.fromisoformat(end.strip()),
+                            float(mbps) * MEGABYTE, float(iops)))
+        except ValueError as e:
+            raise ValueError(f"Could not parse throttle window {window!r}. "
+                             f"Expected HH:MM-HH:MM/mbps/iops.") from e
+    return windows
+
+
+class Throttle():
+    """Limits the bandwidth and operations per second of reads."""
+    @classmethod
+    def from_config(cls, config: ConfigParser):
+        return cls(
+            max_bytes=float(config['settings']['max_read_mbps']) * MEGABYTE,
+            max_iops=float(config['settings']['max_iops']),
+            schedule=parse_schedule(config['settings']['throttle_schedule']),
+            timezone=ZoneInfo(config['settings']['timezone'])
+        )
+
+    def __init__(self, max_bytes: float, max_iops: float,
+                 schedule: list[tuple[time, time, float, float]],
+                 timezone: ZoneInfo):
+        self.max_bytes: float = max_bytes
+        self.max_iops: float = max_iops
+        self.schedule: list[tuple[time, time, float, float]] = schedule
+        self.timezone: ZoneInfo = timezone
+        self.bytes_bucket: TokenBucket = TokenBucket(max_bytes)
+        self.iops_bucket: TokenBucket = TokenBucket(max_iops)
+        self.lock: Lock = Lock()
+        self.throttled: float = 0
+        self.parent: Throttle | None = None
+
+    def share(self) -> 'Throttle':
+        """
+        Creates a throttle with the same limits and buckets as this one.
+
+        Reads through either throttle count against the same limits. The
+        new throttle keeps its own total of waiting time, which is also added
+        to the total of this one.
+
+        Returns:
+            The new throttle.
+        """
+        shared = Throttle(self.max_bytes, self.max_iops, self.schedule,
+                          self.timezone)
+        shared.bytes_bucket = self.bytes_bucket
+        shared.iops_bucket = self.iops_bucket
+        shared.parent = self
+        return shared
+
+    def add_throttled(self, wait: float) -> None:
+        with self.lock:
+            self.throttled += wait
+        if self.parent is not None:
+            self.parent.add_throttled(wait)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.max_bytes or self.max_iops or self.schedule)
+
+    def current_limits(self) -> tuple[float, float]:
+        """
+        Determines the limits that apply right now.
+
+        Returns:
+            Maximum bytes per second and operations per second of the first
+            schedule window containing the current time, or the default
+            limits outside of all windows.
+        """
+        now = datetime.now(self.timezone).time()
+        for start, end, max_bytes, max_iops in self.schedule:
+            if start <= end:
+                inside = start <= now < end
+            else:
+                inside = now >= start or now < end
+            if inside:
+                return max_bytes, max_iops
+        return self.max_bytes, self.max_iops
+
+    def consume(self, size: int, ops: int = 1) -> None:
+        """
+        Waits until a read is allowed by the current limits.
+
+        Args:
+            size: Amount of bytes about to be read.
+            ops: Amount of I/O operations about to be performed.
+        """
+        if not self.enabled:
+            return
+        max_bytes, max_iops = self.current_limits()
+        self.bytes_bucket.set_rate(max_bytes)
+        self.iops_bucket.set_rate(max_iops)
+        wait = max(self.bytes_bucket.reserve(size),
+                   self.iops_bucket.reserve(ops))
+        if wait > 0:
+            self.add_throttled(wait)
+            sleep(wait)
+
+
+def lower_priority() -> None:
+    """
+    Drops the CPU priority of the process to the lowest level and its I/O
+    priority to the idle class.
+
+    Threads started afterwards inherit these priorities.
+    """
+    os.setpriority(os.PRIO_PROCESS, 0, 19)
+    try:
+        check_call(['ionice', '-c', '3', '-p', str(os.getpid())])
+    except (OSError, CalledProcessError) as e:
+        logger.warning("Could not set idle I/O priority.", exc_info=e)
+        return
+    logger.info("Lowered CPU and I/O priority of the backup process.")
@@ -0,0 +1,459 @@
+"""Copies files and directory trees as efficiently as the kernel allows."""
+
+import os
+import errno
+import shutil
+from dataclasses import dataclass
+from logging import getLogger
+from pathlib import Path
+from queue import Queue
+from threading import Lock, Thread, local
+from typing import BinaryIO, Callable
+
+from digibankup.throttle import Throttle
+from digibankup.walk import BoundedExecutor, DirectoryBarrier, TreeWalker
+
+logger = getLogger(__name__)
+
+BUFFER_SIZE = 8 * 1024 * 1024
+# Size of the blocks a TeeWriter passes to its extra files, and the amount of
+# blocks that may wait for each extra file.
+TEE_BLOCK_SIZE = 1024 * 1024
+TEE_DEPTH = 4
+
+# Errors meaning a copy method is not supported for this pair of files, as
+# opposed to a real I/O error.
+UNSUPPORTED_ERRNOS = {errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                      errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF,
+                      errno.ETXTBSY, errno.EPERM}
+
+
+thread_local = local()
+
+
+def thread_buffer() -> memoryview:
+    """Returns a copy buffer that is reused by all copies in this thread."""
+    if not hasattr(thread_local, 'buffer'):
+        thread_local.buffer = memoryview(bytearray(BUFFER_SIZE))
+    return thread_local.buffer
+
+
+def data_segments(fd: int, size: int) -> list[tuple[int, int]]:
+    """
+    Finds the regions of a file that contain data, skipping holes.
+
+    Args:
+        fd: File descriptor of the file.
+        size: Size of the file.
+
+    Returns:
+        (offset, length) of every data region. The whole file is returned as
+        one region if the file system does not support SEEK_DATA.
+    """
+    if not hasattr(os, 'SEEK_DATA'):
+        return [(0, size)] if size else []
+
+    segments = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    break
+                raise
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+            segments.append((start, end - start))
+            offset = end
+    except OSError as e:
+        if e.errno not in UNSUPPORTED_ERRNOS:
+            raise
+        return [(0, size)] if size else []
+    return segments
+
+
+def copy_range(src_fd: int, dst_fd: int, offset: int, length: int,
+               hasher=None) -> None:
+    """
+    Copies a region of a file to the same offset in another file.
+
+    Tries os.copy_file_range first, which copies inside the kernel and can be
+    offloaded to the server on NFS 4.2. Falls back on os.sendfile, and
+    finally on reading into a buffer reused by every copy in this thread.
+
+    Args:
+        src_fd: File descriptor of the source file.
+        dst_fd: File descriptor of the destination file.
+        offset: Start of the region.
+        length: Length of the region.
+        hasher: If set, the region is read into the buffer and added to this
+            hash object, instead of being copied by the kernel.
+    """
+    end = offset + length
+
+    if hasher is None and hasattr(os, 'copy_file_range'):
+        try:
+            while offset < end:
+                copied = os.copy_file_range(src_fd, dst_fd, end - offset,
+                                            offset, offset)
+                if copied == 0:
+                    return
+                offset += copied
+            return
+        except OSError as e:
+            if e.errno not in UNSUPPORTED_ERRNOS:
+                raise
+
+    if hasher is None:
+        try:
+            os.lseek(dst_fd, offset, os.SEEK_SET)
+            while offset < end:
+                sent = os.sendfile(dst_fd, src_fd, offset, end - offset)
+                if sent == 0:
+                    return
+                offset += sent
+            return
+        except OSError as e:
+            if e.errno not in UNSUPPORTED_ERRNOS:
+                raise
+
+    buffer = thread_buffer()
+    while offset < end:
+        view = buffer[:min(len(buffer), end - offset)]
+        read = os.preadv(src_fd, [view], offset)
+        if read == 0:
+            return
+        if hasher is not None:
+            hasher.update(view[:read])
+        written = 0
+        while written < read:
+            written += os.pwrite(dst_fd, view[written:read], offset + written)
+        offset += read
+
+
+def hash_zeros(hasher, length: int) -> None:
+    """Adds length zero bytes, the contents of a hole, to a hash object."""
+    zeros = memoryview(bytes(min(length, BUFFER_SIZE)))
+    while length > 0:
+        hasher.update(zeros[:min(length, len(zeros))])
+        length -= len(zeros)
+
+
+def write_sparse(f: BinaryIO, block: bytes) -> None:
+    """
+    Writes a block to a file, leaving a hole instead if it is all zeros.
+
+    The file has to be truncated at its final position afterwards, so a hole
+    at its end still counts towards its size.
+
+    Args:
+        f: File object opened for binary writing.
+        block: Data to write.
+    """
+    if block.count(0) == len(block):
+        f.seek(len(block), os.SEEK_CUR)
+    else:
+        f.write(block)
+
+
+@dataclass
+class TeeTarget:
+    """
+    Extra file written by a TeeWriter.
+
+    Attributes:
+        f: File object opened for binary writing. Closed by the TeeWriter.
+        on_error: Called with the error if writing to f fails.
+    """
+    f: BinaryIO
+    on_error: Callable[[OSError], None]
+
+
+class TeeWriter():
+    """
+    Writable file object that writes the same data to several files at once.
+
+    The main file is written by the calling thread, every extra file by a
+    thread of its own. At most TEE_DEPTH writes wait for each extra file, so
+    the slowest file sets the pace without buffering the whole contents. An
+    extra file that fails is reported and skipped, without stopping the
+    others. Errors of the main file are raised as usual.
+    """
+    def __init__(self, f: BinaryIO, targets: list[TeeTarget]):
+        self.f: BinaryIO = f
+        self.queues: list[Queue] = []
+        self.threads: list[Thread] = []
+        for target in targets:
+            queue = Queue(TEE_DEPTH)
+            thread = Thread(target=self.drain, args=(target, queue),
+                            name='tee', daemon=True)
+            thread.start()
+            self.queues.append(queue)
+            self.threads.append(thread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *e):
+        self.close()
+
+    @staticmethod
+    def drain(target: TeeTarget, queue: Queue) -> None:
+        failed = False
+        while (item := queue.get()) is not None:
+            if failed:
+                continue
+            method, argument = item
+            try:
+                getattr(target.f, method)(argument)
+            except OSError as e:
+                failed = True
+                target.on_error(e)
+        try:
+            target.f.close()
+        except OSError as e:
+            if not failed:
+                target.on_error(e)
+
+    def put(self, item: tuple | None) -> None:
+        for queue in self.queues:
+            queue.put(item)
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.put(('write', data))
+        return self.f.write(data)
+
+    def seek(self, offset: int) -> int:
+        self.put(('seek', offset))
+        return self.f.seek(offset)
+
+    def truncate(self, size: int) -> int:
+        self.put(('truncate', size))
+        return self.f.truncate(size)
+
+    def close(self) -> None:
+        self.put(None)
+        try:
+            self.f.close()
+        finally:
+            for thread in self.threads:
+                thread.join()
+
+
+def tee_file(src, dst, targets: list[TeeTarget],
+             throttle: Throttle | None = None, hasher=None) -> None:
+    """
+    Copies the contents of a file to dst and extra files, reading it once.
+
+    Holes in the source are skipped in every copy.
+
+    Args:
+        src: Source file.
+        dst: Destination file.
+        targets: Extra files to write the contents to.
+        throttle: If set, every block read waits for the throttle.
+        hasher: If set, the contents of the file are added to this hash
+            object, holes included.
+    """
+    with (open(src, 'rb') as fsrc,
+          TeeWriter(open(dst, 'wb'), targets) as writer):
+        src_fd = fsrc.fileno()
+        size = os.fstat(src_fd).st_size
+        position = 0
+        for offset, length in data_segments(src_fd, size):
+            if hasher is not None:
+                hash_zeros(hasher, offset - position)
+            position = offset + length
+            writer.seek(offset)
+            while offset < position:
+                block_size = min(TEE_BLOCK_SIZE, position - offset)
+                if throttle is not None:
+                    throttle.consume(block_size)
+                block = os.pread(src_fd, block_size, offset)
+                if not block:
+                    break
+                if hasher is not None:
+                    hasher.update(block)
+                writer.write(block)
+                offset += len(block)
+        if hasher is not None:
+            hash_zeros(hasher, size - position)
+        writer.truncate(size)
+
+
+def copy_file(src, dst, *, follow_symlinks=True,
+              throttle: Throttle | None = None, hasher=None,
+              tee: Callable[[Path], list[TeeTarget]] | None = None):
+    """
+    Copies a file and its metadata, keeping holes in sparse files.
+
+    Drop-in replacement for shutil.copy2 where dst is a file path.
+
+    Args:
+        src: Source file.
+        dst: Destination file.
+        follow_symlinks: If false, symlinks are copied as symlinks.
+        throttle: If set, the copy is split into pieces of BUFFER_SIZE that
+            each wait for the throttle.
+        hasher: If set, the contents of the file are added to this hash
+            object while copying, holes included.
+        tee: If set, called with dst. The contents are also written to the
+            files it returns, reading the source only once.
+
+    Returns:
+        dst
+    """
+    if not follow_symlinks and os.path.islink(src):
+        os.symlink(os.readlink(src), dst)
+        shutil.copystat(src, dst, follow_symlinks=False)
+        return dst
+
+    targets = [] if tee is None else tee(Path(dst))
+    if targets:
+        tee_file(src, dst, targets, throttle, hasher)
+        shutil.copystat(src, dst)
+        return dst
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        src_fd = fsrc.fileno()
+        dst_fd = fdst.fileno()
+        size = os.fstat(src_fd).st_size
+        throttled = throttle is not None and throttle.enabled
+        if throttled:
+            throttle.consume(0)
+        position = 0
+        for offset, length in data_segments(src_fd, size):
+            if hasher is not None:
+                hash_zeros(hasher, offset - position)
+                position = offset + length
+            if not throttled:
+                copy_range(src_fd, dst_fd, offset, length, hasher)
+                continue
+            for piece in range(offset, offset + length, BUFFER_SIZE):
+                piece_length = min(BUFFER_SIZE, offset + length - piece)
+                throttle.consume(piece_length)
+                copy_range(src_fd, dst_fd, piece, piece_length, hasher)
+        if hasher is not None:
+            hash_zeros(hasher, size - position)
+        os.ftruncate(dst_fd, size)
+    shutil.copystat(src, dst)
+    return dst
+
+
+def copy_tree(src_root: Path, dst_root: Path, copy_function: Callable,
+              workers: int,
+              ignore: Callable[[str, list[str]], set[str]] | None = None
+              ) -> list[tuple[str, str, str]]:
+    """
+    Copies a directory tree, copying files concurrently.
+
+    The source is walked lazily with walk.TreeWalker, directories are created
+    while walking, and files are queued to a pool of worker threads. The
+    queue is bounded, so the walk never runs far ahead of the copies, and
+    memory use does not grow with the size of the tree. Every directory gets
+    its metadata as soon as everything in it is copied. Symlinks to
+    directories are copied as symlinks. Unlike
+    shutil.copytree, a failing file does not stop the other files from being
+    copied.
+
+    Args:
+        src_root: Root of the directory tree to copy.
+        dst_root: Destination of the copy. May already exist.
+        copy_function: Function with the signature of shutil.copy2 used to
+            copy each file. It is also passed the os.DirEntry of the file as
+            the keyword argument entry, so it can reuse its stat results.
+        workers: Amount of files copied at the same time.
+        ignore: If set, called with a directory and the names of some of its
+            entries, like the ignore argument of shutil.copytree. The
+            returned names are not copied.
+
+    Returns:
+        (src, dst, reason) for every file or directory that could not be
+        copied, in the same format as the arguments of shutil.Error.
+
+    Raises:
+        FileNotFoundError: Raised when src_root does not exist.
+    """
+    if not src_root.is_dir():
+        raise FileNotFoundError(f"No such directory: {os.fspath(src_root)}")
+
+    errors: list[tuple[str, str, str]] = []
+    errors_lock = Lock()
+    # Source directory: destination directory, for every directory that is
+    # not finished yet.
+    dst_dirs: dict[str, str] = {}
+
+    def add_error(src: str, dst: str, e: Exception) -> None:
+        reason = str(e)
+        if not isinstance(e, OSError):
+            reason = f"{type(e).__name__}: {reason}"
+        with errors_lock:
+            errors.append((src, dst, reason))
+
+    def finish(src_dir: str) -> None:
+        dst_dir = dst_dirs.pop(src_dir)
+        try:
+            shutil.copystat(src_dir, dst_dir)
+        except OSError as e:
+            add_error(src_dir, dst_dir, e)
+
+    barrier = DirectoryBarrier(finish)
+
+    def copy_one(src: str, dst: str, src_dir: str,
+                 entry: os.DirEntry) -> None:
+        try:
+            copy_function(src, dst, entry=entry)
+        except OSError as e:
+            add_error(src, dst, e)
+        except Exception as e:
+            # A bug rather than an I/O error, but the file is still missing.
+            logger.error(f"Unexpected error while copying {src} to {dst}.",
+                         exc_info=e)
+            add_error(src, dst, e)
+        finally:
+            barrier.done(src_dir)
+
+    def walk_error(e: OSError) -> None:
+        add_error(e.filename, '', e)
+
+    walker = TreeWalker(src_root, ignore, walk_error)
+    with BoundedExecutor(workers) as executor:
+        for visit in walker:
+            if visit.leaving:
+                barrier.leave(visit.path)
+                continue
+            if visit.dirpath is None:
+                dst = os.fspath(dst_root)
+            else:
+                dst = os.path.join(dst_dirs[visit.dirpath],
+                                   os.path.basename(visit.path))
+            if visit.is_dir:
+                try:
+                    os.makedirs(dst, exist_ok=True)
+                except OSError as e:
+                    add_error(visit.path, dst, e)
+                    walker.skip()
+                    continue
+                dst_dirs[visit.path] = dst
+                barrier.enter(visit.path, visit.dirpath)
+            elif visit.entry.is_dir():
+                # A symlink to a directory is copied as a symlink, instead of
+                # copying the directory it points to.
+                try:
+                    if os.path.islink(dst):
+                        os.unlink(dst)
+                    os.symlink(os.readlink(visit.path), dst)
+                except OSError as e:
+                    add_error(visit.path, dst, e)
+            else:
+                barrier.start(visit.dirpath)
+                try:
+                    executor.submit(copy_one, visit.path, dst, visit.dirpath,
+                                    visit.entry)
+                except BaseException:
+                    barrier.done(visit.dirpath)
+                    raise
+
+    return errors
@@ -1,19 +1,95 @@
+import os
 from pathlib import Path
 
+from digibankup.walk import BoundedExecutor, DirectoryBarrier, TreeWalker
 
-def rmtree(f: Path):
+RMTREE_BATCH_SIZE = 1000
+
+
+def unlink_all(paths: list[str]) -> None:
+    """
+    Deletes files, ignoring files that are already gone.
+
+    Args:
+        paths: Paths of the files to delete.
+    """
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def rmtree(f: Path, workers: int = 1):
     """
     Deletes directory, including subdirectories and files.
 
+    Walks the tree lazily with walk.TreeWalker, so neither the depth nor the
+    size of the tree is limited by memory or the recursion limit. Symlinks
+    are deleted, never followed. Files are deleted in batches by a pool of
+    worker threads, which hides the latency of each unlink on network file
+    systems, and every directory is removed as soon as it is empty.
+
     Args:
         f: Path of directory to delete.
+        workers: Amount of threads deleting files at the same time.
+
+    Raises:
+        OSError: The first error, raised after deleting everything else.
     """
-    if f.is_file():
+    if f.is_symlink() or not f.is_dir():
         f.unlink()
-    else:
-        for child in f.iterdir():
-            rmtree(child)
-        f.rmdir()
+        return
+
+    errors: list[OSError] = []
+
+    def add_error(e: OSError) -> None:
+        errors.append(e)
+
+    def remove_dir(directory: str) -> None:
+        try:
+            os.rmdir(directory)
+        except OSError as e:
+            add_error(e)
+
+    barrier = DirectoryBarrier(remove_dir)
+
+    def unlink_batch(batch: list[str], directory: str) -> None:
+        try:
+            unlink_all(batch)
+        except OSError as e:
+            add_error(e)
+        finally:
+            barrier.done(directory)
+
+    def submit(batch: list[str], directory: str) -> None:
+        barrier.start(directory)
+        try:
+            executor.submit(unlink_batch, batch, directory)
+        except BaseException:
+            barrier.done(directory)
+            raise
+
+    # Directory: files not submitted yet, for every directory being walked.
+    batches: dict[str, list[str]] = {}
+    with BoundedExecutor(workers) as executor:
+        for visit in TreeWalker(f, onerror=add_error):
+            if visit.leaving:
+                batch = batches.pop(visit.path)
+                if batch:
+                    submit(batch, visit.path)
+                barrier.leave(visit.path)
+            elif visit.is_dir:
+                batches[visit.path] = []
+                barrier.enter(visit.path, visit.dirpath)
+            else:
+                batch = batches[visit.dirpath]
+                batch.append(visit.path)
+                if len(batch) >= RMTREE_BATCH_SIZE:
+                    submit(batch, visit.dirpath)
+                    batches[visit.dirpath] = []
+    if errors:
+        raise errors[0]
 
 
 def touch_parents(f: Path):
@@ -0,0 +1,208 @@
+"""
+Walks directory trees with bounded memory.
+
+TreeWalker yields the entries of a tree one at a time, straight from
+os.scandir, with an explicit stack of open directories instead of recursion.
+Memory use depends on the depth of the tree, not on the size of its
+directories, and the first entries come right away instead of after listing
+a whole directory. Every entry comes with its os.DirEntry, so its cached
+type and stat results can be reused.
+
+BoundedExecutor and DirectoryBarrier let a pool of threads process the
+entries with a bounded amount of work waiting, while still finishing every
+directory after its contents, as copy_tree and rmtree need.
+"""
+
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from threading import BoundedSemaphore, Lock
+from typing import Callable, Iterator, NamedTuple
+
+
+class Visit(NamedTuple):
+    """
+    Step of a walk.
+
+    Attributes:
+        path: Path of the entry.
+        dirpath: Directory containing the entry. None for the root.
+        entry: os.DirEntry of the entry. None for the root, and when leaving
+            a directory.
+        is_dir: Whether the entry is a walked directory. Symlinks to
+            directories are not walked, and visited like files.
+        leaving: Whether all contents of the directory were visited.
+    """
+    path: str
+    dirpath: str | None
+    entry: os.DirEntry | None
+    is_dir: bool
+    leaving: bool = False
+
+
+class TreeWalker():
+    """
+    Walks a directory tree depth first.
+
+    Every directory is visited when entering it, then its entries, then
+    again when leaving it. Entries within a directory come in the order of
+    os.scandir.
+    """
+    def __init__(self, root: Path | str,
+                 ignore: Callable[[str, list[str]], set[str]] | None = None,
+                 onerror: Callable[[OSError], None] | None = None):
+        """
+        Args:
+            root: Root of the tree.
+            ignore: If set, called with a directory and the names of some of
+                its entries, like the ignore argument of shutil.copytree. The
+                returned names are not visited.
+            onerror: If set, called with the error when a directory cannot
+                be read, after which the walk continues without its (other)
+                entries. Otherwise, the error is raised.
+        """
+        self.root: str = os.fspath(root)
+        self.ignore: Callable[[str, list[str]], set[str]] | None = ignore
+        self.onerror: Callable[[OSError], None] | None = onerror
+        self.skipping: bool = False
+
+    def skip(self) -> None:
+        """
+        Skips the contents of the directory that was just entered. It is not
+        left either.
+        """
+        self.skipping = True
+
+    def error(self, e: OSError) -> None:
+        if self.onerror is None:
+            raise e
+        self.onerror(e)
+
+    def __iter__(self) -> Iterator[Visit]:
+        stack: list[tuple[str, Iterator[os.DirEntry]]] = []
+        try:
+            self.skipping = False
+            yield Visit(self.root, None, None, True)
+            if self.skipping:
+                return
+            try:
+                stack.append((self.root, os.scandir(self.root)))
+            except OSError as e:
+                self.error(e)
+                yield Visit(self.root, None, None, True, True)
+            while stack:
+                dirpath, entries = stack[-1]
+                try:
+                    entry = next(entries, None)
+                except OSError as e:
+                    self.error(e)
+                    entry = None
+                if entry is None:
+                    entries.close()
+                    stack.pop()
+                    parent = stack[-1][0] if stack else None
+                    yield Visit(dirpath, parent, None, True, True)
+                    continue
+                if (self.ignore is not None
+                        and self.ignore(dirpath, [entry.name])):
+                    continue
+
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    is_dir = False
+                self.skipping = False
+                yield Visit(entry.path, dirpath, entry, is_dir)
+                if not is_dir or self.skipping:
+                    continue
+                try:
+                    stack.append((entry.path, os.scandir(entry.path)))
+                except OSError as e:
+                    self.error(e)
+                    yield Visit(entry.path, dirpath, None, True, True)
+        finally:
+            for _, entries in stack:
+                entries.close()
+
+
+class BoundedExecutor(ThreadPoolExecutor):
+    """
+    ThreadPoolExecutor whose submit blocks while too many tasks are waiting
+    or running, so a fast producer cannot queue up unbounded work.
+    """
+    def __init__(self, max_workers: int, depth: int | None = None,
+                 **kwargs):
+        """
+        Args:
+            max_workers: Amount of worker threads.
+            depth: Amount of tasks that may be submitted and unfinished.
+                Defaults to four per worker.
+            **kwargs: Passed to ThreadPoolExecutor.
+        """
+        super().__init__(max_workers=max_workers, **kwargs)
+        self.slots: BoundedSemaphore = BoundedSemaphore(depth
+                                                        or max_workers * 4)
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        self.slots.acquire()
+        try:
+            future = super().submit(fn, *args, **kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self.slots.release())
+        return future
+
+
+class DirectoryBarrier():
+    """
+    Finishes every directory of a walk once everything in it is done.
+
+    A directory is finished after it was left, all work started on its
+    entries is done, and its subdirectories are finished. Work is usually
+    done in other threads, so a directory may be finished by any of them.
+    """
+    def __init__(self, finish: Callable[[str], None]):
+        """
+        Args:
+            finish: Called with every finished directory. Must not raise.
+        """
+        self.finish: Callable[[str], None] = finish
+        # Directory: [unfinished work, left, parent].
+        self.pending: dict[str, list] = {}
+        self.lock: Lock = Lock()
+
+    def enter(self, path: str, parent: str | None) -> None:
+        with self.lock:
+            self.pending[path] = [0, False, parent]
+            if parent is not None:
+                self.pending[parent][0] += 1
+
+    def start(self, directory: str) -> None:
+        """Records work started on an entry of a directory."""
+        with self.lock:
+            self.pending[directory][0] += 1
+
+    def done(self, directory: str) -> None:
+        """Records work done on an entry of a directory."""
+        with self.lock:
+            self.pending[directory][0] -= 1
+        self.check(directory)
+
+    def leave(self, path: str) -> None:
+        with self.lock:
+            self.pending[path][1] = True
+        self.check(path)
+
+    def check(self, directory: str | None) -> None:
+        while directory is not None:
+            with self.lock:
+                state = self.pending.get(directory)
+                if state is None or state[0] or not state[1]:
+                    return
+                del self.pending[directory]
+            self.finish(directory)
+            directory = state[2]
+            if directory is not None:
+                with self.lock:
+                    self.pending[directory][0] -= 1
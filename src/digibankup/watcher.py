@@ -0,0 +1,261 @@
+"""
+Watches the trees of the FOG server with inotify between backups.
+
+Every change marks the directory it happened in as dirty. A directory that
+appears, disappears or moves is marked dirty as a whole tree. The next backup
+only compares the files in dirty directories with their sources. Files in
+clean directories are hard linked from the previous backup without being
+looked at.
+
+inotify is used through ctypes, so this only works on Linux. If the kernel
+drops events, every directory counts as dirty during the next backup. If it
+runs out of watches, during every backup.
+"""
+
+import os
+import ctypes
+import ctypes.util
+import errno
+import select
+import struct
+from logging import getLogger
+from pathlib import Path
+from threading import Event, Lock, Thread
+
+logger = getLogger(__name__)
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+              | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+              | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+EVENT_HEADER = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+
+
+class ChangeSet():
+    """
+    Directories that changed since a backup.
+
+    Paths are absolute and normalized. A directory is clean if it lies in
+    one of the watched roots, and neither it nor any of its parents was
+    marked dirty as a tree.
+    """
+    def __init__(self, roots: list[str], since: str | None = None):
+        """
+        Args:
+            roots: Roots of the watched trees.
+            since: Name of the snapshot the changes are relative to. None if
+                unknown, in which case nothing is clean.
+        """
+        self.roots: set[str] = {os.path.normpath(root) for root in roots}
+        self.since: str | None = since
+        self.dirs: set[str] = set()
+        self.trees: set[str] = set()
+        self.overflow: bool = False
+
+    def mark_dir(self, path: str) -> None:
+        self.dirs.add(os.path.normpath(path))
+
+    def mark_tree(self, path: str) -> None:
+        self.trees.add(os.path.normpath(path))
+
+    def merge(self, other: 'ChangeSet') -> None:
+        """Adds the changes of an older change set to this one."""
+        self.dirs |= other.dirs
+        self.trees |= other.trees
+        self.overflow |= other.overflow
+        self.since = other.since
+
+    def usable(self, previous: str | None) -> bool:
+        """
+        Checks if the changes can replace comparing files with the previous
+        backup.
+
+        Args:
+            previous: Name of the snapshot of the previous backup.
+        """
+        return (not self.overflow and self.since is not None
+                and self.since == previous)
+
+    def is_clean(self, dirpath: str) -> bool:
+        """Checks if nothing changed in a directory."""
+        path = os.path.normpath(dirpath)
+        if path in self.dirs:
+            return False
+        while True:
+            if path in self.trees:
+                return False
+            if path in self.roots:
+                return True
+            parent = os.path.dirname(path)
+            if parent == path:
+                return False
+            path = parent
+
+    def summary(self) -> str:
+        return (f"{len(self.dirs)} changed directories and "
+                f"{len(self.trees)} changed trees")
+
+
+class Watcher():
+    """
+    Watches directory trees with inotify in a background thread.
+
+    The changes are collected in a change set, which take swaps for a new one
+    at the start of every backup.
+    """
+    def __init__(self, roots: list[Path]):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        self.inotify_add_watch = libc.inotify_add_watch
+        self.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p,
+                                           ctypes.c_uint32)
+        self.inotify_rm_watch = libc.inotify_rm_watch
+        self.fd: int = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f"inotify_init1: {os.strerror(error)}")
+
+        self.roots: list[str] = [os.path.normpath(root) for root in roots]
+        self.paths: dict[int, str] = {}
+        self.changes: ChangeSet = ChangeSet(self.roots)
+        self.complete: bool = True
+        self.lock: Lock = Lock()
+        self.stopping: Event = Event()
+        self.thread: Thread | None = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *e):
+        self.close()
+
+    def add_tree(self, root: str) -> None:
+        """Watches every directory in a tree."""
+        for dirpath, dirnames, filenames in os.walk(root):
+            if not self.add_watch(dirpath):
+                dirnames.clear()
+
+    def add_watch(self, path: str) -> bool:
+        wd = self.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd >= 0:
+            self.paths[wd] = path
+            return True
+        error = ctypes.get_errno()
+        if error in (errno.ENOENT, errno.ENOTDIR):
+            return False
+        logger.error(f"Could not watch {path}: {os.strerror(error)}. "
+                     f"Comparing every file during every backup.")
+        self.complete = False
+        self.changes.overflow = True
+        return False
+
+    def remove_tree(self, root: str) -> None:
+        """Stops watching a tree that moved away."""
+        prefix = root + os.sep
+        for wd, path in list(self.paths.items()):
+            if path == root or path.startswith(prefix):
+                self.inotify_rm_watch(self.fd, wd)
+                del self.paths[wd]
+
+    def start(self) -> None:
+        """Adds the watches and starts reading events."""
+        with self.lock:
+            for root in self.roots:
+                self.add_tree(root)
+        logger.info(f"Watching {len(self.paths)} directories under "
+                    f"{', '.join(self.roots)}.")
+        self.thread = Thread(target=self.run, name='watcher', daemon=True)
+        self.thread.start()
+
+    def run(self) -> None:
+        while not self.stopping.is_set():
+            readable, _, _ = select.select([self.fd], [], [], 1)
+            if not readable:
+                continue
+            data = os.read(self.fd, READ_SIZE)
+            with self.lock:
+                self.handle(data)
+
+    def handle(self, data: bytes) -> None:
+        """Marks the directories of a batch of events as dirty."""
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("inotify dropped events. Comparing every "
+                               "file during the next backup.")
+                self.changes.overflow = True
+                continue
+            dirpath = self.paths.get(wd)
+            if dirpath is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.paths[wd]
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                self.changes.mark_tree(dirpath)
+                continue
+
+            self.changes.mark_dir(dirpath)
+            if not mask & IN_ISDIR:
+                continue
+            path = os.path.join(dirpath, name)
+            self.changes.mark_tree(path)
+            if mask & IN_MOVED_FROM:
+                self.remove_tree(path)
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(path)
+
+    def take(self) -> ChangeSet:
+        """
+        Returns the changes so far, and starts collecting new ones.
+
+        The new change set is relative to the backup the returned changes
+        are used for, once finish names its snapshot.
+        """
+        with self.lock:
+            changes = self.changes
+            self.changes = ChangeSet(self.roots)
+            self.changes.overflow = not self.complete
+        return changes
+
+    def finish(self, changes: ChangeSet, snapshot: str | None) -> None:
+        """
+        Records the outcome of the backup that used a change set.
+
+        Args:
+            changes: Result of take.
+            snapshot: Name of the snapshot of the backup, or None if it
+                failed, in which case its changes are collected again.
+        """
+        with self.lock:
+            if snapshot is None:
+                self.changes.merge(changes)
+            else:
+                self.changes.since = snapshot
+
+    def close(self) -> None:
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        os.close(self.fd)
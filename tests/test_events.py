@@ -0,0 +1,38 @@
+import json
+import logging
+from configparser import ConfigParser
+
+from digibankup.config import default_config_dict
+from digibankup.fog import copy_function_maker
+from digibankup.logging import configure_events
+from digibankup.transfer import copy_tree
+
+
+def test_events_are_written_with_logging_off(tmp_path):
+    config = ConfigParser()
+    config.read_dict(default_config_dict)
+    config['paths']['event_log'] = str(tmp_path / 'events.jsonl')
+    config['settings']['log'] = 'False'
+    config['settings']['event_batch_size'] = '2'
+    src = tmp_path / 'src'
+    src.mkdir()
+    for i in range(3):
+        (src / f'f{i}').write_bytes(b'x' * i)
+
+    # configure_logging is not called, as with --no-log.
+    assert not logging.getLogger('digibankup').handlers
+    stop = configure_events(config)
+    try:
+        assert copy_tree(src, tmp_path / 'dst', copy_function_maker(0),
+                         2) == []
+    finally:
+        stop()
+
+    with (tmp_path / 'events.jsonl').open() as f:
+        events = [json.loads(line) for line in f]
+    assert sorted(event['file'] for event in events) == [
+        str(src / f'f{i}') for i in range(3)]
+    for event in events:
+        assert event['result'] == 'copied'
+        assert event['bytes'] == int(event['file'][-1])
+        assert event['duration'] >= 0
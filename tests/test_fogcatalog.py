@@ -0,0 +1,14 @@
+from digibankup.fogcatalog import select
+
+
+def test_select_keeps_postinitscripts(tmp_path):
+    for path in ('dev/postinitscripts', 'dev/001122aabbcc',
+                 'dev/00:11:22:aa:bb:cd'):
+        (tmp_path / path).mkdir(parents=True)
+
+    selection = select([], tmp_path)
+    ignore = selection.ignore(tmp_path)
+    assert ignore(str(tmp_path), ['dev']) == set()
+    assert ignore(str(tmp_path / 'dev'), [
+        'postinitscripts', '001122aabbcc', '00:11:22:aa:bb:cd']) == {
+        '001122aabbcc', '00:11:22:aa:bb:cd'}
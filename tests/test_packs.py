@@ -0,0 +1,22 @@
+import os
+
+from digibankup import packs
+
+
+def test_pack_files_skips_unreadable_files(tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    files = []
+    for name in ('a', 'b', 'c'):
+        (src / name).write_bytes(name.encode() * 10)
+        files.append((str(src / name), name, os.lstat(src / name)))
+    (src / 'b').unlink()
+
+    packs_path = tmp_path / 'tree.packs'
+    entries, linked, errors = packs.pack_files(files, packs_path, 1 << 20)
+
+    assert [entry['path'] for entry in entries] == ['a', 'c']
+    assert [error[0] for error in errors] == [str(src / 'b')]
+    dst = tmp_path / 'restored'
+    assert packs.extract_files(packs_path, dst) == []
+    assert (dst / 'c').read_bytes() == b'c' * 10
@@ -0,0 +1,35 @@
+import os
+
+from digibankup.fog import copy_function_maker
+from digibankup.journal import Journal
+from digibankup.transfer import copy_tree
+
+
+def test_resume_keeps_previous_backup_intact(tmp_path):
+    src = tmp_path / 'src'
+    previous = tmp_path / 'previous'
+    backup = tmp_path / '0'
+    for path in (src, previous, backup):
+        path.mkdir()
+    (previous / 'f0.bin').write_bytes(b'old')
+    # The interrupted backup hard linked the file, but its journal line was
+    # lost. The source changed before the backup is resumed.
+    os.link(previous / 'f0.bin', backup / 'f0.bin')
+    (src / 'f0.bin').write_bytes(b'new contents CHANGED')
+
+    journal = Journal(backup, {})
+    journal.open()
+    journal.close()
+    journal = Journal(backup, {})
+    assert journal.load()
+    journal.open()
+    try:
+        copy_function = copy_function_maker(0, src_root=src,
+                                            link_root=previous,
+                                            journal=journal)
+        assert copy_tree(src, backup, copy_function, 2) == []
+    finally:
+        journal.close()
+
+    assert (previous / 'f0.bin').read_bytes() == b'old'
+    assert (backup / 'f0.bin').read_bytes() == b'new contents CHANGED'
@@ -0,0 +1,163 @@
+import json
+import os
+from configparser import ConfigParser
+
+import pytest
+
+boto3 = pytest.importorskip('boto3')
+moto = pytest.importorskip('moto')
+
+from botocore.exceptions import ClientError  # noqa: E402
+
+import digibankup.chunkstore as chunkstore  # noqa: E402
+import digibankup.s3 as s3  # noqa: E402
+from digibankup.config import default_config_dict  # noqa: E402
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket='bucket')
+        yield client
+
+
+@pytest.fixture
+def config(tmp_path):
+    config = ConfigParser()
+    config.read_dict(default_config_dict)
+    config['paths']['backups'] = str(tmp_path / 'backups')
+    config['settings']['http_backoff'] = '0'
+    config['destination:s3'] = {'type': 's3', 'bucket': 'bucket',
+                                'region': 'us-east-1',
+                                'part_size': str(s3.MIN_PART_SIZE)}
+    return config
+
+
+def back_up(config, source_root, before_complete=None):
+    """Stores a backup in the bucket, as backup.backup does."""
+    with s3.S3Destination('s3', config) as destination:
+        destination.prepare(source_root)
+        if before_complete is not None:
+            before_complete(destination)
+        destination.complete()
+        assert not destination.failed
+        destination.rotate({})
+    return destination
+
+
+def read(client, key):
+    return client.get_object(Bucket='bucket', Key=key)['Body'].read()
+
+
+def list_keys(client, prefix):
+    response = client.list_objects_v2(Bucket='bucket', Prefix=prefix)
+    return {entry['Key'] for entry in response.get('Contents', [])}
+
+
+def read_catalog(client, destination):
+    data = read(client, destination.snapshot_key(destination.snapshot,
+                                                 'catalog.jsonl'))
+    return {entry['path']: entry
+            for entry in map(json.loads, data.splitlines())}
+
+
+def test_failed_parts_are_retried(client, config, tmp_path):
+    source_root = tmp_path / 'backups' / '0'
+    source_root.mkdir(parents=True)
+    data = os.urandom(2 * s3.MIN_PART_SIZE + 10)
+    (source_root / 'image.img').write_bytes(data)
+    failed = set()
+
+    def stream(destination):
+        upload_part = destination.client.upload_part
+
+        def flaky_upload_part(**kwargs):
+            if kwargs['PartNumber'] not in failed:
+                failed.add(kwargs['PartNumber'])
+                raise ClientError({'Error': {'Code': 'InternalError'}},
+                                  'UploadPart')
+            return upload_part(**kwargs)
+        destination.client.upload_part = flaky_upload_part
+        with destination.open(source_root / 'image.img') as f:
+            f.write(data)
+
+    destination = back_up(config, source_root, stream)
+    assert failed == {1, 2, 3}
+    assert destination.stats.retries == 3
+    entry = read_catalog(client, destination)['image.img']
+    assert read(client, entry['key']) == data
+    assert not client.list_multipart_uploads(
+        Bucket='bucket').get('Uploads')
+
+
+def test_small_files_are_packed(client, config, tmp_path):
+    source_root = tmp_path / 'backups' / '0'
+    (source_root / 'dir').mkdir(parents=True)
+    for i in range(3):
+        (source_root / 'dir' / f'{i}.txt').write_bytes(os.urandom(i * 100))
+    (source_root / 'dir' / 'link').symlink_to('1.txt')
+
+    destination = back_up(config, source_root)
+    catalog = read_catalog(client, destination)
+    assert sorted(catalog) == ['dir/0.txt', 'dir/1.txt', 'dir/2.txt',
+                               'dir/link']
+    for path, entry in catalog.items():
+        assert 'key' not in entry
+        if path == 'dir/link':
+            continue
+        pack = read(client, entry['pack'])
+        assert (pack[entry['offset']:entry['offset'] + entry['size']]
+                == (source_root / path).read_bytes())
+
+
+@pytest.mark.parametrize('max_copy_size', [s3.MAX_COPY_SIZE,
+                                           s3.MIN_PART_SIZE])
+def test_unchanged_files_are_copied(client, config, tmp_path, monkeypatch,
+                                    max_copy_size):
+    # Below MAX_COPY_SIZE the copy is a single request, above it a multipart
+    # copy.
+    monkeypatch.setattr(s3, 'MAX_COPY_SIZE', max_copy_size)
+    source_root = tmp_path / 'backups' / '0'
+    source_root.mkdir(parents=True)
+    data = os.urandom(2 * s3.MIN_PART_SIZE + 10)
+    (source_root / 'image.img').write_bytes(data)
+    first = back_up(config, source_root)
+
+    second = back_up(config, source_root)
+    assert second.stats.linked == 1
+    assert second.stats.bytes_written == 0
+    entry = read_catalog(client, second)['image.img']
+    assert entry['key'] != read_catalog(client, first)['image.img']['key']
+    assert read(client, entry['key']) == data
+
+
+def test_rotation_removes_snapshots_and_chunks(client, config, tmp_path):
+    config['destination:s3']['backup_count'] = '1'
+    source_root = tmp_path / 'backups' / '0'
+    images = tmp_path / 'images'
+    images.mkdir()
+    store = chunkstore.ChunkStore.from_config(config)
+    manifest_path = chunkstore.manifest_path_of(
+        source_root / config['subpaths']['fog_images'])
+    manifest_path.parent.mkdir(parents=True)
+
+    snapshots = []
+    for contents in (b'old image', b'new image'):
+        (images / 'image.img').write_bytes(contents)
+        chunkstore.backup_tree(store, images, manifest_path)
+        snapshots.append(back_up(config, source_root).snapshot)
+        if len(snapshots) == 1:
+            old_chunks = list_keys(client, s3.CHUNKS_PREFIX)
+
+    index = json.loads(read(client, s3.INDEX_KEY))
+    assert index['snapshots'] == snapshots[1:]
+    assert not list_keys(client, f'{s3.SNAPSHOTS_PREFIX}{snapshots[0]}/')
+    chunks = list_keys(client, s3.CHUNKS_PREFIX)
+    referenced = {s3.CHUNKS_PREFIX + digest for digest in read(
+        client, f'{s3.SNAPSHOTS_PREFIX}{snapshots[1]}/chunks.txt'
+    ).decode().split()}
+    assert chunks == referenced
+    assert old_chunks and not old_chunks & chunks
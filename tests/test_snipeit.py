@@ -0,0 +1,38 @@
+import json
+
+import requests
+
+from digibankup.compression import Compressor
+from digibankup.snipeit import Exporter, export_resource
+
+
+class FakeExporter(Exporter):
+    """Serves records in id order, whatever sort is asked for."""
+    def __init__(self, rows):
+        super().__init__('http://snipeit/api/v1/', 'token', 2, 1,
+                         requests.Session(), (1, 1))
+        self.rows = rows
+
+    def page(self, resource, offset, sort='id', order='asc'):
+        return {'total': len(self.rows),
+                'rows': self.rows[offset:offset + self.page_size]}
+
+
+def test_unsorted_updates_fetch_all_records(tmp_path):
+    previous = tmp_path / 'previous.jsonl'
+    previous.write_text(''.join(
+        json.dumps({'id': i, 'updated_at': '2024-01-01 00:00:00'}) + '\n'
+        for i in range(1, 5)))
+    rows = [{'id': i, 'updated_at': f'2024-{month:02}-01 00:00:00'}
+            for i, month in enumerate((1, 2, 1, 3), 1)]
+    exporter = FakeExporter(rows)
+
+    assert exporter.updated_records('hardware',
+                                    '2024-01-15 00:00:00') is None
+    with Compressor('none', 0, 1) as compressor:
+        newest, _ = export_resource(exporter, compressor, 'hardware',
+                                    tmp_path, previous,
+                                    '2024-01-01 00:00:00')
+    assert newest == '2024-03-01 00:00:00'
+    with (tmp_path / 'hardware.jsonl').open() as f:
+        assert [json.loads(line) for line in f] == rows
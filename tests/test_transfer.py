@@ -0,0 +1,28 @@
+from digibankup.transfer import copy_file, copy_tree
+
+
+def test_copy_tree_reports_unexpected_errors(tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    (src / 'a').write_text('a')
+
+    def copy_function(src, dst, *, follow_symlinks=True, entry=None):
+        raise ValueError('broken')
+
+    errors = copy_tree(src, tmp_path / 'dst', copy_function, 2)
+    assert errors == [(str(src / 'a'), str(tmp_path / 'dst' / 'a'),
+                       'ValueError: broken')]
+
+
+def test_copy_tree_keeps_symlinks_to_directories(tmp_path):
+    src = tmp_path / 'src'
+    (src / 'real').mkdir(parents=True)
+    (src / 'real' / 'a').write_text('a')
+    (src / 'link').symlink_to('real')
+
+    def copy_function(src, dst, *, follow_symlinks=True, entry=None):
+        return copy_file(src, dst, follow_symlinks=follow_symlinks)
+
+    assert copy_tree(src, tmp_path / 'dst', copy_function, 2) == []
+    assert (tmp_path / 'dst' / 'real' / 'a').read_text() == 'a'
+    assert (tmp_path / 'dst' / 'link').readlink().as_posix() == 'real'